@@ -50,12 +50,16 @@ import math
 import shutil
 import tempfile
 import hashlib
+import json
 import lxml
 import random
 import threading
+import contextlib
 
 import dhelpers as dh
 import inkex
+import inkscape_shell
+import export_cache
 from inkex import TextElement, Transform, Vector2d
 from inkex.text.utils import default_style_atts, unique
 from inkex.text.cache import BaseElementCache
@@ -77,6 +81,63 @@ MAX_THREADS = 10;
 sema1 = threading.Semaphore(MAX_THREADS)
 sema2 = threading.Semaphore(MAX_THREADS)
 
+
+def make_pool(bfn, size=MAX_THREADS):
+    """
+    Make a pool of persistent Inkscape workers whose size matches the binary
+    call limit. Returns None if the installed Inkscape cannot support one.
+    """
+    if not inkscape_shell.shell_supported(inkex.installed_ivp):
+        return None
+    return inkscape_shell.ShellPool(bfn, size, cwd=dh.shared_temp())
+
+
+class QueuePrinter:
+    """A picklable print function that sends messages to a queue"""
+
+    def __init__(self, msgq):
+        self.msgq = msgq
+
+    def __call__(self, msg, **kwargs):
+        self.msgq.put(msg)
+
+
+class StopFlag:
+    """Stands in for an exporter thread's stopped attribute in a worker process"""
+
+    def __init__(self, event):
+        self.event = event
+
+    @property
+    def stopped(self):
+        return self.event.is_set()
+
+
+process_pool = None
+
+
+def export_in_process(fin, opts, stopevent, msgq):
+    """
+    Entry point for exporting a file in a process-pool worker. Messages are
+    sent to msgq and the export stops once stopevent is set.
+    """
+    global process_pool
+    if process_pool is None:
+        # Each worker exports one file at a time, so one shell is enough
+        process_pool = make_pool(opts.bfn, size=1)
+    opts.prints = QueuePrinter(msgq)
+    opts.aeThread = StopFlag(stopevent)
+    opts.pool = process_pool
+    try:
+        Exporter(fin, opts).export_all()
+    except SystemExit:
+        pass
+    except Exception:  # pylint: disable=broad-except
+        import traceback  # pylint: disable=import-outside-toplevel
+
+        fname = os.path.split(fin)[1]
+        msgq.put(f"Exception in {fname}\n" + traceback.format_exc())
+
 class AutoExporter(inkex.EffectExtension):
     """Automates exporting of SVG files in multiple formats."""
 
@@ -434,6 +495,8 @@ class AutoExporter(inkex.EffectExtension):
 class Exporter():
     def __init__(self,fin,opts):
         self.filein = fin
+        self.pool = None  # persistent Inkscape workers, if any
+        self.usecache = True  # serve unchanged outputs from the export cache
         self.__dict__.update(vars(opts))
         
     sema_temp = threading.Semaphore(1)
@@ -453,9 +516,16 @@ class Exporter():
         if not os.path.exists(outdir):
             os.makedirs(outdir)
 
+        # Serve any outputs we have already made from the cache
+        formats = list(self.formats)
+        self.cache = None
+        if self.usecache and not (self.testmode or self.debug):
+            self.cache = export_cache.ExportCache()
+            formats = [fmt for fmt in formats if not self.fetch_cached(fmt)]
+
         # Add a document margin
         cfile = self.filein # current file we're working on
-        if self.margin != 0:
+        if self.margin != 0 and len(formats) > 0:
             svg = get_svg(cfile)
             tmp = self.tempbase + "_marg.svg"
             Exporter.add_margin(svg, self.margin, self.testmode)
@@ -463,20 +533,19 @@ class Exporter():
             cfile = copy.copy(tmp)
 
         # Do png before any preprocessing
-        if "png" in self.formats:
-            finished, myo = self.export_file(cfile, "png")
+        if "png" in formats:
+            finished, _ = self.export_file(cfile, "png")
+            if finished:
+                self.store_cached("png")
 
         # Do preprocessing
-        if any(fmt in self.formats for fmt in ["pdf", "emf", "eps", "psvg"]):
-            cfile = self.preprocessing(cfile)
+        if any(fmt in formats for fmt in ["pdf", "emf", "eps", "psvg"]):
+            cfile = self.cached_preprocessing(cfile)
 
         # Do vector outputs
-        newfiles = []
-        for fmt in self.formats:
-            if fmt != "png":
-                finished, myo = self.export_file(cfile, fmt)
-            if finished:
-                newfiles.append(myo)
+        vformats = [fmt for fmt in formats if fmt != "png"]
+        if len(vformats) > 0:
+            self.export_vectors(cfile, vformats)
 
         # Remove temporary outputs and directory
         failed_to_delete = None
@@ -488,6 +557,139 @@ class Exporter():
             subprocess.Popen(f'explorer "{os.path.realpath(self.tempdir)}"')
         return failed_to_delete
 
+    def cache_key(self, stage):
+        """
+        Key for a cached output (stage is a format) or for the preprocessed
+        SVG (stage is 'preprocessed'). It includes everything the stage
+        depends on: the file's contents, linked images, export options, the
+        Inkscape version, and the version of this code.
+        """
+        if not hasattr(self, "linked_sig"):
+            if self.exportnow:
+                lls = self.linked_locations
+            else:
+                lls = ih.get_linked_locations_file(self.filein, get_svg(self.filein))
+            self.linked_sig = export_cache.files_signature(lls.values())
+        base = (
+            self.get_filehash(),
+            self.linked_sig,
+            export_cache.code_signature(dh.si_dir),
+            tuple(inkex.installed_ivp),
+            self.bfn,
+            float(self.margin),
+            int(self.dpi),
+        )
+        if stage == "png":
+            return export_cache.cache_key(base, stage)
+        pre = base + (
+            self.texttopath,
+            self.stroketopath,
+            self.usepsvg,
+            self.imagemode2,
+            ih.hasPIL,
+            inkex.inkscape_system_info.language,
+        )
+        if stage == "preprocessed":
+            return export_cache.cache_key(pre, stage)
+        fmtopts = (self.thinline,)
+        if stage == "pdf":
+            fmtopts += (self.latexpdf,)
+        elif stage == "psvg":
+            # The original's location and hash are written into plain SVGs
+            fmtopts += (self.backingrect, self.original_file)
+            fmtopts += (hash_file(self.original_file),)
+        return export_cache.cache_key(pre, stage, fmtopts)
+
+    def raster_keys(self, svg, els, overlaps, around):
+        """
+        Keys for the rasterized images of els. An element's images only depend
+        on how it and the elements around it render (overlaps are those on
+        top, which are hidden for the opaque image), so edits elsewhere in
+        the file do not invalidate them.
+        """
+        docsig = [repr(sorted(svg.attrib.items()))]
+        for k in svg.descendants2():
+            if k.tag in {inkex.StyleElement.ctag, inkex.NamedView.ctag}:
+                docsig.append(lxml.etree.tostring(k, with_tail=False))
+        base = (
+            export_cache.code_signature(dh.si_dir),
+            tuple(inkex.installed_ivp),
+            self.bfn,
+            int(self.dpi),
+            ih.hasPIL,
+            getattr(self, "linked_sig", None),
+            hashlib.sha256(repr(docsig).encode("utf-8")).hexdigest(),
+        )
+        sigs = dict()
+
+        def sig(elem):
+            if elem not in sigs:
+                sigs[elem] = render_signature(elem)
+            return sigs[elem]
+
+        ret = dict()
+        for elem in els:
+            nbrs = tuple((sig(o), o in overlaps[elem]) for o in around[elem])
+            ret[elem] = export_cache.cache_key(base, "raster", sig(elem), nbrs)
+        return ret
+
+    def output_names(self, fmt):
+        """Base name of a format's outputs and the extension they end with"""
+        base = os.path.splitext(os.path.split(self.outtemplate)[1])[0]
+        return base, ("_plain.svg" if fmt == "psvg" else "." + fmt)
+
+    def fetch_cached(self, fmt):
+        """Copy a format's outputs from the cache, returning True on a hit."""
+        outdir = os.path.dirname(self.outtemplate)
+        base, _ = self.output_names(fmt)
+        meta = self.cache.fetch(
+            self.cache_key(fmt), lambda sfx: os.path.join(outdir, base + sfx)
+        )
+        if meta is None:
+            return False
+        dests = [os.path.join(outdir, base + sfx) for sfx in meta["files"]]
+        myoutput = self.outtemplate[0:-4] + "." + fmt
+        if fmt == "psvg":
+            myoutput = myoutput.replace(".psvg", "_plain.svg")
+        self.remove_stale_outputs(myoutput, dests)
+        self.print_status("Conversion to " + fmt + " unchanged (cached)")
+        return True
+
+    def store_cached(self, fmt):
+        """Add a format's just-made outputs to the cache."""
+        if self.cache is None:
+            return
+        base, ext = self.output_names(fmt)
+        files = dict()
+        for fout in self.final_outputs:
+            name = os.path.split(fout)[1]
+            if not (name.startswith(base) and name.endswith(ext)):
+                continue  # not an output of this format
+            files[name[len(base):]] = fout
+            if fmt == "pdf" and self.latexpdf and os.path.exists(fout + "_tex"):
+                files[os.path.split(fout)[1][len(base):] + "_tex"] = fout + "_tex"
+        if len(files) > 0 and all(os.path.exists(f) for f in files.values()):
+            self.cache.store(self.cache_key(fmt), files)
+
+    def cached_preprocessing(self, fin):
+        """Run preprocessing, reusing the result for unchanged inputs."""
+        tmp = self.tempbase + "_prec.svg"
+        if self.cache is not None:
+            key = self.cache_key("preprocessed")
+            meta = self.cache.fetch(key, {"preprocessed.svg": tmp})
+            if meta is not None:
+                self.excludetxtids = meta["excludetxtids"]
+                self.duplicatelabels = meta["duplicatelabels"]
+                return tmp
+        cfile = self.preprocessing(fin)
+        if self.cache is not None:
+            meta = {
+                "excludetxtids": self.excludetxtids,
+                "duplicatelabels": self.duplicatelabels,
+            }
+            self.cache.store(key, {"preprocessed.svg": cfile}, meta)
+        return cfile
+
     def clear_temp(self):
         """ Clear any temporary files """
         if not (self.debug):
@@ -532,6 +734,7 @@ class Exporter():
         # SVG modifications that should be done prior to any binary calls
         cfile = fin
         svg = get_svg(cfile)
+        svg.resolve_all()  # nearly every element is visited below
 
         # Prune hidden items and remove language switching
         stag = inkex.addNS("switch", "svg")
@@ -752,6 +955,7 @@ class Exporter():
             type == 'stp' creates an action that stroke-to-path's a group of objects
             type == 'imgt' exports a PNG copy of an image with a transparent background
             type == 'imgo' exports a PNG copy of an image with an opaque background, and objects above hidden
+            type == 'ck' exports the document unchanged, as a checkpoint
             '''
             def __init__(self,typ,els,fname=None,overlaps=None):
                 self.type = typ
@@ -782,6 +986,8 @@ class Exporter():
                     return "select:{0}; {1}; export-filename:{2}; export-do; unselect:{0}; ".format(
                         ",".join(self.els), Act.stpact, self.fname
                     )
+                elif self.type == 'ck':
+                    return "export-filename:{0}; export-do; ".format(self.fname)
                 elif self.type == 'imgt':
                     fmt1 = (
                         "export-id:{0}; export-id-only; export-dpi:{1}; "
@@ -804,13 +1010,6 @@ class Exporter():
                     unhides = ['select:{0}; object-set-property:display,{1}; unselect:{0}; '.format(el.get_id(), \
                                 displays[el] if displays[el] is not None else '') for el in overlaps[el]]
                     return ''.join(hides) + actv + ''.join(unhides)
-                
-            def split(self,intermediate_fn):
-                ''' Splits a STP act into two sub-acts '''
-                spl = math.ceil(len(self.els) / 2)
-                act1 = Act('stp',self.els[:spl],intermediate_fn)
-                act2 = Act('stp',self.els[spl:],self.fname)
-                return act1, act2
                     
 
         allacts = []
@@ -853,6 +1052,7 @@ class Exporter():
 
         # Rasterizations
         actts, actos  = [], []
+        cached_bbs = dict()
         if do_rasterizations:
             svg = get_svg(cfile)
 
@@ -861,17 +1061,33 @@ class Exporter():
             if len(els) > 0:
                 imgtype = "png"
                 
-                overlaps = dh.overlapping_els(svg,els)
+                around = dh.overlapping_els(svg,els,below=True)
+                order = {el: i for i, el in enumerate(svg.descendants2())}
+                overlaps = {el: [o for o in around[el] if order[o] > order[el]] for el in els}
                 for elem in els:
                     elid = elem.get_id()
                     actts.append(Act('imgt',elem))
                     actos.append(Act('imgo',elem,overlaps=overlaps))
+
+                # Reuse the images of elements whose rendering is unchanged
+                if self.cache is not None:
+                    rkeys = self.raster_keys(svg, els, overlaps, around)
+                    for actt, acto in zip(actts, actos):
+                        dests = {"t.png": os.path.join(tempdir, actt.fname)}
+                        if ih.hasPIL:
+                            dests["o.png"] = os.path.join(tempdir, acto.fname)
+                        meta = self.cache.fetch(rkeys[actt.els[0]], dests)
+                        if meta is not None:
+                            cached_bbs[actt.els[0].get_id()] = meta["bb"]
                 
-                allacts += (actos + actts) if ih.hasPIL else actts
+                nacts = [act for act in actts if act.els[0].get_id() not in cached_bbs]
+                nacts = [act for act in actos if act.els[0].get_id() not in cached_bbs] + nacts
+                allacts += nacts if ih.hasPIL else [act for act in nacts if act.type == 'imgt']
                 # export-id-onlys need to go last
                 
         imgs_trnp = {act.fname:act.els[0].get_id() for act in actts}
         imgs_opqe = {act.fname:act.els[0].get_id() for act in actos}
+        bbs = dict(cached_bbs)
 
         # To reduce the number of binary calls, we collect the stroke-to-path and
         # rasterization actions into a single call that also gets the Bounding Boxes.
@@ -879,7 +1095,7 @@ class Exporter():
         if len(allacts) > 0 and not self.testmode:
             # use relative paths to reduce arg length
             
-            bbs = self.split_acts(fnm=cfile, acts=allacts)
+            bbs.update(self.run_acts(cfile, allacts) or dict())
             
             imgs = imgs_opqe | imgs_trnp
             missing_images = [t for t in imgs if not os.path.exists(os.path.join(tempdir, t)) and imgs[t] in bbs]
@@ -889,6 +1105,18 @@ class Exporter():
                     + ", ".join(missing_images) + ' in ' + tempdir + '.\n\n'
                     + "This may be a temporary issue; try running the extension again."
                 )
+
+            # Store the raw images before they are cropped and converted
+            if self.cache is not None and len(actts) > 0:
+                for actt, acto in zip(actts, actos):
+                    elid = actt.els[0].get_id()
+                    if elid in cached_bbs or elid not in bbs:
+                        continue
+                    files = {"t.png": os.path.join(tempdir, actt.fname)}
+                    if ih.hasPIL:
+                        files["o.png"] = os.path.join(tempdir, acto.fname)
+                    if all(os.path.exists(f) for f in files.values()):
+                        self.cache.store(rkeys[actt.els[0]], files, {"bb": bbs[elid]})
             if do_stroketopaths:
                 cfile = tmpstp
 
@@ -959,7 +1187,12 @@ class Exporter():
     
     def check(self,func, *args, **kwargs):
         """Wraps a binary call with a check if thread has been stopped; if so, clear the temp file and exit"""
-        with sema1 if func==dh.wrapped_binary else sema2:
+        if self.pool is not None:
+            # The pool's size bounds the number of concurrent calls
+            sema = contextlib.nullcontext()
+        else:
+            sema = sema1 if func==dh.wrapped_binary else sema2
+        with sema:
             if hasattr(self, "aeThread") and self.aeThread.stopped is True:
                 self.clear_temp()
                 sys.exit()
@@ -969,103 +1202,272 @@ class Exporter():
                 sys.exit()
             return ret
 
-    def split_acts(self, fnm, acts, reserved=None, get_bbs=True):
-        """Split actions and run."""
-        if reserved is None:
-            reserved = set()
+    # Longest action list we can pass on the command line. Windows limits the
+    # whole command line; Linux limits each argument.
+    ARG_LIMIT = 32000 if sys.platform == "win32" else 131000
+    STP_CHECKPOINTS = 8
 
-        eargs = ["--actions", "".join([str(a) for a in acts])]
-        bbs = None
-        try:
-            bbs = self.check(dh.wrapped_binary,filename=fnm, inkscape_binary=self.bfn, extra_args=eargs, get_bbs = get_bbs, cwd=self.tempdir)
-            fnf_err = False
-        except FileNotFoundError:
-            fnf_err = True
-                
-                
-        missing_exports = []
-        missing_fns = []
-        found_fns = []
-        for i, act in enumerate(acts):
-            actfile = act.fname
-            if actfile is not None and not os.path.exists(joinmod(self.tempdir,actfile)):
-                missing_exports.append(act)
-                missing_fns.append(actfile)
-            if os.path.exists(joinmod(self.tempdir,actfile)):
-                found_fns.append(actfile)
-                
-        # dh.idebug('Found '+str(found_fns))
-        # dh.idebug('FNF: '+str(fnf_err))
-        # dh.idebug('Missing ' + str(missing_fns) +'\n')
-        
-        if fnf_err:
-            if len(acts)==1:
-                if missing_exports[0].type=='stp':
-                    bbs = self.split_stp(
-                        fnm, missing_exports, 0, reserved=reserved, get_bbs = get_bbs
+    def run_acts(self, fnm, acts):
+        """
+        Run binary Acts with as few Inkscape calls as possible and return the
+        bounding boxes.
+
+        Acts are packed into calls that fit the argument length limit (shell
+        workers have none). Stroke-to-path elements that crashed Inkscape on
+        a previous export of this file are skipped, and the rest are
+        converted in chunks that each write a checkpoint file, after an
+        initial checkpoint showing that the call opened the file. After a
+        crash the checkpoints show which chunk was responsible; one more call
+        converts that chunk an element at a time to find the culprit, which
+        is remembered and skipped once it has failed twice, while the rest
+        resume from the last good checkpoint. Failures that can't be pinned
+        on a chunk are raised.
+        """
+        Act = type(acts[0])
+        stpacts = [a for a in acts if a.type == "stp"]
+        others = [a for a in acts if a.type != "stp"]
+        filehash = self.get_filehash()
+        known = stp_crashes(filehash)
+        stpout = stpacts[0].fname if len(stpacts) > 0 else None
+        pend = [e for a in stpacts for e in a.els if e not in known]
+        suspects = set()
+        strikes = set()  # culprits that have failed once
+        cur = fnm
+        limit = None
+        if self.pool is None:
+            limit = self.ARG_LIMIT - len(self.bfn) - len(fnm) - 100
+        bbs = dict()
+        nck = [0]
+
+        def ckname():
+            nck[0] += 1
+            return self.tempbase + "_ck{0}.svg".format(nck[0])
+
+        while True:
+            # Chain of stroke-to-path chunks, with suspects in their own chunks
+            chunks = []
+            nsus = 0
+            while nsus < len(pend) and pend[nsus] in suspects:
+                chunks.append([pend[nsus]])
+                nsus += 1
+            rest = pend[nsus:]
+            if len(rest) > 0:
+                csz = math.ceil(len(rest) / self.STP_CHECKPOINTS)
+                chunks += [rest[i : i + csz] for i in range(0, len(rest), csz)]
+            subacts = [Act("stp", c, ckname()) for c in chunks]
+            if limit is not None:
+                # Halve any chunk too long to share a call with others
+                i = 0
+                while i < len(subacts):
+                    act = subacts[i]
+                    if len(act.els) > 1 and len(str(act)) > limit // 2:
+                        spl = math.ceil(len(act.els) / 2)
+                        subacts[i : i + 1] = [
+                            Act("stp", act.els[:spl], ckname()),
+                            Act("stp", act.els[spl:], ckname()),
+                        ]
+                    else:
+                        i += 1
+            if len(subacts) > 0:
+                subacts[-1].fname = stpout
+            elif stpout is not None:
+                # Everything left crashes STP, so the output is the input
+                shutil.copy(joinmod(self.tempdir, cur), joinmod(self.tempdir, stpout))
+
+            # Pack into as few calls as the argument limit allows
+            calls, batch, blen = [], [], 0
+            for act in subacts + others:
+                alen = len(str(act))
+                if len(batch) > 0 and limit is not None and blen + alen > limit:
+                    calls.append(batch)
+                    batch, blen = [], 0
+                batch.append(act)
+                blen += alen
+            if len(batch) > 0:
+                calls.append(batch)
+            if len(calls) == 0:
+                # Nothing to run (e.g. every STP element is a known crash),
+                # but still query the bounding boxes
+                calls.append([])
+            for batch in calls:
+                stpis = [i for i, a in enumerate(batch) if a.type == "stp"]
+                if len(stpis) > 0:
+                    batch.insert(stpis[0], Act("ck", [], ckname()))
+
+            crashed = None
+            retry = False
+            infile = cur
+            for batch in calls:
+                eargs = ["--actions", "".join([str(a) for a in batch])] if batch else []
+                err = None
+                try:
+                    ret = self.check(
+                        dh.wrapped_binary,
+                        filename=infile,
+                        inkscape_binary=self.bfn,
+                        extra_args=eargs,
+                        get_bbs=True,
+                        cwd=self.tempdir,
+                        pool=self.pool,
                     )
-                else:
-                    # Already simplified call as much as we can...
-                    raise Exception('FileNotFoundError and cannot split:\n'+str(acts))
-            elif len(missing_exports)>0:
-                acts1 = missing_exports[: math.ceil(len(missing_exports) / 2)]
-                acts2 = missing_exports[math.ceil(len(missing_exports) / 2) :]
-                bbs = self.split_acts(
-                    fnm=fnm, acts=acts1, reserved=reserved, get_bbs = get_bbs
-                )
-                if len(acts2)>0:
-                    self.split_acts(
-                        fnm=fnm, acts=acts2, reserved=reserved, get_bbs = False
+                    bbs = ret if ret is not None else bbs
+                except FileNotFoundError as excp:
+                    # Argument list still too long (Windows)
+                    if limit is not None and limit > 1000:
+                        limit //= 2
+                        retry = True
+                        break
+                    err = excp
+                except (subprocess.CalledProcessError, inkscape_shell.ShellCrash) as excp:
+                    err = excp
+                bstps = [a for a in batch if a.type == "stp"]
+                missing = [
+                    a
+                    for a in batch
+                    if a.type in ["ck", "stp"]
+                    and not os.path.exists(joinmod(self.tempdir, a.fname))
+                ]
+                if len(missing) > 0 and missing[0].type == "stp":
+                    # The previous checkpoint was written, so this chunk crashed
+                    crashed = missing[0]
+                    break
+                if err is not None:
+                    raise err
+                if len(missing) > 0:
+                    raise inkscape_shell.ShellCrash(
+                        "Inkscape did not export " + missing[0].fname
                     )
-        elif any(act.type=='stp' for act in missing_exports):
-            stp_idx = [i for i, act in enumerate(missing_exports) if act.type=='stp'][0]
-            bbs = self.split_stp(
-                fnm, missing_exports, stp_idx, reserved=reserved, get_bbs = get_bbs
-            )
-        return bbs
-    
-    
-    def split_stp(self,fnm, acts, selii, reserved, get_bbs=True, cwd=None):
+                if len(bstps) > 0:
+                    infile = bstps[-1].fname
+            if retry:
+                continue
+            if crashed is None:
+                return bbs
+
+            k = subacts.index(crashed)
+            if k > 0:
+                cur = subacts[k - 1].fname
+            if len(crashed.els) == 1 and crashed.els[0] in strikes:
+                # Found the culprit: skip it now and in future exports
+                add_stp_crash(filehash, crashed.els[0])
+                pend = [e for a in subacts[k + 1 :] for e in a.els]
+            elif len(crashed.els) == 1:
+                # Confirm with a second failure before remembering it
+                strikes.add(crashed.els[0])
+                suspects = set(crashed.els)
+                pend = [e for a in subacts[k:] for e in a.els]
+            else:
+                suspects = set(crashed.els)
+                pend = [e for a in subacts[k:] for e in a.els]
+
+    def get_filehash(self):
+        """Hash of the file being exported"""
+        if not hasattr(self, "filehash"):
+            self.filehash = hash_file(self.filein)
+        return self.filehash
+
+    def export_vectors(self, fin, formats):
         """
-        Windows cannot handle arguments that are too long.
-        If needed, this can split a stroke-to-path operation into two.
+        Export all vector formats in a single pass. The preprocessed SVG is
+        parsed once and forked for each thin-line mode, and single-page
+        outputs made from the same fork are exported by one binary call
+        with a chain of export actions. Plain SVGs and multi-page documents
+        need per-page handling and go through export_file.
         """
-        act = acts[selii]
-        actfn = act.fname
-
-        reserved.update({fnm, actfn})
-        isreserved = True
-        cnt = 0
-        while isreserved:
-            actfna = actfn.strip(".svg") + str(cnt) + ".svg"
-            isreserved = actfna in reserved
-            cnt += 1
-        reserved.update({actfna})
-
-        if len(act.els) == 1:
-            # cannot split, fact that we failed means there is a STP crash
-            shutil.copy(fnm, actfn)
-            return self.split_acts(
-                fnm=fnm,
-                acts=acts[:selii] + acts[selii + 1 :],
-                reserved=reserved
-            )
-        act1, act2 = act.split(actfna)
-        acts1 = acts[:selii] + [act1] if len(act1.els) > 0 else acts[:selii]
-        acts2 = (
-            [act2] + acts[selii + 1 :] if len(act2.els) > 0 else acts[selii + 1 :]
+        modes = {
+            fmt: "bezier" if fmt in ["pdf", "eps"] else "split" for fmt in formats
+        }
+        svg = get_svg(fin)
+        multipage = inkex.installed_haspages and len(svg.cdocsize.pgs) > 1
+        variants = {mode: fin for mode in modes.values()}
+        if self.thinline:
+            needed = unique(modes.values())
+            for i, mode in enumerate(needed):
+                # Fork the tree for all but the last mode
+                vsvg = svg if i == len(needed) - 1 else copy.deepcopy(svg)
+                Exporter.thinline_dehancement(vsvg, mode)
+                tmp = self.tempbase + "_tld" + mode[0] + ".svg"
+                dh.overwrite_svg(vsvg, tmp)
+                variants[mode] = tmp
+
+        batchable = (
+            inkscape_shell.shell_supported(inkex.installed_ivp)
+            and not multipage
+            and not self.testmode
         )
+        newfiles = []
+        batches = dict()
+        for fmt in formats:
+            if batchable and fmt != "psvg":
+                batches.setdefault(variants[modes[fmt]], []).append(fmt)
+            else:
+                finished, myo = self.export_file(
+                    variants[modes[fmt]], fmt, dehanced=True
+                )
+                if finished:
+                    self.store_cached(fmt)
+                newfiles.append(myo)
 
-        bbs = self.split_acts(
-            fnm=fnm, acts=acts1, reserved=reserved, get_bbs=get_bbs
-        )
-        bbs = self.split_acts(
-            fnm=actfna, acts=acts2, reserved=reserved, get_bbs=get_bbs
-        )
-        return bbs
+        for cfile, fmts in batches.items():
+            timestart = time.time()
+            self.print_status("Converting to " + ", ".join(fmts), flush=True)
+            acts = "export-background:#ffffff; export-background-opacity:1.0; "
+            acts += "export-dpi:{0}; ".format(int(self.dpi))
+            outputs = dict()
+            for fmt in fmts:
+                myoutput = self.outtemplate[0:-4] + "." + fmt
+                outputs[fmt] = myoutput
+                if os.path.exists(myoutput):
+                    os.remove(myoutput)
+                latex = fmt == "pdf" and self.latexpdf
+                if latex and os.path.exists(myoutput + "_tex"):
+                    os.remove(myoutput + "_tex")
+                acts += "export-filename:{0}; export-latex:{1}; export-do; ".format(
+                    os.path.abspath(myoutput).replace("\\", "/"),
+                    "true" if latex else "false",
+                )
+            if self.pool is not None:
+                self.check(dh.shell_repeat, self.pool, cfile, acts, query_all=False)
+            else:
+                self.check(dh.subprocess_repeat, [self.bfn, "--actions", acts, cfile])
+
+            toc = time.time() - timestart
+            for fmt, myoutput in outputs.items():
+                if not os.path.exists(myoutput):
+                    # Export this format on its own, which reports failures
+                    self.print_status(
+                        "Batched conversion to {0} failed, converting alone".format(fmt)
+                    )
+                    finished, myo = self.export_file(cfile, fmt, dehanced=True)
+                    if finished:
+                        self.store_cached(fmt)
+                    newfiles.append(myo)
+                    continue
+                self.final_outputs = [myoutput]
+                self.remove_stale_outputs(myoutput, self.final_outputs)
+                self.store_cached(fmt)
+                newfiles.append(myoutput)
+                self.print_status(
+                    "Conversion to {0} done ({1} s)".format(fmt, round(1000 * toc) / 1000)
+                )
+        return newfiles
 
-    def export_file(self, fin, fformat):
-        """Use the Inkscape binary to export the file"""
+    def print_status(self, msg, **kwargs):
+        """Print a message prefixed by the file name, if printing is on"""
+        if self.prints:
+            fname = os.path.split(self.filein)[1]
+            try:
+                offset = round(os.get_terminal_size().columns / 2)
+            except OSError:
+                offset = 40
+            fname = fname + " " * max(0, offset - len(fname))
+            self.prints(fname + ": " + msg, **kwargs)
+
+    def export_file(self, fin, fformat, dehanced=False):
+        """
+        Use the Inkscape binary to export the file. If dehanced is True, thin
+        line dehancement has already been applied to fin.
+        """
         myoutput = self.outtemplate[0:-4] + "." + fformat
         if self.prints:
             fname = os.path.split(self.filein)[1]
@@ -1081,7 +1483,7 @@ class Exporter():
         notpng = not (fformat == "png")
 
         cfile = fin
-        if self.thinline and notpng:
+        if self.thinline and notpng and not dehanced:
             svg = get_svg(cfile)
             if fformat in ["pdf", "eps"]:
                 Exporter.thinline_dehancement(svg, "bezier")
@@ -1121,7 +1523,16 @@ class Exporter():
                     + ["--export-plain-svg"]
                     + args[5:]
                 )
-            self.check(dh.subprocess_repeat,args)
+            if self.pool is not None:
+                self.check(
+                    dh.shell_repeat,
+                    self.pool,
+                    filein,
+                    Exporter.args_to_actions(args[1:-1]),
+                    query_all=False,
+                )
+            else:
+                self.check(dh.subprocess_repeat,args)
 
         def make_output(filein, fileout):
             if fileout.endswith(".svg"):
@@ -1234,7 +1645,24 @@ class Exporter():
                 dh.overwrite_svg(svg, finalname)
                 finalnames.append(finalname)
 
-        # Remove any previous outputs that we did not just make
+        self.final_outputs = finalnames
+        self.remove_stale_outputs(myoutput, finalnames)
+
+        if self.prints:
+            toc = time.time() - timestart
+            self.prints(
+                fname
+                + ": Conversion to "
+                + fformat
+                + " done ("
+                + str(round(1000 * toc) / 1000)
+                + " s)"
+            )
+        return True, myoutput
+
+    @staticmethod
+    def remove_stale_outputs(myoutput, finalnames):
+        """Remove any previous outputs that we did not just make"""
         directory, file_name = os.path.split(myoutput)
         base_name, extension = os.path.splitext(file_name)
         if extension == ".svg" and base_name.endswith("_plain"):
@@ -1257,18 +1685,6 @@ class Exporter():
                 except PermissionError:
                     pass
 
-        if self.prints:
-            toc = time.time() - timestart
-            self.prints(
-                fname
-                + ": Conversion to "
-                + fformat
-                + " done ("
-                + str(round(1000 * toc) / 1000)
-                + " s)"
-            )
-        return True, myoutput
-
     def postprocessing(self, svg):
         """Postprocessing of SVGs, mainly for overcoming bugs in Office products"""
         vds = dh.visible_descendants(svg)
@@ -1369,6 +1785,29 @@ class Exporter():
         tel.set("style", "display:none")
         dh.clean_up_document(svg)  # Clean up
 
+    @staticmethod
+    def args_to_actions(args):
+        """
+        Convert export command-line arguments into the equivalent action list,
+        for use with a shell worker
+        """
+        acts = []
+        i = 0
+        while i < len(args):
+            opt = args[i][2:]
+            if opt in ("vacuum-defs",):
+                acts.append(opt)
+            elif opt in ("export-plain-svg", "export-latex"):
+                acts.append(opt + ":true")
+            else:
+                val = args[i + 1]
+                if opt == "export-filename":
+                    val = os.path.abspath(val).replace("\\", "/")
+                acts.append(opt + ":" + str(val))
+                i += 1
+            i += 1
+        return "; ".join(acts + ["export-do"]) + "; "
+
     PTH_COMMANDS = list("MLHVCSQTAZmlhvcsqtaz")
 
     @staticmethod
@@ -1493,7 +1932,7 @@ class Exporter():
         for dsd in elem.descendants2():
             bsh = dsd.ccascaded_style.get("baseline-shift")
             if bsh in ["super", "sub"]:
-                sty = dsd.ccascaded_style
+                sty = dsd.ccascaded_style.copy()
                 sty["baseline-shift"] = "40%" if bsh == "super" else "-20%"
                 dsd.cstyle = sty
 
@@ -1518,7 +1957,7 @@ class Exporter():
                             == "0%"
                         ):
                             sel = list(dsd2)[0]
-                            mys = sel.ccascaded_style
+                            mys = sel.ccascaded_style.copy()
                             if mys.get("baseline-shift") == "0%":
                                 mys["baseline-shift"] = dsd2.ccascaded_style.get(
                                     "baseline-shift"
@@ -1829,7 +2268,7 @@ class Exporter():
             if isinstance(elem, inkex.Group) and len(mkrs) > 0:
                 dh.ungroup(elem)
             elif elem.tag in otp_support_tags:
-                sty = elem.cspecified_style
+                sty = elem.cspecified_style.copy()
                 if "stroke" in sty and sty["stroke"] != "none":
                     stroked_els.append((elem, sty, mkrs))
 
@@ -1896,7 +2335,7 @@ class Exporter():
 
                 # Fix bug on start markers where auto-start-reverse
                 # oriented markers are inverted by STP
-                sty = elem.cspecified_style
+                sty = elem.cspecified_style.copy()
                 mstrt = sty.get_link("marker-start", svg)
                 if mstrt is not None:
                     if mstrt.get("orient") == "auto-start-reverse":
@@ -1945,5 +2384,73 @@ def hash_file(filename):
     return hashv.hexdigest()
 
 
+STP_CRASH_FILE = "si_ae_stp_crashes.json"
+MAX_CRASH_RECORDS = 500
+crash_lock = threading.Lock()
+
+
+def stp_crashes(filehash):
+    """IDs of elements in a file that previously crashed stroke-to-path"""
+    fname = os.path.join(os.path.dirname(dh.shared_temp()), STP_CRASH_FILE)
+    try:
+        with open(fname, "r", encoding="utf-8") as file:
+            return set(json.load(file).get(filehash, []))
+    except (OSError, ValueError, AttributeError):
+        return set()
+
+
+def add_stp_crash(filehash, elid):
+    """Remember that an element crashes stroke-to-path"""
+    fname = os.path.join(os.path.dirname(dh.shared_temp()), STP_CRASH_FILE)
+    with crash_lock:
+        try:
+            with open(fname, "r", encoding="utf-8") as file:
+                records = json.load(file)
+        except (OSError, ValueError):
+            records = dict()
+        if not isinstance(records, dict):
+            records = dict()
+        # Re-insert so the most recently updated files are kept
+        els = records.pop(filehash, [])
+        records[filehash] = unique(els + [elid])
+        while len(records) > MAX_CRASH_RECORDS:
+            records.pop(next(iter(records)))
+        tmp = fname + ".{0}.tmp".format(os.getpid())
+        try:
+            with open(tmp, "w", encoding="utf-8") as file:
+                json.dump(records, file)
+            os.replace(tmp, fname)
+        except OSError:
+            pass
+
+
+REF_RE = re.compile(rb"""(?:url\(\s*["']?|href=")#([^)"'\s]+)""")
+
+
+def render_signature(elem):
+    """
+    Hash of everything that determines how an element renders: its subtree,
+    its composed transform, its ancestors' attributes (inherited styles,
+    clips and masks), and any definitions these reference.
+    """
+    svg = elem.croot
+    parts = [str(elem.ccomposed_transform).encode("utf-8")]
+    for anc in elem.ancestors2():
+        attrs = repr((anc.tag, sorted(anc.attrib.items())))
+        parts.append(attrs.encode("utf-8"))
+    parts.append(lxml.etree.tostring(elem, with_tail=False))
+    seen = set()
+    i = 0
+    while i < len(parts):
+        for rid in REF_RE.findall(parts[i]):
+            if rid not in seen:
+                seen.add(rid)
+                ref = svg.getElementById(rid.decode("utf-8"))
+                if ref is not None:
+                    parts.append(lxml.etree.tostring(ref, with_tail=False))
+        i += 1
+    return hashlib.sha256(b"\0".join(parts)).hexdigest()
+
+
 if __name__ == "__main__":
     dh.Run_SI_Extension(AutoExporter(), "Autoexporter")
\ No newline at end of file
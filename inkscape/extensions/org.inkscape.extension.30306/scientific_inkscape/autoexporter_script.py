@@ -5,6 +5,9 @@
 DEBUG = False
 WHILESLEEP = 0.5
 MAXTHREADS = 1000
+USE_PROCESSES = True  # run "Export all" in a process pool
+MAXPROCESSES = 8  # most worker processes the pool may use
+MAXSUBMITTED = 2  # submitted exports per worker process, queued ones wait
 
 import sys, platform, os, threading, time, copy, pickle
 
@@ -13,12 +16,15 @@ import tempfile
 systmpdir = os.path.abspath(tempfile.gettempdir())
 aes = os.path.join(systmpdir, "si_ae_settings.p")
 
-with open(aes, "rb") as f:
-    input_options = pickle.load(f)
-os.remove(aes)
-bfn = input_options.inkscape_bfn
-sys.path += input_options.syspath
-guitype = input_options.guitype
+# Process-pool workers started by spawning re-run this script as __mp_main__,
+# so only the main process reads the settings and runs the UI
+if __name__ == "__main__":
+    with open(aes, "rb") as f:
+        input_options = pickle.load(f)
+    os.remove(aes)
+    bfn = input_options.inkscape_bfn
+    sys.path += input_options.syspath
+    guitype = input_options.guitype
 
 import dhelpers as dh  # noqa
 import inkex
@@ -208,13 +214,42 @@ class FileCheckerThread(threading.Thread):
         self.thread_queue = []
         self.running_threads = []
         self.finished_threads = []
-
-    def queue_thread(self, f):
+        # Persistent Inkscape workers shared by all export threads
+        self.pool = autoexporter.make_pool(bfn)
+        # Worker processes for Export all, made when first needed
+        self.executor = None
+        self.manager = None
+        self.msgq = None
+        self.maxsubmitted = 0
+
+    def queue_thread(self, f, inprocess=False):
         for t in self.thread_queue + self.running_threads:
             if t.file == f:
                 t.stopped = True
-        fthr = AutoExporterThread()
+        if inprocess:
+            if self.executor is None:
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Spawn rather than fork, since forking from here would copy
+                # the GTK state, live threads, and the shell pool's pipes
+                ctx = multiprocessing.get_context("spawn")
+                self.manager = ctx.Manager()
+                nworkers = min(MAXPROCESSES, os.cpu_count() or 1)
+                self.executor = ProcessPoolExecutor(
+                    max_workers=nworkers, mp_context=ctx
+                )
+                self.maxsubmitted = MAXSUBMITTED * nworkers
+                # All workers share one message queue, drained by one thread
+                self.msgq = self.manager.Queue()
+                threading.Thread(
+                    target=relay_messages, args=(self.msgq,), daemon=True
+                ).start()
+            fthr = ProcessExport(self.executor, self.manager, self.msgq)
+        else:
+            fthr = AutoExporterThread()
         fthr.file = f
+        fthr.pool = self.pool
         fthr.outtemplate = autoexporter.joinmod(self.writedir, os.path.split(f)[1])
         self.thread_queue.append(fthr)
 
@@ -242,8 +277,10 @@ class FileCheckerThread(threading.Thread):
             if self.watcher.directory_to_watch != self.watchdir:
                 self.start_watcher()
 
+            inprocess = False
             if self.ea:  # export all
                 self.ea = False
+                inprocess = USE_PROCESSES
                 updatefiles = get_files(self.watchdir)
                 if updatefiles is None:
                     mprint("Cannot access watch directory.")
@@ -257,13 +294,19 @@ class FileCheckerThread(threading.Thread):
             loopme = True
             while loopme:
                 for f in sorted(updatefiles):
-                    self.queue_thread(f)
+                    self.queue_thread(f, inprocess=inprocess)
 
                 while (
                     len(self.thread_queue) > 0
                     and len(self.running_threads) < MAXTHREADS
                     and not self.stopped
                 ):
+                    if isinstance(self.thread_queue[0], ProcessExport):
+                        nsub = sum(
+                            isinstance(t, ProcessExport) for t in self.running_threads
+                        )
+                        if nsub >= self.maxsubmitted:
+                            break
                     self.thread_queue[0].start()
                     self.running_threads.append(self.thread_queue[0])
                     self.thread_queue.remove(self.thread_queue[0])
@@ -293,6 +336,12 @@ class FileCheckerThread(threading.Thread):
         for thr in reversed(self.running_threads):
             self.running_threads.remove(thr)
             self.finished_threads.append(thr)
+        if self.pool is not None:
+            self.pool.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.msgq.put(None)
+            self.manager.shutdown()
 
 class PromptThread(threading.Thread):
     def __init__(self):
@@ -309,6 +358,7 @@ class AutoExporterThread(threading.Thread):
         self.file = None
         self.outtemplate = None
         self.stopped = False
+        self.pool = None
 
     def run(self):
         fname = os.path.split(self.file)[1]
@@ -318,10 +368,23 @@ class AutoExporterThread(threading.Thread):
             offset = 40
         fname = fname + " " * max(0, offset - len(fname))
         mprint(fname + ": Beginning export")
-        opts = copy.copy(input_options)
-        opts.debug = DEBUG
+        opts = self.make_options()
         opts.prints = mprint
         opts.aeThread = self
+        opts.pool = self.pool
+        try:
+            Exporter(self.file, opts).export_all()
+        except SystemExit:
+            pass
+        except:
+            import traceback
+            error_message = f"Exception in {fname}\n"
+            error_message += traceback.format_exc()
+            mprint(error_message)
+
+    def make_options(self):
+        opts = copy.copy(input_options)
+        opts.debug = DEBUG
         opts.original_file = self.file
         opts.formats = [
             fmt
@@ -333,17 +396,85 @@ class AutoExporterThread(threading.Thread):
         ]
         opts.outtemplate = self.outtemplate
         opts.bfn = bfn
+        return opts
+
+
+def relay_messages(msgq):
+    """Print the messages of export worker processes until None arrives"""
+    while True:
         try:
-            Exporter(self.file, opts).export_all()
-        except SystemExit:
-            pass
+            msg = msgq.get()
+        except (EOFError, OSError):
+            return  # manager shut down
+        if msg is None:
+            return
+        mprint(msg)
+
+
+class ProcessExport:
+    """
+    Exports a file in a worker process, so that the pure-Python pre- and
+    postprocessing of many files can run on multiple cores. It stands in for
+    an AutoExporterThread in the FileCheckerThread's lists, but submits to
+    the process pool instead of running a thread. Setting stopped forwards a
+    stop request to the worker.
+    """
+
+    make_options = AutoExporterThread.make_options
+
+    def __init__(self, executor, manager, msgq):
+        self.file = None
+        self.outtemplate = None
+        self.pool = None
+        self.executor = executor
+        self.stopevent = manager.Event()
+        self.msgq = msgq
+        self.fut = None
+        self._stopped = False
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    @stopped.setter
+    def stopped(self, value):
+        self._stopped = value
+        if value and (self.fut is None or not self.fut.cancel()):
+            self.stopevent.set()
+
+    def start(self):
+        fname = os.path.split(self.file)[1]
+        try:
+            offset = round(os.get_terminal_size().columns / 2)
         except:
-            import traceback
-            error_message = f"Exception in {fname}\n"
-            error_message += traceback.format_exc()
-            mprint(error_message)
+            offset = 40
+        fname = fname + " " * max(0, offset - len(fname))
+        mprint(fname + ": Beginning export")
+        self.fut = self.executor.submit(
+            autoexporter.export_in_process,
+            self.file,
+            self.make_options(),
+            self.stopevent,
+            self.msgq,
+        )
+
+        def report(fut):
+            if not fut.cancelled() and fut.exception() is not None:
+                import traceback
+                error_message = f"Exception in {fname}\n"
+                error_message += "".join(
+                    traceback.format_exception(
+                        type(fut.exception()), fut.exception(), None
+                    )
+                )
+                mprint(error_message)
+
+        self.fut.add_done_callback(report)
+
+    def is_alive(self):
+        return self.fut is not None and not self.fut.done()
 
-if guitype == "gtk":
+if __name__ == "__main__" and guitype == "gtk":
     import warnings
 
     with warnings.catch_warnings():
@@ -755,7 +886,7 @@ if guitype == "gtk":
     win.show_all()
     win.set_keep_above(False)
     Gtk.main()
-else:
+elif __name__ == "__main__":
     try:
         import tkinter
 
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2023 David Burghoff <burghoff@utexas.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Benchmark merge candidate generation in Remove Kerning
+
+Builds synthetic grids of tick labels like those in PDF figures: numbers
+written as separate text elements per digit group, scientific-notation
+labels whose exponents are superscripts, and rotated y-axis labels. Each
+label is a few chunks that External_Merges should join, densely packed
+next to their neighbors. Usage:
+
+    python benchmark_merges.py [number of labels ...]
+"""
+
+import io
+import sys
+import time
+import random
+
+import dhelpers as dh  # noqa
+import inkex
+import inkex.text.parser as tp
+import remove_kerning as rk
+
+STY = "font-size:{0}px;font-family:sans-serif"
+# Approximate advances (in em) of DejaVu Sans, the usual sans-serif
+ADVANCES = {"-": 0.421, ".": 0.318}
+DIGIT = 0.636
+
+
+def tick_grid(nlabels, seed=1):
+    """SVG of a grid of about nlabels tick labels."""
+    rnd = random.Random(seed)
+    ncols = max(1, int(nlabels**0.5))
+    parts = []
+    for i in range(nlabels):
+        x = 40 * (i % ncols)
+        y = 12 * (i // ncols)
+        kind = i % 3
+        if kind == 0:
+            # Number split after the decimal point
+            val = "{0:.2f}".format(rnd.uniform(-10, 10))
+            ipart, fpart = val.split(".")
+            parts.append(
+                '<text x="{0}" y="{1}" style="{2}">{3}.</text>'.format(
+                    x, y, STY.format(8), ipart
+                )
+            )
+            parts.append(
+                '<text x="{0}" y="{1}" style="{2}">{3}</text>'.format(
+                    x + 8 * sum(ADVANCES.get(c, DIGIT) for c in ipart + "."),
+                    y,
+                    STY.format(8),
+                    fpart,
+                )
+            )
+        elif kind == 1:
+            # Power of ten with a superscript exponent
+            parts.append(
+                '<text x="{0}" y="{1}" style="{2}">10</text>'.format(
+                    x, y, STY.format(8)
+                )
+            )
+            parts.append(
+                '<text x="{0}" y="{1}" style="{2}">{3}</text>'.format(
+                    x + 9.4, y - 3.5, STY.format(5), rnd.randint(-9, 9)
+                )
+            )
+        else:
+            # Rotated axis label made of words
+            parts.append(
+                '<text transform="rotate(-90 {0} {1})" x="{0}" y="{1}" '
+                'style="{2}">Time</text>'.format(x, y, STY.format(8))
+            )
+            parts.append(
+                '<text transform="rotate(-90 {0} {1})" x="{2}" y="{1}" '
+                'style="{3}">(s)</text>'.format(x, y, x + 23.5, STY.format(8))
+            )
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" width="1000" height="1000">'
+        + "".join(parts)
+        + "</svg>"
+    )
+
+
+def run_benchmark(nlabels):
+    """Time candidate generation and External_Merges for one grid size."""
+    svg = inkex.load_svg(io.BytesIO(tick_grid(nlabels).encode("utf-8"))).getroot()
+    els = [el for el in svg.iter() if isinstance(el, inkex.TextElement)]
+    tic = time.perf_counter()
+    ptl = tp.ParsedTextList(els)
+    ptl.precalcs()
+    ptl.make_next_chain()
+    tparse = time.perf_counter() - tic
+
+    chks = [w for el in els for line in el.parsed_text.lns for w in line.chks]
+    tic = time.perf_counter()
+    pairs = rk.merge_candidates(chks)
+    tcand = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    plausible, _ = rk.plausible_merges(chks, pairs, True, True)
+    tplaus = time.perf_counter() - tic
+
+    tic = time.perf_counter()
+    rk.External_Merges(els, True, True)
+    tmerge = time.perf_counter() - tic
+    nmatched = sum(len(w.mw) > 0 for w in chks)
+
+    print(
+        "{0:>7} {1:>7} {2:>9} {3:>9} {4:>7} {5:>8.2f} {6:>8.3f} {7:>8.3f} {8:>8.3f}".format(
+            nlabels,
+            len(chks),
+            len(pairs),
+            int(plausible.sum()),
+            nmatched,
+            tparse,
+            tcand,
+            tplaus,
+            tmerge,
+        )
+    )
+
+
+def main(sizes):
+    """Benchmark External_Merges on tick grids of each size."""
+    print(
+        "{0:>7} {1:>7} {2:>9} {3:>9} {4:>7} {5:>8} {6:>8} {7:>8} {8:>8}".format(
+            "labels",
+            "chunks",
+            "cands",
+            "plausible",
+            "matched",
+            "parse s",
+            "cands s",
+            "filter s",
+            "merges s",
+        )
+    )
+    for nlabels in sizes:
+        run_benchmark(nlabels)
+
+
+if __name__ == "__main__":
+    main([int(v) for v in sys.argv[1:]] or [1000, 4000, 15000])
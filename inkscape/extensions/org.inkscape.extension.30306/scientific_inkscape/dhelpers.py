@@ -69,13 +69,14 @@ from inkex.text.utils import (
     subprocess_repeat,
     tags,
     bbox,
+    BBoxArray,
     ipx,
 )
 
 
 from inkex import Tspan, Transform, Path, PathElement, BaseElement
 from applytransform_mod import fuseTransform
-import lxml, math, re, os, random, sys
+import lxml, math, re, os, random, sys, hashlib
 from functools import lru_cache
 
 # Parsed Inkex version, with extension back to v0.92.4
@@ -488,41 +489,188 @@ def merge_clipmask(node, newclip, mask=False):
         return cout
 
 
+class Fenwick:
+    """Fenwick (binary indexed) tree of counts, for prefix sums in O(log n)"""
+
+    def __init__(self, counts):
+        self.n = len(counts)
+        self.tree = [0] + list(counts)
+        for i in range(1, self.n + 1):
+            j = i + (i & -i)
+            if j <= self.n:
+                self.tree[j] += self.tree[i]
+        self.top = 1 << self.n.bit_length() if self.n > 0 else 0
+
+    def add(self, i, delta):
+        """Add delta to count i"""
+        i += 1
+        while i <= self.n:
+            self.tree[i] += delta
+            i += i & -i
+
+    def prefix(self, i):
+        """Sum of counts before i"""
+        ret = 0
+        while i > 0:
+            ret += self.tree[i]
+            i -= i & -i
+        return ret
+
+    def kth(self, k):
+        """Index of the kth (from 0) unit of count, or n if there are fewer"""
+        pos = 0
+        step = self.top
+        while step > 0:
+            nxt = pos + step
+            if nxt <= self.n and self.tree[nxt] <= k:
+                pos = nxt
+                k -= self.tree[nxt]
+            step >>= 1
+        return pos
+
+
 # A cached list of all descendants of an svg in order
-# Currently only handles deletions appropriately
+# Elements are kept in an array of slots in document order, with empty slots
+# (from deletions and spare room) between them. Insertions go into empty slots
+# next to their predecessor, and when a region is too full it is spread out
+# over a larger one (a packed-memory array). A Fenwick tree of which slots
+# are filled gives positions and the next element after a slot in O(log n).
 class dtree:
+    MAX_DENSITY = 0.75  # density a region is spread out to
+    comment_tag = lxml.etree.Comment("").tag
+
     def __init__(self, svg):
-        ds, pts = svg.descendants2(True)
-        self.ds = ds
-        self.iids = {d: ii for ii, d in enumerate(ds)}  # desc. index by el
-        iipts = {
-            ptv: (ii, jj) for ii, pt in enumerate(pts) for jj, ptv in enumerate(pt)
-        }
-        self.range = [(ii, iipts[d][0]) for ii, d in enumerate(ds)]
+        self.svg = svg
+        self.relayout(svg.descendants2())
+
+    def relayout(self, ds, cap=None):
+        """Lay out elements over a new array with even spacing"""
+        cap = max(cap or 0, int(len(ds) / dtree.MAX_DENSITY) + 1)
+        self.slots = [None] * cap
+        self.pos = dict()
+        self.place(ds, 0, cap)
+        self.fw = Fenwick([s is not None for s in self.slots])
+
+    def place(self, ds, strt, stop):
+        """Spread elements evenly over empty slots strt to stop"""
+        n = len(ds)
+        for ii, d in enumerate(ds):
+            si = strt + (ii * (stop - strt)) // max(n, 1)
+            self.slots[si] = d
+            self.pos[d] = si
+
+    @property
+    def ds(self):
+        return [d for d in self.slots if d is not None]
+
+    def __len__(self):
+        return len(self.pos)
+
+    def __contains__(self, el):
+        return el in self.pos
+
+    def index(self, el):
+        """Position of an element in document order"""
+        return self.fw.prefix(self.pos[el])
+
+    def next_slot(self, si):
+        """Slot of the first element after slot si"""
+        return self.fw.kth(self.fw.prefix(si + 1))
+
+    def last_descendant(self, el):
+        """Last element of el's subtree in document order"""
+        while True:
+            kid = el[-1] if len(el) > 0 else None
+            while kid is not None and kid.tag == dtree.comment_tag:
+                kid = kid.getprevious()
+            if kid is None:
+                return el
+            el = kid
+
+    def preceding(self, el):
+        """The element before el in document order"""
+        prev = el.getprevious()
+        while prev is not None and prev.tag == dtree.comment_tag:
+            prev = prev.getprevious()
+        if prev is None:
+            return el.getparent()
+        return self.last_descendant(prev)
 
     def iterel(self, el):
+        """el and its descendants, in order"""
         try:
-            eli = self.iids[el]
-            for ii in range(self.range[eli][0], self.range[eli][1]):
-                yield self.ds[ii]
-        except:
-            pass
+            strt = self.pos[el]
+            stop = self.pos[self.last_descendant(el)] + 1
+        except KeyError:
+            return
+        si = strt
+        while si < stop:
+            yield self.slots[si]
+            si = self.next_slot(si)
 
     def delel(self, el):
-        try:
-            eli = self.iids[el]
-            strt = self.range[eli][0]
-            stop = self.range[eli][1]
-            self.ds = self.ds[:strt] + self.ds[stop:]
-            self.range = self.range[:strt] + self.range[stop:]
-            N = stop - strt
-            self.range = [
-                (x - N if x > strt else x, y - N if y > strt else y)
-                for x, y in self.range
-            ]
-            self.iids = {d: ii for ii, d in enumerate(self.ds)}  # desc. index by el
-        except:
-            pass
+        """Remove el and its descendants"""
+        for d in el.descendants2():
+            si = self.pos.pop(d, None)
+            if si is not None:
+                self.slots[si] = None
+                self.fw.add(si, -1)
+        if len(self.pos) < len(self.slots) * dtree.MAX_DENSITY / 8:
+            self.relayout(self.ds)  # mostly empty, so compact
+
+    def addel(self, el):
+        """
+        Add el and its descendants at their place in the document. Ignored if
+        the element before them is not in the tree (for example, when they
+        are being added as part of a larger subtree that will be added next).
+        """
+        prev = self.preceding(el)
+        placeable = prev is not None and prev in self.pos
+        if el in self.pos or placeable:
+            self.delel(el)
+        if not placeable:
+            return
+        ds = el.descendants2()
+        si = self.pos[prev]
+        nsi = self.next_slot(si)
+        if nsi - si - 1 >= len(ds):
+            # Room right after the preceding element
+            self.place(ds, si + 1, si + 1 + len(ds))
+            for d in ds:
+                self.fw.add(self.pos[d], 1)
+            return
+
+        # Find the smallest aligned region around si that is sparse enough,
+        # then spread its elements and the new ones over it
+        cap = len(self.slots)
+        size = 1
+        while True:
+            size *= 2
+            strt = (si // size) * size
+            stop = min(strt + size, cap)
+            cnt = self.fw.prefix(stop) - self.fw.prefix(strt)
+            if cnt + len(ds) <= (stop - strt) * dtree.MAX_DENSITY:
+                break
+            if strt == 0 and stop == cap:
+                self.relayout(self.ds_with(ds, prev), 2 * cap)
+                return
+        old = self.slots[strt:stop]
+        olds = [d for d in old if d is not None]
+        ii = olds.index(prev) + 1
+        newds = olds[:ii] + ds + olds[ii:]
+        for jj, d in enumerate(old):
+            if d is not None:
+                self.slots[strt + jj] = None
+                self.fw.add(strt + jj, -1)
+        self.place(newds, strt, stop)
+        for d in newds:
+            self.fw.add(self.pos[d], 1)
+
+    def ds_with(self, ds, prev):
+        """All elements, with ds inserted after prev"""
+        alls = self.ds
+        ii = alls.index(prev) + 1
+        return alls[:ii] + ds + alls[ii:]
 
 
 def get_cd2(svg):
@@ -568,7 +716,7 @@ unrendered.update(
 
 
 
-def wrapped_binary(filename, inkscape_binary=None, extra_args=None, svg=None, get_bbs=True,cwd=None):
+def wrapped_binary(filename, inkscape_binary=None, extra_args=None, svg=None, get_bbs=True,cwd=None,pool=None):
     """
     Retrieves all of a document's bounding boxes using a call to the Inkscape binary.
 
@@ -578,6 +726,8 @@ def wrapped_binary(filename, inkscape_binary=None, extra_args=None, svg=None, ge
         it will attempt to find it.
         extra_args (list): Additional arguments to pass to the Inkscape command.
         svg: An optional svg to use instead of loading from file.
+        pool: An optional inkscape_shell.ShellPool. If supplied, any --actions
+        in extra_args are run by a persistent worker instead of a new process.
 
     Returns:
         dict: A dictionary where keys are element IDs and values are bounding
@@ -587,14 +737,21 @@ def wrapped_binary(filename, inkscape_binary=None, extra_args=None, svg=None, ge
         inkscape_binary = inkex.inkscape_system_info.binary_location
     extra_args = [] if extra_args is None else extra_args
 
-    if get_bbs:
+    if pool is not None:
+        acts = "".join(
+            extra_args[i + 1] for i, a in enumerate(extra_args[:-1]) if a == "--actions"
+        )
+        tfstr = shell_repeat(pool, filename, acts, query_all=get_bbs)
+        if not get_bbs:
+            return None
+    elif get_bbs:
         arg2 = [inkscape_binary, "--query-all"] + extra_args + [filename]
         proc = subprocess_repeat(arg2,cwd=cwd)
+        tfstr = proc.stdout
     else:
         arg2 = [inkscape_binary] + extra_args + [filename]
         proc = subprocess_repeat(arg2,cwd=cwd)
         return None
-    tfstr = proc.stdout
 
     # Parse the output
     tbbli = tfstr.splitlines()
@@ -606,8 +763,11 @@ def wrapped_binary(filename, inkscape_binary=None, extra_args=None, svg=None, ge
         if str(line)[2:52] == "WARNING: Requested update while update in progress":
             continue
             # skip warnings (version 1.0 only?)
-        data = [float(x.strip("'")) for x in str(line).split(",")[1:]]
-        if keyv != "'":  # sometimes happens in v1.3
+        try:
+            data = [float(x.strip("'")) for x in str(line).split(",")[1:]]
+        except ValueError:
+            continue  # shell workers can print other messages
+        if keyv != "'" and len(data) == 4:  # sometimes happens in v1.3
             bbs[keyv] = data
 
     # Inkscape always reports a bounding box in pixels, relative to the viewbox
@@ -622,6 +782,33 @@ def wrapped_binary(filename, inkscape_binary=None, extra_args=None, svg=None, ge
     return bbs
 
 
+def shell_repeat(pool, filename, actions, query_all=True):
+    """
+    Like subprocess_repeat, but runs on a shell worker from a pool. Timeouts
+    are retried with a longer limit; crashes are raised immediately as
+    inkscape_shell.ShellCrash so the caller can split up its actions.
+    """
+    import inkscape_shell
+
+    base_timeout = 60
+    nattempts = 6
+    ntime = 0
+    for i in range(nattempts):
+        timeout = base_timeout * 2**i
+        try:
+            return pool.run_file(filename, actions, query_all=query_all, timeout=timeout)
+        except inkscape_shell.ShellTimeout:
+            ntime += timeout
+    raise TimeoutError(
+        "\nThe call to the Inkscape binary timed out "
+        + str(nattempts)
+        + " times in "
+        + str(ntime)
+        + " seconds.\n\n"
+        + "This may be a temporary issue; try running the extension again."
+    )
+
+
 # Determine if object has a bbox
 @lru_cache(maxsize=None)
 def hasbbox(el):
@@ -643,59 +830,136 @@ def isdrawn(el):
 
 
 # A wrapper that replaces get_bounding_boxes with Pythonic calls only if possible
-def BB2(svg, els=None, forceupdate=False, roughpath=False, parsed=False):
+# With asarray=True, returns a BBoxArray instead of a dict
+# Elements it doesn't support get their boxes from a binary query (see BB2_binary)
+def BB2(svg, els=None, forceupdate=False, roughpath=False, parsed=False, asarray=False):
     if els is None:
         els = svg.descendants2()
-    if all([d.tag in bb2_support_tags or not (hasbbox(d)) for d in els]):
-        # All descendants of all els in the list
-        allds = set()
-        for el in els:
-            if el not in allds:  # so we're not re-descendants2ing
-                allds.update(el.descendants2())
-        tels = [
-            d
-            for d in unique(allds)
-            if isinstance(d, (inkex.TextElement, inkex.FlowRoot))
-        ]
+    unsupported = [d for d in els if d.tag not in bb2_support_tags and hasbbox(d)]
+    if len(unsupported) > 0:
+        binels = set()
+        for d in unsupported:
+            binels.update(d.descendants2())
+        els = [d for d in els if d not in binels]
+    # All descendants of all els in the list
+    allds = set()
+    for el in els:
+        if el not in allds:  # so we're not re-descendants2ing
+            allds.update(el.descendants2())
+    tels = [
+        d
+        for d in unique(allds)
+        if isinstance(d, (inkex.TextElement, inkex.FlowRoot))
+    ]
 
-        if len(tels) > 0:
-            if forceupdate:
-                svg.char_table = None
-                for d in els:
-                    d.cbbox = None
-                    d.parsed_text = None
-            if not hasattr(svg, "_char_table"):
-                from inkex.text import parser  # noqa
-
-                svg.make_char_table(els=tels)
-                # pts = [el.parsed_text for el in tels]
-                ptl = parser.ParsedTextList(tels)
-                ptl.precalcs()
+    if len(tels) > 0:
+        if forceupdate:
+            svg.char_table = None
+            for d in els:
+                d.cbbox = None
+                d.parsed_text = None
+        if not hasattr(svg, "_char_table"):
+            from inkex.text import parser  # noqa
+
+            svg.make_char_table(els=tels)
+            # pts = [el.parsed_text for el in tels]
+            ptl = parser.ParsedTextList(tels)
+            ptl.precalcs()
+    # Get all path extents in one vectorized pass
+    pels = [d for d in allds if d.tag in cpath_support_tags]
+    BaseElementCache.precalc_cpath_extents(pels, rough=roughpath)
+    if asarray:
+        # Get untransformed boxes (cached), then transform all at once
+        bels = [d for d in els if d.tag in bb2_support_tags and hasbbox(d)]
+        lbbs = [
+            bounding_box2(d, dotransform=False, roughpath=roughpath, parsed=parsed)
+            for d in bels
+        ]
+        ret = BBoxArray.from_bboxes([d.get_id() for d in bels], lbbs)
+        ret = ret.transform([d.ccomposed_transform for d in bels])
+    else:
         ret = dict()
         for d in els:
             if d.tag in bb2_support_tags and hasbbox(d):
                 mbbox = bounding_box2(d, roughpath=roughpath, parsed=parsed)
                 if not (mbbox.isnull):
                     ret[d.get_id()] = mbbox.sbb
-    else:
+
+    if len(unsupported) > 0:
+        # Merge in the binary's boxes, which are also added to any ancestors
+        binbbs = BB2_binary(svg, unsupported)
+        ret = dict(ret)
+        ids = {d.get_id() for d in els}
+        for d in unsupported:
+            for k in d.descendants2():
+                if k.get_id() in binbbs:
+                    ret[k.get_id()] = binbbs[k.get_id()]
+            if d.get_id() not in binbbs:
+                continue
+            for anc in d.ancestors2():
+                aid = anc.get_id()
+                if aid in ids:
+                    ret[aid] = bbox(ret.get(aid)).union(bbox(binbbs[d.get_id()])).sbb
+        if asarray:
+            ret = BBoxArray.from_dict(ret)
+
+    return ret
+
+
+URL_REF = re.compile(r"""(?:url\(\s*["']?|^)#([^)"'\s]+)""")
+
+
+def BB2_binary(svg, els):
+    """
+    Bounding boxes of elements that BB2 can't calculate, found with the binary.
+    Only a pruned copy of the document is queried: the elements, their
+    ancestors and descendants, definitions, and anything they reference.
+    Results are memoized by the pruned copy's contents, so repeat calls
+    on an unchanged document don't call the binary again.
+    """
+    keep = set()
+    todo = list(els) + [k for k in svg if k.tag in unrendered]
+    while todo:
+        el = todo.pop()
+        if el in keep:
+            continue
+        keep.update(el.ancestors2(includeme=True))
+        for d in el.descendants2():
+            keep.add(d)
+            for val in d.attrib.values():
+                for rid in URL_REF.findall(val):
+                    ref = svg.getElementById(rid)
+                    if ref is not None and ref not in keep:
+                        todo.append(ref)
+
+    def prune(el):
+        new = lxml.etree.Element(el.tag, dict(el.attrib), nsmap=el.nsmap)
+        new.text = el.text
+        for k in el:
+            if k in keep:
+                nk = prune(k)
+                nk.tail = k.tail
+                new.append(nk)
+        return new
+
+    pruned = lxml.etree.tostring(prune(svg), xml_declaration=True, encoding="UTF-8")
+    key = hashlib.sha256(pruned).hexdigest()
+    if not hasattr(svg, "_bb2_binary"):
+        svg._bb2_binary = dict()
+    if key not in svg._bb2_binary:
         import tempfile
 
-        # with tempfile.TemporaryFile() as temp:
-        #     idebug(temp.name)
-        #     tname = os.path.abspath(temp.name)
-        #     overwrite_svg(svg, tname)
-        #     ret = wrapped_binary(filename=tname, svg=svg)
-            
-        with tempfile.NamedTemporaryFile(delete=False) as temp:
+        with tempfile.NamedTemporaryFile(delete=False, suffix=".svg") as temp:
             tname = os.path.abspath(temp.name)
+            temp.write(pruned)
         try:
-            overwrite_svg(svg, tname)
-            ret = wrapped_binary(filename=tname, svg=svg)
+            svg._bb2_binary[key] = wrapped_binary(filename=tname, svg=svg)
         finally:
             if os.path.exists(tname):
                 os.remove(tname)
-
-    return ret
+        while len(svg._bb2_binary) > 8:
+            svg._bb2_binary.pop(next(iter(svg._bb2_binary)))
+    return svg._bb2_binary[key]
 
 
 # For diagnosing BB2
@@ -741,23 +1005,33 @@ def bb_intersects(bbs, bb2s=None):
         )
 
 # Return list of objects on top of other objects
-def overlapping_els(svg,tocheck):
+def overlapping_els(svg,tocheck,below=False):
+    """
+    For each element in tocheck, find the drawn elements on top of it whose
+    bounding boxes intersect its own. If below is True, the intersecting
+    elements underneath it are also included.
+    """
     els = [el for el in svg.descendants2() if isdrawn(el)]
-    bbs = BB2(svg, els, roughpath=True, parsed=True)
-    bbs = [bbox(bbs.get(el.get_id())) for el in els]
+    bbs = BB2(svg, els, roughpath=True, parsed=True, asarray=True)
+    bbs = bbs.take([el.get_id() for el in els])
     
-    chki = [i for i,el in enumerate(els) if el in tocheck]
-    bbs_check = [bbs[i] for i in chki]
-    intrscts = bb_intersects(bbs, bbs_check)
+    tochk = set(tocheck)
+    chki = [i for i,el in enumerate(els) if el in tochk]
+    bbs_check = bbs.take([els[i].get_id() for i in chki])
+    from spatial_index import SpatialIndex
+    ii, jj = SpatialIndex(bbs).query_pairs(bbs_check)
     
     ret = {el: [] for el in tocheck}
-    for j,ci in enumerate(chki):
+    dss = dict()
+    for i, j in zip(ii.tolist(), jj.tolist()):
+        ci = chki[j]
+        if i == ci or (i < ci and not below):
+            continue
         elj = els[ci]
-        for i in range(ci+1,len(els)):
-            eli = els[i]
-            ds = elj.descendants2()
-            if intrscts[i,j] and eli not in ds:
-                ret[elj].append(eli)
+        if elj not in dss:
+            dss[elj] = set(elj.descendants2())
+        if els[i] not in dss[elj]:
+            ret[elj].append(els[i])
     
     # for k,v in ret.items():
     #     dh.idebug(k.get_id()+': '+str([v2.get_id() for v2 in v]))
@@ -970,51 +1244,19 @@ def clean_up_document(svg):
             el.getparent() == svg.cdefs and el.tag not in exclude
         )
 
-    xlink = [inkex.addNS("href", "xlink"), "href"]
-    attids = {sa: dict() for sa in urlatts}
-    xlinks = dict()
-
-    def miterdescendants(el):
-        yield el
-        for d in el.iterdescendants():
-            yield d
-
-    # Make dicts of all url-containing style atts and xlinks
-    for d in svg.cdescendants2.ds:
-        for attName in d.attrib.keys():
-            if attName in urlatts:
-                if d.attrib[attName].startswith("url"):
-                    attids[attName][d.get_id()] = d.attrib[attName][5:-1]
-            elif attName in xlink:
-                if d.attrib[attName].startswith("#"):
-                    xlinks[d.get_id()] = d.attrib[attName][1:]
-            elif attName == "style":
-                if "url" in d.attrib[attName]:
-                    sty = Style(d.attrib[attName])
-                    for an2 in sty.keys():
-                        if an2 in urlatts:
-                            if sty[an2].startswith("url"):
-                                attids[an2][d.get_id()] = sty[an2][5:-1]
-
+    # Defs are pruned when nothing links to them or their descendants.
+    # Deletion updates the reference graph, so defs only used by pruned
+    # defs are pruned on the next pass.
+    refs = svg.crefs
     deletedsome = True
     while deletedsome:
-        allurls = set(
-            [v for sa in urlatts for v in attids[sa].values()] + list(xlinks.values())
-        )
-        # sets much faster than lists for membership testing
         deletedsome = False
         for el in svg.cdescendants2.ds:
             if should_prune(el):
                 eldids = [dv.get_id() for dv in svg.cdescendants2.iterel(el)]
-                if not (any([idv in allurls for idv in eldids])):
+                if all(refs.orphaned(did) for did in eldids):
                     el.delete()
                     deletedsome = True
-                    for did in eldids:
-                        for anm in urlatts:
-                            if did in attids[anm]:
-                                del attids[anm][did]
-                        if did in xlinks:
-                            del xlinks[did]
 
 
 def global_transform(el, trnsfrm, irange=None, trange=None, preserveStroke=True):
@@ -1314,30 +1556,17 @@ def bounding_box2(
                                 max(y) - min(y) + swd,
                             ]
                         )
-                    elif not roughpath:
-                        bbx = pth.bounding_box()
-                        ret = bbox(
-                            [
-                                bbx.left - swd / 2,
-                                bbx.top - swd / 2,
-                                bbx.width + swd,
-                                bbx.height + swd,
-                            ]
-                        )
                     else:
-                        anyarc = any(s.letter in ["a", "A"] for s in pth)
-                        pth = inkex.Path(inkex.CubicSuperPath(pth)) if anyarc else pth
-                        pts = list(pth.control_points)
-                        x = [p.x for p in pts]
-                        y = [p.y for p in pts]
-                        ret = bbox(
-                            [
-                                min(x) - swd / 2,
-                                min(y) - swd / 2,
-                                max(x) - min(x) + swd,
-                                max(y) - min(y) + swd,
-                            ]
-                        )
+                        bbx = self.cpath_extents(rough=roughpath)
+                        if not bbx.isnull:
+                            ret = bbox(
+                                [
+                                    bbx.x1 - swd / 2,
+                                    bbx.y1 - swd / 2,
+                                    bbx.w + swd,
+                                    bbx.h + swd,
+                                ]
+                            )
 
             elif self.tag in grouplike_tags:
                 for kid in list2(self):
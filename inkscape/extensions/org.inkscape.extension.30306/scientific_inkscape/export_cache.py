@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2023 David Burghoff <burghoff@utexas.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Content-addressed cache for Autoexporter outputs
+
+Entries are keyed by a hash of everything that determines an output (the
+SVG's hash, the format, the relevant export options, and the versions of
+Inkscape and of this code) and hold one or more files plus a small pickled
+metadata dict. Each entry is a directory that is written under a temporary
+name and renamed into place, so concurrent exporters never see a partial
+entry. Entries are evicted least recently used first once the cache exceeds
+its size limit.
+"""
+
+import os
+import time
+import pickle
+import shutil
+import hashlib
+import threading
+from functools import lru_cache
+
+import dhelpers as dh
+
+MAX_BYTES = 500 * 2**20
+META_FILE = "si_meta.p"
+evict_lock = threading.Lock()
+
+
+def cache_key(*parts):
+    """Hash any number of picklable, deterministic parts into a key."""
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+def files_signature(paths):
+    """A cheap signature for external files (e.g. linked images)."""
+    sig = []
+    for path in sorted(p for p in paths if p is not None):
+        try:
+            stat = os.stat(path)
+            sig.append((path, stat.st_size, stat.st_mtime))
+        except OSError:
+            sig.append((path, None, None))
+    return tuple(sig)
+
+
+@lru_cache(maxsize=None)
+def code_signature(root):
+    """
+    A signature of the Python sources under a directory, so that entries made
+    by another version of the code that produced them are not reused.
+    """
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if d != "__pycache__"]
+        paths += [os.path.join(dirpath, f) for f in filenames if f.endswith(".py")]
+    return cache_key(files_signature(paths))
+
+
+class ExportCache:
+    """A size-bounded, least-recently-used store of exported files."""
+
+    def __init__(self, cachedir=None, max_bytes=MAX_BYTES):
+        if cachedir is None:
+            # Not inside si_temp, whose stale files are regularly deleted
+            cachedir = os.path.join(os.path.dirname(dh.shared_temp()), "si_ae_cache")
+        self.cachedir = cachedir
+        self.max_bytes = max_bytes
+        os.makedirs(self.cachedir, exist_ok=True)
+
+    def fetch(self, key, dests=None):
+        """
+        Look up an entry. If found, copy its files to the locations in dests
+        (a dict of stored name to destination path, a function giving the
+        destination of a stored name, or a directory that all files are copied
+        into) and return its metadata. Returns None on a miss.
+        """
+        edir = os.path.join(self.cachedir, key)
+        mfile = os.path.join(edir, META_FILE)
+        try:
+            with open(mfile, "rb") as file:
+                meta = pickle.load(file)
+            if isinstance(dests, str):
+                dests = {name: os.path.join(dests, name) for name in meta["files"]}
+            elif callable(dests):
+                dests = {name: dests(name) for name in meta["files"]}
+            elif dests is None:
+                dests = dict()
+            for name, dest in dests.items():
+                shutil.copyfile(os.path.join(edir, name), dest)
+            os.utime(edir)  # mark as recently used
+        except (OSError, EOFError, pickle.UnpicklingError, KeyError):
+            return None
+        return meta
+
+    def store(self, key, files, meta=None):
+        """
+        Add an entry. files is a dict of stored name to source path; meta is an
+        optional dict of extra information (must be picklable).
+        """
+        edir = os.path.join(self.cachedir, key)
+        if os.path.exists(edir):
+            return
+        tmpdir = edir + ".{0}.{1}.tmp".format(os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(tmpdir)
+            for name, src in files.items():
+                shutil.copyfile(src, os.path.join(tmpdir, name))
+            meta = dict() if meta is None else dict(meta)
+            meta["files"] = list(files.keys())
+            with open(os.path.join(tmpdir, META_FILE), "wb") as file:
+                pickle.dump(meta, file)
+            os.rename(tmpdir, edir)
+        except OSError:
+            # Another exporter stored it first, or the disk is unavailable
+            shutil.rmtree(tmpdir, ignore_errors=True)
+            return
+        self.evict()
+
+    def entries(self):
+        """List (last use time, size, path) of all complete entries."""
+        ret = []
+        for name in os.listdir(self.cachedir):
+            edir = os.path.join(self.cachedir, name)
+            if name.endswith(".tmp") or not os.path.isdir(edir):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(edir, f)) for f in os.listdir(edir)
+                )
+                ret.append((os.path.getmtime(edir), size, edir))
+            except OSError:
+                continue
+        return ret
+
+    def evict(self):
+        """Delete least recently used entries until under the size limit."""
+        with evict_lock:
+            ents = sorted(self.entries())
+            total = sum(e[1] for e in ents)
+            for _, size, edir in ents:
+                if total <= self.max_bytes:
+                    break
+                shutil.rmtree(edir, ignore_errors=True)
+                total -= size
+
+            # Clear any abandoned partial entries
+            one_day_ago = time.time() - 24 * 60 * 60
+            for name in os.listdir(self.cachedir):
+                tmp = os.path.join(self.cachedir, name)
+                try:
+                    if name.endswith(".tmp") and os.path.getmtime(tmp) < one_day_ago:
+                        shutil.rmtree(tmp, ignore_errors=True)
+                except OSError:
+                    pass
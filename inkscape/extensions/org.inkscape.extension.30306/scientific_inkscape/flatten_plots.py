@@ -43,6 +43,7 @@ from inkex import (
 from inkex.text.utils import isrectangle
 import lxml
 from remove_kerning import remove_kerning
+from spatial_index import SpatialIndex
 
 
 class FlattenPlots(inkex.EffectExtension):
@@ -183,6 +184,7 @@ class FlattenPlots(inkex.EffectExtension):
         reversions = self.options.reversions and self.options.fixtext
         removetextclips = self.options.removetextclips and self.options.fixtext
 
+        self.svg.resolve_all()
         sel = [el for el in self.svg.descendants2() if el in sel]  # doc order
         if self.options.tab == "Exclusions":
             self.options.markexc = {1: True, 2: False}[self.options.markexc]
@@ -488,29 +490,28 @@ class FlattenPlots(inkex.EffectExtension):
                 bbs3 = [dh.bbox(bbs.get(el.get_id())) for el in ngs3]
                 wriis = [ii for ii, el in enumerate(ngs3) if el in wrects]
                 wrbbs = [bbs3[ii] for ii in wriis]
-                intrscts = dh.bb_intersects(bbs3, wrbbs)
+                kks, jjs = SpatialIndex(bbs3).query_pairs(wrbbs)
+                below = {jj: [] for jj in range(len(wriis))}
+                for kk, jj in zip(kks.tolist(), jjs.tolist()):
+                    if kk < wriis[jj]:
+                        below[jj].append(kk)
+                deleted = set()
                 for jj, ii in enumerate(wriis):
-                    if not any(intrscts[:ii, jj]):
+                    if all(kk in deleted for kk in below[jj]):
                         ngs3[ii].delete(deleteup=True)
-                        intrscts[ii, :] = False
+                        deleted.add(ii)
                         ngs2.remove(ngs3[ii])
                         
                     
 
         # Remove any unused clips we made, unnecessary white space in document
-        ds = self.svg.iddict.descendants
-        clips = [dh.EBget(el, "clip-path") for el in ds]
-        masks = [dh.EBget(el, "mask") for el in ds]
-        clips = [url[5:-1] for url in clips if url is not None]
-        masks = [url[5:-1] for url in masks if url is not None]
-
         ctag = inkex.ClipPath.ctag
         if hasattr(self.svg, "newclips"):
+            refs = self.svg.crefs
             for el in self.svg.newclips:
-                if el.tag == ctag and not (el.get_id() in clips):
-                    el.delete(deleteup=True)
-                elif dh.isMask(el) and not (el.get_id() in masks):
+                if (el.tag == ctag or dh.isMask(el)) and refs.orphaned(el):
                     el.delete(deleteup=True)
+        ds = self.svg.iddict.descendants
 
         ttags = dh.tags((Tspan, TextPath, FlowPara, FlowRegion, FlowSpan))
         ttags2 = dh.tags(
@@ -32,6 +32,9 @@ Also gives SvgDocumentElements some dictionaries that are used to speed up
 various lookups:
   svg.iddict: elements by their ID
   svg.cssdict: CSS styles by ID
+  svg.crefs: which elements link to which (clip-paths, masks, gradients, etc.)
+svg.resolve_all() fills the style and transform caches of a whole document
+at once, which is faster when most elements will be visited.
 
 Lastly, several core Inkex functions are overwritten with versions that
 use the cache. For example, getElementById uses svg.iddict to avoid xpath
@@ -39,12 +42,21 @@ calls.
 """
 
 import re
+import cssselect
+from collections import OrderedDict
 from typing import Optional, List
 import inkex
 from inkex import Style
 from inkex import BaseElement, SvgDocumentElement
 from inkex.text.parser import ParsedText, CharacterTable
-from text.utils import shapetags, tags, ipx, list2  # pylint: disable=import-error
+from text.utils import (  # pylint: disable=import-error
+    shapetags,
+    tags,
+    ipx,
+    list2,
+    path_segments,
+    path_extents,
+)
 import lxml
 
 EBget = lxml.etree.ElementBase.get
@@ -95,6 +107,86 @@ else:
         return ret
 
 
+class FrozenStyle(Style):
+    """
+    An immutable Style that is shared by every element with the same style.
+    Cached cascaded and specified styles are interned as FrozenStyles, so
+    memory scales with the number of distinct styles rather than elements.
+    Copying or adding to one gives an ordinary Style that can be modified.
+    """
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("Cached styles are shared and cannot be modified, use a copy")
+
+    __setitem__ = __delitem__ = _readonly
+    update = pop = popitem = clear = setdefault = _readonly
+    __iadd__ = __isub__ = update_urls = _readonly
+
+    def copy(self):
+        """A mutable copy of the style."""
+        ret = empty_style()
+        dict.update(ret, self)
+        return ret
+
+    __copy__ = copy
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def __reduce__(self):
+        return (Style, (dict(self),))
+
+    def __add__(self, other):
+        ret = self.copy()
+        ret.update(other)
+        return ret
+
+    def add3(self, other1, other2):
+        """Adds three style objects together."""
+        return self + other1 + other2
+
+    def __sub__(self, other):
+        ret = self.copy()
+        ret -= other
+        return ret
+
+
+# Interning is only done for SI's dict-based Style
+INTERN_STYLES = not issubclass(Style, OrderedDict)
+INTERNED_STYLES = dict()  # items -> FrozenStyle
+MERGED_STYLES = dict()  # (id(parent), id(local)) -> (parent, local, FrozenStyle)
+# Both tables are cleared once this many styles are interned, so long-lived
+# processes (e.g. the Autoexporter's) don't keep every style they have seen
+MAX_INTERNED = 100000
+
+
+def clear_style_tables():
+    """Forget all interned and merged styles."""
+    INTERNED_STYLES.clear()
+    MERGED_STYLES.clear()
+
+
+def intern_style(sty):
+    """
+    Returns the shared FrozenStyle with the same items (in the same order)
+    as sty. Styles with unhashable values are returned as-is.
+    """
+    if not INTERN_STYLES or type(sty) is FrozenStyle:
+        return sty
+    try:
+        key = tuple(sty.items())
+        ret = INTERNED_STYLES.get(key)
+    except TypeError:
+        return sty
+    if ret is None:
+        if len(INTERNED_STYLES) >= MAX_INTERNED:
+            clear_style_tables()
+        ret = dict.__new__(FrozenStyle)
+        dict.update(ret, sty)
+        INTERNED_STYLES[key] = ret
+    return ret
+
+
 # pylint:disable=attribute-defined-outside-init
 class BaseElementCache(BaseElement):
     """Adds caching of style and transformation properties of base elements."""
@@ -154,7 +246,7 @@ class BaseElementCache(BaseElement):
                     del elem.attrib["style"]
 
             if not isinstance(value, BaseElementCache.CStyle):
-                if isinstance(value, Style):
+                if isinstance(value, Style) and not isinstance(value, FrozenStyle):
                     # Cast to CStyle without reinitializing
                     value.__class__ = BaseElementCache.CStyle
                     value.elem = elem
@@ -164,6 +256,7 @@ class BaseElementCache(BaseElement):
             elem._cstyle = value
             elem.ccascaded_style = None
             elem.cspecified_style = None
+            elem.update_crefs()
 
     cstyle = CStyleDescriptor()
 
@@ -175,14 +268,36 @@ class BaseElementCache(BaseElement):
         if not (hasattr(self, "_cspecified_style")):
             parent = self.getparent()
             if parent is not None and parent.tag in BaseElementCache.cstytags:
-                ret = parent.cspecified_style + self.ccascaded_style
+                psty = parent.cspecified_style
             else:
-                ret = self.ccascaded_style
-            if "font" in ret:
-                ret = ret + BaseElementCache.font_shorthand(ret["font"])
-            self._cspecified_style = ret
+                psty = None
+            self._cspecified_style = BaseElementCache.merge_specified(
+                psty, self.ccascaded_style
+            )
         return self._cspecified_style
 
+    @staticmethod
+    def merge_specified(psty, locsty):
+        """
+        Specified style of an element from its parent's specified style (None
+        if it doesn't inherit) and its cascaded style.
+        """
+        # Entries hold their inputs, so the ids in their keys can't be reused
+        # by other styles while they are in the table
+        key = (id(psty), id(locsty))
+        ent = MERGED_STYLES.get(key)
+        if ent is not None:
+            return ent[2]
+        ret = locsty if psty is None else psty + locsty
+        if "font" in ret:
+            ret = ret + BaseElementCache.font_shorthand(ret["font"])
+        ret = intern_style(ret)
+        if type(ret) is FrozenStyle and (
+            psty is None or type(psty) is FrozenStyle
+        ) and type(locsty) is FrozenStyle:
+            MERGED_STYLES[key] = (psty, locsty, ret)
+        return ret
+
     def set_cspecified_style(self, svi):
         """Invalidates the cached specified style."""
         if svi is None:
@@ -323,7 +438,7 @@ class BaseElementCache(BaseElement):
                 # Any style specified locally takes priority, followed by CSS,
                 # followed by any attributes that the element has
                 ret = attsty.add3(csssty, locsty)
-            self._ccascaded_style = ret
+            self._ccascaded_style = intern_style(ret)
         return self._ccascaded_style
 
     def set_ccascaded_style(self, svi):
@@ -451,10 +566,49 @@ class BaseElementCache(BaseElement):
 
     def set_cpath_fcn(self, svi):
         """Invalidates the cached path."""
-        if svi is None and hasattr(self, "_cpath"):
-            delattr(self, "_cpath")  # invalidate
+        if svi is None:
+            for att in ("_cpath", "_cpath_segments", "_cpath_extents"):
+                if hasattr(self, att):
+                    delattr(self, att)  # invalidate
 
     cpath = property(get_path2, set_cpath_fcn)
+
+    def get_cpath_segments(self):
+        """
+        Cached cpath as an (n, 4, 2) array of cubic segments, for vectorized
+        geometry (see path_segments).
+        """
+        if not hasattr(self, "_cpath_segments"):
+            self._cpath_segments = path_segments(self.cpath)
+        return self._cpath_segments
+
+    cpath_segments = property(get_cpath_segments)
+
+    def cpath_extents(self, rough=False):
+        """
+        Cached untransformed bbox of cpath, without stroke. If rough is True
+        it is the bbox of the control points, an upper bound.
+        """
+        if not hasattr(self, "_cpath_extents"):
+            self._cpath_extents = dict()
+        if rough not in self._cpath_extents:
+            exts = path_extents([self.cpath_segments], rough)
+            self._cpath_extents[rough] = exts.bbox(0)
+        return self._cpath_extents[rough]
+
+    @staticmethod
+    def precalc_cpath_extents(els, rough=False):
+        """Calculate the cpath extents of many elements at once."""
+        els = [
+            el
+            for el in els
+            if not (hasattr(el, "_cpath_extents") and rough in el._cpath_extents)
+        ]
+        exts = path_extents([el.cpath_segments for el in els], rough)
+        for i, el in enumerate(els):
+            if not hasattr(el, "_cpath_extents"):
+                el._cpath_extents = dict()
+            el._cpath_extents[rough] = exts.bbox(i)
     cpath_support = (
         inkex.Rectangle,
         inkex.Ellipse,
@@ -505,6 +659,12 @@ class BaseElementCache(BaseElement):
 
     croot = property(get_croot, set_croot)
 
+    def update_crefs(self):
+        """Updates the element's links in its root's reference graph, if made."""
+        svg = self.croot
+        if svg is not None and hasattr(svg, "_crefs"):
+            svg._crefs.update(self)
+
     # Version of set_random_id that uses cached root
     def set_random_id(
         self,
@@ -602,6 +762,8 @@ class BaseElementCache(BaseElement):
                 except (KeyError, AttributeError):
                     pass
                 svg.iddict.remove(ddv)
+                if hasattr(svg, "_crefs"):
+                    svg._crefs.remove(ddv)
             ddv.croot = None
         if hasattr(svg, "_cd2"):
             svg.cdescendants2.delel(self)
@@ -634,6 +796,7 @@ class BaseElementCache(BaseElement):
             elem.croot = newroot
             if newroot is not None:
                 newroot.iddict.add(elem)  # generates an ID if needed
+            elem.update_crefs()
             for k in list2(elem):
                 elem.append(k)  # update children
         elif oldroot != newroot:
@@ -642,14 +805,23 @@ class BaseElementCache(BaseElement):
             if oldroot is not None:
                 oldroot.iddict.remove(elem)
                 css = oldroot.cssdict.pop(elem.get_id(), None)
+                if hasattr(oldroot, "_crefs"):
+                    oldroot._crefs.remove(elem)
             elem.croot = newroot
             if newroot is not None:
                 newroot.iddict.add(elem)  # generates an ID if needed
                 if css is not None:
                     newroot.cssdict[elem.get_id()] = css
+            elem.update_crefs()
             for k in list2(elem):
                 elem.append(k)  # update children
 
+        # Keep the cached descendants list in order
+        if oldroot is not newroot and hasattr(oldroot, "_cd2"):
+            oldroot._cd2.delel(elem)
+        if hasattr(newroot, "_cd2"):
+            newroot._cd2.addel(elem)
+
     # Appending
     # BE_append = inkex.BaseElement.append
     BE_append = lxml.etree.ElementBase.append
@@ -669,6 +841,7 @@ class BaseElementCache(BaseElement):
             elem.croot = newroot
             if newroot is not None:
                 newroot.iddict.add(elem)  # generates an ID if needed
+            elem.update_crefs()
             for k in list2(elem):
                 elem.append(k)  # update children
         elif oldroot != newroot:
@@ -677,14 +850,23 @@ class BaseElementCache(BaseElement):
             if oldroot is not None:
                 oldroot.iddict.remove(elem)
                 css = oldroot.cssdict.pop(elem.get_id(), None)
+                if hasattr(oldroot, "_crefs"):
+                    oldroot._crefs.remove(elem)
             elem.croot = newroot
             if newroot is not None:
                 newroot.iddict.add(elem)  # generates an ID if needed
                 if css is not None:
                     newroot.cssdict[elem.get_id()] = css
+            elem.update_crefs()
             for k in list2(elem):
                 elem.append(k)  # update children
 
+        # Keep the cached descendants list in order
+        if oldroot is not newroot and hasattr(oldroot, "_cd2"):
+            oldroot._cd2.delel(elem)
+        if hasattr(newroot, "_cd2"):
+            newroot._cd2.addel(elem)
+
     # addnext
     # BE_addnext = inkex.BaseElement.addnext
     BE_addnext = lxml.etree.ElementBase.addnext
@@ -704,6 +886,7 @@ class BaseElementCache(BaseElement):
             elem.croot = newroot
             if newroot is not None:
                 newroot.iddict.add(elem)  # generates an ID if needed
+            elem.update_crefs()
             for k in list2(elem):
                 elem.append(k)  # update children
         elif oldroot != newroot:
@@ -712,14 +895,23 @@ class BaseElementCache(BaseElement):
             if oldroot is not None:
                 oldroot.iddict.remove(elem)
                 css = oldroot.cssdict.pop(elem.get_id(), None)
+                if hasattr(oldroot, "_crefs"):
+                    oldroot._crefs.remove(elem)
             elem.croot = newroot
             if newroot is not None:
                 newroot.iddict.add(elem)  # generates an ID if needed
                 if css is not None:
                     newroot.cssdict[elem.get_id()] = css
+            elem.update_crefs()
             for k in list2(elem):
                 elem.append(k)  # update children
 
+        # Keep the cached descendants list in order
+        if oldroot is not newroot and hasattr(oldroot, "_cd2"):
+            oldroot._cd2.delel(elem)
+        if hasattr(newroot, "_cd2"):
+            newroot._cd2.addel(elem)
+
     # Duplication
     clipmasktags = {inkex.addNS("mask", "svg"), inkex.ClipPath.ctag}
 
@@ -748,6 +940,10 @@ class BaseElementCache(BaseElement):
             if origids[k] in css
         }
         dup.croot.cssdict.update(newids)
+        if hasattr(dup.croot, "_crefs"):
+            for k in dup.descendants2():
+                if EBget(k, "id") in newids:
+                    k.update_crefs()
 
         if dup.tag in BaseElementCache.clipmasktags:
             # Clip duplications can cause weird issues if they are not appended
@@ -804,6 +1000,35 @@ class SvgDocumentElementCache(SvgDocumentElement):
 
     crootsty = property(crootsty_func)
 
+    def resolve_all(self):
+        """
+        Caches the root, cascaded style, specified style, and composed transform
+        of every element in one pass. Parents are visited before their children,
+        so each element is resolved from its parent's cached values instead of
+        by recursive property calls. Values that are already cached are kept.
+        """
+        cstytags = BaseElementCache.cstytags
+        self.iddict  # pylint: disable=pointless-statement
+        # (iddict references every element, so the values cached here persist)
+        for elem in self.descendants2():
+            elem._croot = self
+            parent = elem.getparent()
+            if not hasattr(elem, "_cspecified_style"):
+                if parent is not None and parent.tag in cstytags:
+                    psty = parent._cspecified_style
+                else:
+                    psty = None
+                elem._cspecified_style = BaseElementCache.merge_specified(
+                    psty, elem.ccascaded_style
+                )
+            if not hasattr(elem, "_ccomposed_transform"):
+                if parent is None:
+                    elem._ccomposed_transform = elem.ctransform
+                else:
+                    elem._ccomposed_transform = (
+                        parent._ccomposed_transform @ elem.ctransform
+                    )
+
     def get_ids(self):
         """Version of get_ids that uses iddict"""
         return set(self.iddict.keys())
@@ -902,96 +1127,269 @@ class SvgDocumentElementCache(SvgDocumentElement):
     # Check if v1.4 or later
     hasmatches = hasattr(inkex.styles.ConditionalStyle, "matches")
 
-    class CSSDict(dict):
-        """A dict that keeps track of the CSS style for each element"""
+    class RefGraph:
+        """
+        Keeps track of which elements link to which others, through href
+        attributes and url() values of the style properties in urlatts
+        (clip-path, mask, markers, fill and stroke paint servers, and
+        filters). Links from attributes, the style attribute, and CSS are all
+        included. Forward edges map elements to the (attribute, ID) pairs they
+        link to, and backward edges map IDs to the elements linking to them.
+        Kept up to date by the insertion, deletion, and cstyle hooks, and by
+        set for link attributes.
+        """
+
+        urlatts = (
+            "fill",
+            "stroke",
+            "clip-path",
+            "mask",
+            "filter",
+            "marker-start",
+            "marker-mid",
+            "marker-end",
+            "marker",
+        )
+        hrefatts = {inkex.addNS("href", "xlink"): "xlink:href", "href": "href"}
+        # Attributes whose changes can change an element's links
+        linkatts = frozenset(urlatts) | frozenset(hrefatts) | {"style"}
 
         def __init__(self, svg):
             self.svg = svg
+            self.forward = dict()
+            self.backward = dict()
+            for elem in svg.descendants2():
+                self.update(elem)
+
+        def links(self, elem):
+            """Set of (attribute, ID) pairs that an element links to"""
+            ret = set()
+            attrib = elem.attrib
+            for att, name in SvgDocumentElementCache.RefGraph.hrefatts.items():
+                val = attrib.get(att)
+                if val is not None and val.startswith("#"):
+                    ret.add((name, val[1:]))
+            stys = [attrib]
+            locsty = attrib.get("style")
+            if locsty is not None and "url" in locsty:
+                stys.append(Style(locsty))
+            css = self.svg.cssdict.get(attrib.get("id"))
+            if css is not None:
+                stys.append(css)
+            for sty in stys:
+                for att in SvgDocumentElementCache.RefGraph.urlatts:
+                    val = sty.get(att)
+                    if val is not None and val.startswith("url"):
+                        ret.add((att, val[5:-1]))
+            return ret
+
+        def update(self, elem):
+            """Recomputes the links of an element"""
+            self.remove(elem)
+            links = self.links(elem)
+            if len(links) > 0:
+                self.forward[elem] = links
+                for _, tid in links:
+                    # dicts used as ordered sets
+                    self.backward.setdefault(tid, dict())[elem] = None
 
-            # For certain xpaths such as classes, we can avoid xpath calls
-            # by checking the class attributes on a document's descendants directly.
-            # This is much faster for large documents.
-            hasall = False
-            simpleclasses = dict()
-            simpleids = dict()
-            patcls = re.compile(r"\.([-\w]+)")
-            patid = re.compile(r"#(\w+)")
+        def remove(self, elem):
+            """Removes the links of an element"""
+            links = self.forward.pop(elem, None)
+            if links is not None:
+                for _, tid in links:
+                    users = self.backward.get(tid)
+                    if users is not None:
+                        users.pop(elem, None)
+                        if len(users) == 0:
+                            del self.backward[tid]
+
+        @staticmethod
+        def target_id(target):
+            """ID of an element, or the ID itself if given a string"""
+            return target if isinstance(target, str) else EBget(target, "id")
+
+        def users(self, target):
+            """Elements that link to an element (or an ID)"""
+            return list(self.backward.get(self.target_id(target), ()))
+
+        def orphaned(self, target):
+            """True if no element links to an element (or an ID)"""
+            return self.target_id(target) not in self.backward
+
+        def targets(self, elem):
+            """List of (attribute, element) pairs of the existing elements an
+            element links to"""
+            ret = []
+            for att, tid in sorted(self.forward.get(elem, ())):
+                tel = self.svg.getElementById(tid, literal=True)
+                if tel is not None:
+                    ret.append((att, tel))
+            return ret
+
+    class SelectorIndex:
+        """
+        Inverted index of a document's elements by tag, class, and ID, used to
+        match CSS selectors without xpath. Selectors made of tags, classes, IDs,
+        and descendant / child combinators are supported. A compound selector
+        is matched by intersecting the elements with each of its tags, classes
+        and IDs, and combinators are checked by walking up each match's ancestors.
+        """
 
-            for sheet in svg.stylesheets:
-                for style in sheet:
-                    rules = tuple(str(r) for r in style.rules)
-                    # inkex.utils.debug(rules)
-                    if rules == ("*",):
-                        hasall = True
-                    elif all(patcls.match(r) for r in rules):
-                        # all rules are classes
-                        simpleclasses[rules] = [patcls.sub(r"\1", r) for r in rules]
-                    elif all(patid.match(r) for r in rules):
-                        # all rules are ids
-                        simpleids[rules] = [patid.sub(r"\1", r) for r in rules]
-
-            # Now, we make a dictionary of rules / xpaths we can do easily
-            knownrules = dict()
-            if hasall or len(simpleclasses) > 0:
-                dds = svg.iddict.descendants
-                if hasall:
-                    knownrules[("*",)] = dds
-                cvs = [EBget(d, "class") for d in dds]
-                c2s = [(i, c) for (i, c) in enumerate(cvs) if c is not None]
-                cmatches = dict()
-                for i, clsval in c2s:
-                    for c in clsval.split(" "):
-                        cmatches[c] = cmatches.get(c, []) + [dds[i]]
-                kxp2 = {
-                    rules: list(
-                        dict.fromkeys(
-                            [d for c in clslist if c in cmatches for d in cmatches[c]]
-                        )
-                    )
-                    for rules, clslist in simpleclasses.items()
-                }
-                knownrules.update(kxp2)
-
-            for rules, ids in simpleids.items():
-                knownrules[rules] = []
-                for idv in ids:
-                    idel = svg.getElementById(idv)
-                    if idel is not None:
-                        knownrules[rules].append(idel)
-
-            # Now run any necessary xpaths and get the element styles
+        svgns = "{" + inkex.NSS["svg"] + "}"
+
+        def __init__(self, svg):
+            self.elements = set()
+            self.bytag = dict()
+            self.byclass = dict()
+            self.byid = dict()
+            self.classes = dict()
+            for elem in svg.iddict.descendants:
+                self.elements.add(elem)
+                self.bytag.setdefault(elem.tag, set()).add(elem)
+                for cls in self.get_classes(elem):
+                    self.byclass.setdefault(cls, set()).add(elem)
+                self.byid.setdefault(EBget(elem, "id"), set()).add(elem)
+
+        def get_classes(self, elem):
+            """Set of an element's classes"""
+            try:
+                return self.classes[elem]
+            except KeyError:
+                clsval = EBget(elem, "class")
+                ret = frozenset(clsval.split()) if clsval else frozenset()
+                self.classes[elem] = ret
+                return ret
+
+        def compile(self, selector):
+            """
+            Converts a parsed selector into a list of (combinator, (tag, classes,
+            ids)) compounds, rightmost first, or None if it is not supported.
+            """
+            if selector.pseudo_element is not None:
+                return None
+            ret = []
+            comb = None
+            node = selector.parsed_tree
+            while True:
+                if isinstance(node, cssselect.parser.CombinedSelector):
+                    if node.combinator not in (" ", ">"):
+                        return None
+                    compound = self.compile_compound(node.subselector)
+                    nextcomb = node.combinator
+                    node = node.selector
+                else:
+                    compound = self.compile_compound(node)
+                    nextcomb = None
+                if compound is None:
+                    return None
+                ret.append((comb, compound))
+                if nextcomb is None:
+                    return ret
+                comb = nextcomb
+
+        def compile_compound(self, node):
+            """(tag, classes, ids) of a compound selector, or None if unsupported"""
+            classes, ids = [], []
+            while not isinstance(node, cssselect.parser.Element):
+                if isinstance(node, cssselect.parser.Class):
+                    classes.append(node.class_name)
+                elif isinstance(node, cssselect.parser.Hash):
+                    ids.append(node.id)
+                else:
+                    return None
+                node = node.selector
+            if node.namespace is not None:
+                return None
+            tag = None if node.element is None else self.svgns + node.element
+            return tag, frozenset(classes), ids
+
+        def matches_compound(self, elem, compound):
+            """Whether an element matches a compound selector"""
+            tag, classes, ids = compound
+            return (
+                (tag is None or elem.tag == tag)
+                and all(EBget(elem, "id") == idv for idv in ids)
+                and classes <= self.get_classes(elem)
+            )
+
+        def matches_from(self, elem, compiled, pos):
+            """
+            Whether an element that matches compound pos of a compiled selector
+            also satisfies the compounds to its left
+            """
+            if pos + 1 == len(compiled):
+                return True
+            comb, nextc = compiled[pos + 1]
+            anc = elem.getparent()
+            while anc is not None:
+                if self.matches_compound(anc, nextc) and self.matches_from(
+                    anc, compiled, pos + 1
+                ):
+                    return True
+                if comb == ">":
+                    return False
+                anc = anc.getparent()
+            return False
+
+        def candidates(self, compound):
+            """Elements that match a compound selector"""
+            tag, classes, ids = compound
+            posts = [self.byclass.get(c, set()) for c in classes]
+            posts += [self.byid.get(i, set()) for i in ids]
+            if tag is not None:
+                posts.append(self.bytag.get(tag, set()))
+            if len(posts) == 0:
+                return self.elements
+            posts.sort(key=len)
+            return posts[0].intersection(*posts[1:])
+
+        def select(self, compiled):
+            """Elements that match a compiled selector"""
+            cands = self.candidates(compiled[0][1])
+            if len(compiled) == 1:
+                return cands
+            return [d for d in cands if self.matches_from(d, compiled, 0)]
+
+    class CSSDict(dict):
+        """A dict that keeps track of the CSS style for each element"""
+
+        def __init__(self, svg):
+            self.svg = svg
             super().__init__()
+
+            # Selectors of tags, classes, and ids (and combinations of them)
+            # are matched using an index, avoiding xpath calls. This is much
+            # faster for large documents.
+            index = None
             for sheet in svg.croot.stylesheets:
                 for style in sheet:
                     try:
-                        # els = svg.xpath(style.to_xpath())  # original code
-                        rules = tuple(str(r) for r in style.rules)
                         stylev = Style(style)
-                        if rules in knownrules:
-                            els = knownrules[rules]
+                        if len(stylev) == 0:
+                            continue
+                        if index is None:
+                            index = SvgDocumentElementCache.SelectorIndex(svg)
+                        compiled = [index.compile(r.selector) for r in style.rules]
+                        if all(c is not None for c in compiled):
+                            els = set()
+                            for cmp in compiled:
+                                els.update(index.select(cmp))
+                        elif SvgDocumentElementCache.hasmatches:
+                            els = style.all_matches(svg)
                         else:
-                            if SvgDocumentElementCache.hasmatches:
-                                els = style.all_matches(svg)
-                            else:
-                                els = svg.xpath(style.to_xpath())
-
-                        if len(stylev) > 0:
-                            idvs = [
-                                EBget(elem, "id", None)
-                                for elem in els
-                                if "id" in elem.attrib
-                            ]
-                            newstys = {
-                                elid: stylev
-                                if elid not in self
-                                else self[elid] + stylev
-                                for elid in idvs
-                            }
-                            # Technically we should copy stylev, but as long as
-                            # styles in cssdict are only used in
-                            # get_cascaded_style, this is fine since that
-                            # function adds (creating copies)
-                            self.update(newstys)
+                            els = svg.xpath(style.to_xpath())
+
+                        for elem in els:
+                            elid = EBget(elem, "id", None)
+                            if elid is not None:
+                                # Technically we should copy stylev, but as
+                                # long as styles in cssdict are only used in
+                                # get_cascaded_style, this is fine since that
+                                # function adds (creating copies)
+                                self[elid] = (
+                                    stylev if elid not in self else self[elid] + stylev
+                                )
                     except (lxml.etree.XPathEvalError,):
                         pass
 
@@ -1001,6 +1399,16 @@ class SvgDocumentElementCache(SvgDocumentElement):
             if csssty is not None:
                 self[newid] = csssty
 
+    def get_crefs(self):
+        """Returns the reference graph of the document."""
+        try:
+            return self._crefs
+        except AttributeError:
+            self._crefs = SvgDocumentElementCache.RefGraph(self)
+            return self._crefs
+
+    crefs = property(get_crefs)
+
     def get_cssdict(self):
         """Returns the CSS dictionary that caches styles by element ID."""
         try:
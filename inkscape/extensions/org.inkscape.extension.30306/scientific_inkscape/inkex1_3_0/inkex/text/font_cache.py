@@ -0,0 +1,219 @@
+# coding=utf-8
+#
+# Copyright (c) 2023 David Burghoff <burghoff@utexas.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Persistent cache of fontconfig font resolution
+
+Matching a CSS style to a font, and finding fallback fonts for characters the
+matched font lacks, is done with fontconfig queries that were repeated on
+every run of an extension. This module stores the results in an SQLite
+database: the properties of the font each style matches, which font each
+character falls back to, and each font's character coverage (as a compressed
+bitmap).
+
+fontconfig's results only change when its configuration, cache, or font
+directories do, so the modification times of those paths are recorded with
+the entries. If any of them change, all entries are discarded.
+"""
+
+import os
+import json
+import zlib
+import sqlite3
+import threading
+import numpy as np
+from inkex.text.utils import temp_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS watched (path TEXT PRIMARY KEY, mtime REAL);
+CREATE TABLE IF NOT EXISTS matches (
+    sty TEXT PRIMARY KEY, truefont TEXT, props TEXT
+);
+CREATE TABLE IF NOT EXISTS bychar (
+    sty TEXT, c TEXT, truefont TEXT,
+    PRIMARY KEY (sty, c)
+);
+CREATE TABLE IF NOT EXISTS charsets (truefont TEXT PRIMARY KEY, coverage BLOB);
+"""
+DB_NAME = "si_font_matches_v1.sqlite"
+ENV_VARS = ("FONTCONFIG_FILE", "FONTCONFIG_PATH", "SI_FC_DIR", "XDG_DATA_HOME")
+
+
+def mtime(path):
+    """Modification time of a path, or None if it doesn't exist"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def env_entry(var):
+    """Watched entry for an environment variable that affects fontconfig"""
+    return "env:{0}={1}".format(var, os.environ.get(var, ""))
+
+
+def pack_charset(cset):
+    """Compress a set of code points into a coverage bitmap"""
+    if len(cset) == 0:
+        return b""
+    bits = np.zeros(max(cset) + 1, dtype=bool)
+    bits[np.fromiter(cset, dtype=np.int64, count=len(cset))] = True
+    return zlib.compress(np.packbits(bits).tobytes())
+
+
+def unpack_charset(coverage):
+    """Set of code points in a coverage bitmap"""
+    if len(coverage) == 0:
+        return set()
+    bits = np.unpackbits(np.frombuffer(zlib.decompress(coverage), dtype=np.uint8))
+    return set(np.flatnonzero(bits).tolist())
+
+
+class FontResolutionCache:
+    """An SQLite store of style-to-font matches and character coverage."""
+
+    def __init__(self, path=None):
+        self.path = temp_path(DB_NAME) if path is None else path
+        self.local = threading.local()  # connections can't be shared by threads
+        self.lock = threading.Lock()
+        self.watching = False
+        self.validate()
+
+    def connect(self):
+        """Get this thread's connection, making the tables if needed."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def validate(self):
+        """Discard all entries if any watched path has changed."""
+        conn = self.connect()
+        watched = conn.execute("SELECT path, mtime FROM watched").fetchall()
+
+        def changed(path, mtm):
+            if path.startswith("env:"):
+                return path != env_entry(path[4:].split("=")[0])
+            return mtime(path) != mtm
+
+        if any(changed(p, m) for p, m in watched):
+            with conn:
+                for table in ("watched", "matches", "bychar", "charsets"):
+                    conn.execute("DELETE FROM " + table)
+            watched = []
+        self.watching = len(watched) > 0
+
+    def watch(self, paths):
+        """
+        Record the paths whose changes invalidate the cache (fontconfig's
+        config, cache, and font directories). Only needed once per database.
+        """
+        with self.lock:
+            if self.watching:
+                return
+            rows = [(p, mtime(p)) for p in paths]
+            rows += [(env_entry(k), None) for k in ENV_VARS]
+            conn = self.connect()
+            with conn:
+                conn.executemany("INSERT OR REPLACE INTO watched VALUES (?, ?)", rows)
+            self.watching = True
+
+    def lookup_match(self, sty):
+        """
+        The font a style matched, as (truefont, props), or None if not cached.
+        props is a dict of fontconfig property names and values.
+        """
+        row = (
+            self.connect()
+            .execute("SELECT truefont, props FROM matches WHERE sty=?", (sty,))
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def store_match(self, sty, truefont, props):
+        """Add the font a style matched, in the format returned by lookup_match."""
+        try:
+            pjson = json.dumps(props)
+        except (TypeError, ValueError):
+            return
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO matches VALUES (?, ?, ?)", (sty, truefont, pjson)
+            )
+
+    def lookup_bychar(self, sty, chars):
+        """
+        Fallback fonts for characters of a style. Returns a dict of the
+        characters found, whose values are true fonts or None (no font).
+        """
+        ret = dict()
+        for c, truefont in self.connect().execute(
+            "SELECT c, truefont FROM bychar WHERE sty=?", (sty,)
+        ):
+            if c in chars:
+                ret[c] = truefont
+        return ret
+
+    def store_bychar(self, sty, tfbc):
+        """Add fallback fonts, in the format returned by lookup_bychar."""
+        conn = self.connect()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO bychar VALUES (?, ?, ?)",
+                [(sty, c, truefont) for c, truefont in tfbc.items()],
+            )
+
+    def lookup_charset(self, truefont):
+        """A font's set of code points, or None if not cached."""
+        row = (
+            self.connect()
+            .execute("SELECT coverage FROM charsets WHERE truefont=?", (truefont,))
+            .fetchone()
+        )
+        return None if row is None else unpack_charset(row[0])
+
+    def store_charset(self, truefont, cset):
+        """Add a font's set of code points."""
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO charsets VALUES (?, ?)",
+                (truefont, pack_charset(cset)),
+            )
+
+
+RCACHE = None
+RCACHE_LOCK = threading.Lock()
+
+
+def get_resolution_cache():
+    """The shared cache, or None if the database can't be used."""
+    global RCACHE  # pylint: disable=global-statement
+    with RCACHE_LOCK:
+        if RCACHE is None:
+            try:
+                RCACHE = FontResolutionCache()
+            except (sqlite3.Error, OSError):
+                RCACHE = False
+    return RCACHE if RCACHE else None
@@ -33,11 +33,20 @@ import os
 import warnings
 import sys
 import re
+import io
+import mmap
 import ctypes
+import hashlib
+import itertools
+import threading
+import queue
+import concurrent.futures
 from unittest.mock import patch
 from functools import lru_cache
+import numpy as np
 import inkex
-from inkex.text.utils import default_style_atts
+from inkex.text.utils import default_style_atts, temp_path
+from inkex.text.font_cache import get_resolution_cache
 from inkex import Style
 
 # The fontconfig library is used to select a font given its CSS specs
@@ -163,6 +172,40 @@ if sys.platform == "win32":
         )
 
 
+RESOLUTION_CACHE = True  # keep fontconfig matches between runs?
+CACHED_PROPS = (
+    fc.PROP.FAMILY,
+    fc.PROP.FULLNAME,
+    fc.PROP.FILE,
+    fc.PROP.INDEX,
+    fc.PROP.WEIGHT,
+    fc.PROP.WIDTH,
+    fc.PROP.SLANT,
+    fc.PROP.FONT_VARIATIONS,
+    fc.PROP.EMBOLDEN,
+)
+
+
+class CachedFcFont:
+    """
+    Stands in for a fontconfig font restored from the resolution cache.
+    Supports getting the properties in CACHED_PROPS and the charset.
+    """
+
+    __slots__ = ("props", "charset")
+
+    def __init__(self, props, charset):
+        self.props = props
+        self.charset = charset
+
+    def get(self, prop, _):
+        """Get a property's first value, like fc.Pattern.get"""
+        if prop == fc.PROP.CHARSET:
+            return self.charset, 0
+        val = self.props.get(prop.value)
+        return val, 0 if val is not None else 1
+
+
 class FontConfig:
     """
     Class to handle FontConfig functionalities.
@@ -173,12 +216,50 @@ class FontConfig:
         self.truefontsfc = dict()  # fontconfig
         self.truefontsfn = dict()  # fullnames
         self.truefontsft = dict()  # fonttools
+        self.ftinstances = dict()  # fonttools, by face
         self.fontcharsets = dict()
         self.disable_lcctype()
-        self.conf = fc.Config.get_current()
+        self._conf = None
+        self._rcache = None
         self._font_list = None
         self._font_list_css = None
 
+    @property
+    def conf(self):
+        """
+        fontconfig's configuration, loaded when first needed (which is not at
+        all if every font is in the resolution cache)
+        """
+        if self._conf is None:
+            self._conf = fc.Config.get_current()
+            if self.rcache is not None:
+                self.rcache.watch(
+                    list(self._conf.config_dirs)
+                    + list(self._conf.config_files)
+                    + list(self._conf.cache_dirs)
+                    + list(self._conf.font_dirs)
+                )
+        return self._conf
+
+    @property
+    def rcache(self):
+        """The persistent resolution cache, or None if disabled or unavailable"""
+        if self._rcache is None:
+            self._rcache = (get_resolution_cache() if RESOLUTION_CACHE else None) or False
+        return self._rcache if self._rcache else None
+
+    def load_charset(self, truefont):
+        """
+        Make sure a true font's charset is known, getting it from the
+        resolution cache if needed. Returns False if it isn't available.
+        """
+        if truefont not in self.fontcharsets:
+            cset = self.rcache.lookup_charset(str(truefont))
+            if cset is None:
+                return False
+            self.fontcharsets[truefont] = cset
+        return True
+
     def disable_lcctype(self):
         """
         Disables LC_CTYPE to suppress Mac warnings.
@@ -197,11 +278,30 @@ class FontConfig:
     def get_true_font(self, fontsty):
         """Use fontconfig to get the true font that most text will be rendered as"""
         if fontsty not in self.truefonts:
-            found = self.font_match(fontsty)
-            truefont = FontConfig.fcfont_to_css(found)
+            cached = None
+            if self.rcache is not None:
+                cached = self.rcache.lookup_match(str(fontsty))
+            if cached is not None:
+                truefont = None if cached[0] is None else Style(cached[0])
+                if self.load_charset(truefont):
+                    found = CachedFcFont(cached[1], self.fontcharsets[truefont])
+                else:
+                    cached = None
+            if cached is None:
+                found = self.font_match(fontsty)
+                truefont = FontConfig.fcfont_to_css(found)
+                self.fontcharsets[truefont] = found.get(fc.PROP.CHARSET, 0)[0]
+                if self.rcache is not None:
+                    self.rcache.store_charset(
+                        str(truefont), self.fontcharsets[truefont]
+                    )
+                    self.rcache.store_match(
+                        str(fontsty),
+                        None if truefont is None else str(truefont),
+                        {p.value: found.get(p, 0)[0] for p in CACHED_PROPS},
+                    )
             self.truefonts[fontsty] = truefont
             self.truefontsfc[fontsty] = found
-            self.fontcharsets[truefont] = found.get(fc.PROP.CHARSET, 0)[0]
         return self.truefonts[fontsty]
 
     def get_true_font_fullname(self, fontsty):
@@ -226,7 +326,20 @@ class FontConfig:
         truefont = self.truefonts[fontsty]
         cd1 = {k: truefont for k in chars if ord(k) in self.fontcharsets[truefont]}
 
+        if len(cd1) < len(chars) and self.rcache is not None:
+            # Fallbacks found on previous runs
+            cached = self.rcache.lookup_bychar(
+                str(fontsty), {c for c in chars if c not in cd1}
+            )
+            for c in chars:
+                if c in cached:
+                    tfstr = cached[c]
+                    truefont = None if tfstr is None else Style(tfstr)
+                    if truefont is None or self.load_charset(truefont):
+                        cd1[c] = truefont
+
         if len(cd1) < len(chars):
+            sorted_from = len(cd1)
             found = self.font_sort(fontsty)
             for fnt in found:
                 truefont = FontConfig.fcfont_to_css(fnt)
@@ -239,8 +352,42 @@ class FontConfig:
                     break
             if len(cd1) < len(chars):
                 cd1.update({c: None for c in chars if c not in cd1})
+            if self.rcache is not None:
+                new = dict(itertools.islice(cd1.items(), sorted_from, None))
+                for truefont in set(new.values()) - {None}:
+                    self.rcache.store_charset(str(truefont), self.fontcharsets[truefont])
+                self.rcache.store_bychar(
+                    str(fontsty),
+                    {c: None if v is None else str(v) for c, v in new.items()},
+                )
         return cd1
 
+    def get_font_signature(self, fontsty):
+        """
+        Identifies the font a style resolves to: its file, face index, and
+        variation, plus the file's size and modification time so that
+        changes to the font can be detected.
+        """
+        if fontsty not in self.truefontsfc:
+            self.get_true_font(fontsty)
+        found = self.truefontsfc[fontsty]
+        props = (
+            fc.PROP.FILE,
+            fc.PROP.INDEX,
+            fc.PROP.WEIGHT,
+            fc.PROP.WIDTH,
+            fc.PROP.SLANT,
+            fc.PROP.FONT_VARIATIONS,
+            fc.PROP.EMBOLDEN,
+        )
+        sig = tuple(found.get(prop, 0)[0] for prop in props)
+        try:
+            stat = os.stat(sig[0])
+            sig += (stat.st_size, stat.st_mtime)
+        except (OSError, TypeError):
+            sig += (None, None)
+        return sig
+
     @lru_cache(maxsize=None)
     def font_match(self, fontsty):
         """
@@ -271,7 +418,20 @@ class FontConfig:
             if fontsty not in self.truefontsfc:
                 self.get_true_font(fontsty)
             found = self.truefontsfc[fontsty]
-            self.truefontsft[fontsty] = FontToolsFontInstance(found)
+            # Styles that resolve to the same face share an instance
+            key = tuple(
+                found.get(p, 0)[0]
+                for p in (
+                    fc.PROP.FILE,
+                    fc.PROP.FAMILY,
+                    fc.PROP.WEIGHT,
+                    fc.PROP.SLANT,
+                    fc.PROP.WIDTH,
+                )
+            )
+            if key not in self.ftinstances:
+                self.ftinstances[key] = FontToolsFontInstance(found)
+            self.truefontsft[fontsty] = self.ftinstances[key]
         return self.truefontsft[fontsty]
 
     @staticmethod
@@ -685,6 +845,259 @@ class PangoRenderer:
         numunknown = self.pangolayout.get_unknown_glyphs_count()
         return wds, numunknown
 
+    def measure_blocks(self, sty, blocks):
+        """
+        Measure blocks of strings of a style in a single layout. Each block is
+        (strings, bare, prefix): its strings are separated by spaces and
+        followed by prefix, so each block is laid out as it would be by itself.
+        For each block, returns a list of boxes (x, y, w, h) in units of the
+        font size. Bare strings get the ink box of their first character, and
+        others their logical position and width. Returns None for every block
+        if the style can't be loaded.
+        """
+        success, metrics = self.set_text_style(sty)
+        if not success:
+            return [None] * len(blocks)
+        joinch = " "
+        texts, flags, modws = [], [], []
+        for mystrs, _, prefix in blocks:
+            # We need to render all the characters, but we don't
+            # need all of their extents. For most of them we just
+            # need the first character, unless the following string
+            # has length 1 (and may be differently differentially kerned)
+            modw = [
+                any(len(mystrs[i]) == 1 for i in range(i, i + 2) if 0 <= i < len(mystrs))
+                for i in range(len(mystrs))
+            ]
+            needexts = [
+                "1"
+                if len(s) == 1
+                else "1" + "0" * (len(s) - 2) + ("1" if modw[i] else "0")
+                for i, s in enumerate(mystrs)
+            ]
+            texts.append(joinch.join(mystrs) + joinch + prefix)
+            flags.append("0".join(needexts) + "1" + "1" * len(prefix))
+            modws.append(modw)
+        self.render_text(joinch.join(texts))
+        exts, _ = self.get_character_extents(metrics[1], "0".join(flags))
+
+        ret = []
+        start = 0
+        for (mystrs, bare, prefix), modw, text in zip(blocks, modws, texts):
+            spw = exts[start + len(text) - len(prefix) - 1][0][2]
+            boxes = []
+            cnt = start
+            x = 0
+            for i, mystr in enumerate(mystrs):
+                if modw[i]:
+                    wdt = (
+                        exts[cnt + len(mystr) - 1][0][0]
+                        + exts[cnt + len(mystr) - 1][0][2]
+                        - exts[cnt][0][0]
+                    )
+                else:
+                    wdt = exts[cnt + len(mystr) + 1][0][0] - exts[cnt][0][0] - spw
+
+                (xbr, ybr, wbr, hbr) = tuple(exts[cnt][2])
+                if not bare[i]:
+                    xbr = x
+                    wbr = wdt
+                    # use logical width
+                boxes.append([xbr, ybr, wbr, hbr])
+                cnt += len(mystr) + len(joinch)
+                x += wdt
+            ret.append(boxes)
+            start += len(text) + len(joinch)
+        return ret
+
+
+class PangoService:
+    """
+    A process-wide PangoRenderer that measures strings for any number of
+    threads. Requests are queued and handled by one thread, which renders all
+    pending requests of the same style in a single layout (identical requests
+    are rendered once). Concurrent measurements, e.g. from export threads,
+    thereby share one warmed font map instead of each making their own.
+
+    Threads don't survive a fork, so a service is only used by the process
+    that made it (see get_pango_service). This could not be tested against a
+    working Pango install, so measure_here is kept as a fallback for callers
+    whose requests fail.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.renderer = None
+        self.pid = os.getpid()
+
+    def submit(self, sty, strs, bare, prefix):
+        """
+        Request the boxes of strings of a style (see measure_blocks). Returns a
+        Future for the list of boxes, which is None if the style can't be loaded.
+        """
+        fut = concurrent.futures.Future()
+        self.queue.put((sty, (tuple(strs), tuple(bare), prefix), fut))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        return fut
+
+    def run(self):
+        """Handle requests, as many at a time as are waiting"""
+        while True:
+            reqs = [self.queue.get()]
+            while True:
+                try:
+                    reqs.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            bysty = dict()
+            for sty, block, fut in reqs:
+                bysty.setdefault(sty, dict()).setdefault(block, []).append(fut)
+            for sty, futs in bysty.items():
+                try:
+                    if self.renderer is None:
+                        self.renderer = PangoRenderer()
+                    results = self.renderer.measure_blocks(sty, list(futs))
+                except Exception as excp:  # pylint: disable=broad-except
+                    for bfuts in futs.values():
+                        for fut in bfuts:
+                            fut.set_exception(excp)
+                    continue
+                for bfuts, res in zip(futs.values(), results):
+                    for fut in bfuts:
+                        fut.set_result(res)
+
+    @staticmethod
+    def measure_here(sty, strs, bare, prefix):
+        """Measure like submit, but in the calling thread with its own renderer"""
+        block = (tuple(strs), tuple(bare), prefix)
+        return PangoRenderer().measure_blocks(sty, [block])[0]
+
+
+PSERVICE = None
+PSERVICE_LOCK = threading.Lock()
+
+
+def reset_pango_service():
+    """
+    Forget the shared PangoService in a forked child, whose copy has no thread
+    behind it (and whose lock may have been held by another parent thread).
+    """
+    global PSERVICE, PSERVICE_LOCK  # pylint: disable=global-statement
+    PSERVICE = None
+    PSERVICE_LOCK = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_pango_service)
+
+
+def get_pango_service():
+    """The shared PangoService of this process"""
+    global PSERVICE  # pylint: disable=global-statement
+    with PSERVICE_LOCK:
+        if PSERVICE is None or PSERVICE.pid != os.getpid():
+            PSERVICE = PangoService()
+    return PSERVICE
+
+
+INSTANCE_DIR = "si_font_instances"  # saved variable font instances
+
+
+def open_ttfont(fname, number=-1, lazy=True):
+    """
+    Open a font file (face number of a collection) as a FontTools font that
+    reads from a memory map of the file. Tables are only read and decompiled
+    when they are used, so large fonts (e.g. CJK) are never read in full.
+    """
+    from fontTools.ttLib import TTFont  # pylint: disable=no-name-in-module
+
+    with open(fname, "rb") as file:
+        try:
+            # Each font gets its own map, since reading moves its position
+            buf = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # e.g., empty files
+            buf = io.BytesIO(file.read())
+    return TTFont(buf, fontNumber=number, lazy=lazy)
+
+
+@lru_cache(maxsize=None)
+def collection_faces(fname, _mtime):
+    """
+    The faces of a TrueType collection, as a list of (OS/2 weight class,
+    OS/2 width class, is italic, family names). Only the OS/2 and name tables
+    of each face are read.
+    """
+    from fontTools.ttLib.sfnt import readTTCHeader
+
+    with open(fname, "rb") as file:
+        num_fonts = readTTCHeader(file).numFonts
+    faces = []
+    for i in range(num_fonts):
+        tfont = open_ttfont(fname, i)
+        subfamily = tfont["name"].getName(2, 3, 1, 1033)
+        subfamily = subfamily.toUnicode() if subfamily is not None else "Unknown"
+        faces.append(
+            (
+                tfont["OS/2"].usWeightClass,
+                tfont["OS/2"].usWidthClass,
+                (tfont["OS/2"].fsSelection & 1) != 0
+                or "italic" in subfamily.lower()
+                or "oblique" in subfamily.lower(),
+                [n.toUnicode() for n in tfont["name"].names if n.nameID == 1],
+            )
+        )
+        tfont.close()
+    return faces
+
+
+def variable_font_instance(fname, location):
+    """
+    A static instance of a variable font. Instances are saved in the temp
+    directory, since instantiating decompiles and rewrites every glyph, and
+    are reopened lazily on later runs.
+    """
+    from fontTools.ttLib import TTFont  # pylint: disable=no-name-in-module
+    from fontTools.varLib import mutator
+    import fontTools
+
+    stat = os.stat(fname)
+    key = repr(
+        (
+            os.path.abspath(fname),
+            stat.st_size,
+            stat.st_mtime,
+            sorted(location.items()),
+            fontTools.version,
+        )
+    )
+    idir = temp_path(INSTANCE_DIR)
+    iname = os.path.join(idir, hashlib.sha256(key.encode("utf-8")).hexdigest() + ".ttf")
+    if os.path.exists(iname):
+        try:
+            return open_ttfont(iname)
+        except Exception:  # pylint: disable=broad-except
+            pass  # damaged, make it again
+
+    font = mutator.instantiateVariableFont(
+        TTFont(fname, lazy=False), location, inplace=True
+    )
+    tmpname = iname + ".{0}.{1}.tmp".format(os.getpid(), threading.get_ident())
+    try:
+        os.makedirs(idir, exist_ok=True)
+        font.save(tmpname)
+        os.replace(tmpname, iname)
+    except Exception:  # pylint: disable=broad-except
+        # Not saved, but the instance can still be used
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+    return font
+
 
 # pylint:disable=import-outside-toplevel
 class FontToolsFontInstance:
@@ -707,18 +1120,19 @@ class FontToolsFontInstance:
         self.glyf = None
         self.glyph_names = None
         self.ligatures = None
+        self._pair_index = None
 
     @staticmethod
     def font_from_fc(found):
         """Find a FontTools font from a FontConfig font."""
         fname = found.get(fc.PROP.FILE, 0)[0]
 
-        from fontTools.ttLib import TTFont, TTLibFileIsCollectionError  # pylint: disable=no-name-in-module
+        from fontTools.ttLib import TTLibFileIsCollectionError  # pylint: disable=no-name-in-module
         import logging
 
         logging.getLogger("fontTools").setLevel(logging.ERROR)
         try:
-            font = TTFont(fname)
+            font = open_ttfont(fname)
 
             # If font has variants, get them
             if "fvar" in font:
@@ -732,9 +1146,7 @@ class FontToolsFontInstance:
                     elif axis.axisTag == "wdth":
                         location["wdth"] = fcwdt
                 if len(location) > 0:
-                    from fontTools.varLib import mutator
-
-                    font = mutator.instantiateVariableFont(font, location)
+                    font = variable_font_instance(fname, location)
 
         except TTLibFileIsCollectionError:
             # is TT collection
@@ -743,31 +1155,12 @@ class FontToolsFontInstance:
             fcsln = found.get(fc.PROP.SLANT, 0)[0]
             fcwdt = found.get(fc.PROP.WIDTH, 0)[0]
 
-            from fontTools.ttLib import TTCollection
-
-            collection = TTCollection(fname)
-            num_fonts = len(collection)
-            collection.close()
             num_match = []
-            for i in range(num_fonts):
-                tfont = TTFont(fname, fontNumber=i)
-                font_weight = tfont["OS/2"].usWeightClass
-                font_width = tfont["OS/2"].usWidthClass
-
-                subfamily = tfont["name"].getName(2, 3, 1, 1033)
-                subfamily = (
-                    subfamily.toUnicode() if subfamily is not None else "Unknown"
-                )
-                font_italic = (
-                    (tfont["OS/2"].fsSelection & 1) != 0
-                    or "italic" in subfamily.lower()
-                    or "oblique" in subfamily.lower()
-                )
-
+            for font_weight, font_width, font_italic, families in collection_faces(
+                fname, os.path.getmtime(fname)
+            ):
                 # nameID=1: font family name
-                familymatch = any(
-                    fcfam in n.toUnicode() for n in tfont["name"].names if n.nameID == 1
-                )
+                familymatch = any(fcfam in n for n in families)
                 widthmatch = C.OS2WDT_FCWDT[font_width] == fcwdt
                 weightmatch = (
                     interpolate_dict(C.OS2WGT_FCWGT, font_weight, None) == fcwgt
@@ -779,15 +1172,9 @@ class FontToolsFontInstance:
                     sum([weightmatch, widthmatch, slantmatch, familymatch])
                 )
                 if num_match[-1] == 4:
-                    font = tfont
                     break
-            if max(num_match) < 4:
-                # Did not find a perfect match
-                font = [
-                    TTFont(fname, fontNumber=i)
-                    for i in range(num_fonts)
-                    if num_match[i] == max(num_match)
-                ][0]
+            # First perfect match, or the first best match
+            font = open_ttfont(fname, num_match.index(max(num_match)))
         return font
 
     def find_font_metrics(self):
@@ -849,9 +1236,8 @@ class FontToolsFontInstance:
         else:
             self.cap_height = 1
 
-    def get_char_advances(self, chars, pchars):
-        """Get the advance width and bounding boxes of characters."""
-        units_per_em = self.head.unitsPerEm
+    def load_tables(self):
+        """Load the tables needed for character advances, if not already."""
         if self.cmap is None:
             self.cmap = self.font.getBestCmap()
         if self.hmtx is None:
@@ -874,6 +1260,11 @@ class FontToolsFontInstance:
                         self.cmap[codepoint] = name
                         self.cmap[codepoint - 15 * 4096] = name
 
+    def get_char_advances(self, chars, pchars):
+        """Get the advance width and bounding boxes of characters."""
+        units_per_em = self.head.unitsPerEm
+        self.load_tables()
+
         advs = dict()
         bbs = dict()
         for c in chars:
@@ -897,6 +1288,14 @@ class FontToolsFontInstance:
             else:
                 advs[c] = None
 
+        dadvs = dict()
+        for c in pchars:
+            for pchar in pchars[c]:
+                dadvs[(pchar, c)] = self.get_pair_advance(pchar, c)
+        return advs, dadvs, bbs
+
+    def load_ligatures(self):
+        """Find the font's standard ligatures, if not already."""
         # Get ligature table (made with LLM help)
         # Reference: https://learn.microsoft.com/en-us/typography/opentype/spec/gsub
         if self.ligatures is None:
@@ -940,33 +1339,183 @@ class FontToolsFontInstance:
             else:
                 self.ligatures = dict()
 
-        dadvs = dict()
-        for c in pchars:
-            glyph2 = self.cmap.get(ord(c))
-            for pchar in pchars[c]:
-                glyph1 = self.cmap.get(ord(pchar))
-                kerning_value = None
-                if (glyph1, glyph2) in self.ligatures:
-                    ligglyph = self.ligatures[(glyph1, glyph2)]
-                    awlig, _ = self.hmtx.metrics[ligglyph]
-                    aw1, _ = self.hmtx.metrics[glyph1]
-                    aw2, _ = self.hmtx.metrics[glyph2]
-                    kerning_value = awlig - aw1 - aw2
-                else:
-                    if self.kern is not None:
-                        for subtable in self.kern.kernTables:
-                            kerning_value = subtable.kernTable.get((glyph1, glyph2))
-                            if kerning_value is not None:
-                                break
-                if kerning_value is None:
-                    kerning_value = 0
-                dadvs[(pchar, c)] = kerning_value / units_per_em
-        return advs, dadvs, bbs
+    @property
+    def pair_index(self):
+        """The font's pair kerning, read on first use."""
+        if self._pair_index is None:
+            self._pair_index = PairIndex(self.font)
+        return self._pair_index
+
+    def get_pair_advance(self, pchar, c):
+        """
+        Get the differential advance of a character when preceded by pchar
+        (the change in their combined advance due to kerning or ligatures).
+        """
+        self.load_tables()
+        self.load_ligatures()
+        glyph1 = self.cmap.get(ord(pchar))
+        glyph2 = self.cmap.get(ord(c))
+        if (glyph1, glyph2) in self.ligatures:
+            ligglyph = self.ligatures[(glyph1, glyph2)]
+            awlig, _ = self.hmtx.metrics[ligglyph]
+            aw1, _ = self.hmtx.metrics[glyph1]
+            aw2, _ = self.hmtx.metrics[glyph2]
+            kerning_value = awlig - aw1 - aw2
+        else:
+            kerning_value = self.pair_index.get(glyph1, glyph2)
+        return kerning_value / self.head.unitsPerEm
+
+    def needs_layout(self, pchar, c):
+        """
+        Whether a character pair's differential advance needs to be found by
+        rendering, since shaping may do things the pair tables don't describe.
+        """
+        self.load_tables()
+        self.load_ligatures()
+        glyph1 = self.cmap.get(ord(pchar))
+        glyph2 = self.cmap.get(ord(c))
+        return (
+            glyph1 is None
+            or glyph2 is None
+            or not self.pair_index.complete
+            or (glyph1, glyph2) in self.ligatures
+        )
 
 
 # pylint:enable=import-outside-toplevel
 
 
+class PairIndex:
+    """
+    A compact index of a font's pair kerning, read once from the 'kern'
+    lookups of its GPOS table (or from its legacy kern table if there are none).
+    Individual pairs are stored as sorted arrays of glyph id pair keys and
+    values; class-based pairs as arrays of glyph classes and a value matrix.
+    Values are in font units.
+    """
+
+    PAIRS, CLASSES = 0, 1
+
+    def __init__(self, font):
+        self.gids = font.getReverseGlyphMap()
+        self.nglyphs = len(self.gids)
+        self.lookups = []
+        # each a list of subtables, of which the first to apply is used
+        self.complete = True
+        # False if the font kerns or substitutes in ways not read here
+
+        gpos = font["GPOS"].table if "GPOS" in font else None
+        lidxs = set()
+        if gpos is not None and gpos.FeatureList is not None:
+            for frec in gpos.FeatureList.FeatureRecord:
+                if frec.FeatureTag == "kern":
+                    lidxs.update(frec.Feature.LookupListIndex)
+        if len(lidxs) > 0:
+            for lidx in sorted(lidxs):
+                lookup = gpos.LookupList.Lookup[lidx]
+                subtables = []
+                for subtable in lookup.SubTable:
+                    lookup_type = lookup.LookupType
+                    if lookup_type == 9:  # Extension positioning
+                        lookup_type = subtable.ExtensionLookupType
+                        subtable = subtable.ExtSubTable
+                    if lookup_type != 2:  # not pair positioning
+                        self.complete = False
+                    elif subtable.Format == 1:
+                        subtables.append(self.read_pairs(subtable))
+                    elif subtable.Format == 2:
+                        subtables.append(self.read_classes(subtable))
+                self.lookups.append(subtables)
+        elif "kern" in font:
+            subtables = []
+            for ktable in font["kern"].kernTables:
+                if getattr(ktable, "format", None) != 0:
+                    self.complete = False
+                    continue
+                pairs = [
+                    (self.gids[g1] * self.nglyphs + self.gids[g2], val)
+                    for (g1, g2), val in ktable.kernTable.items()
+                    if g1 in self.gids and g2 in self.gids
+                ]
+                subtables.append(self.make_pairs(pairs))
+            self.lookups.append(subtables)
+
+        if "GSUB" in font and font["GSUB"].table.FeatureList is not None:
+            for frec in font["GSUB"].table.FeatureList.FeatureRecord:
+                if frec.FeatureTag == "calt":  # contextual alternates
+                    self.complete = False
+
+    @staticmethod
+    def xadvance(val1, val2):
+        """Total advance change of a pair's value records"""
+        return (getattr(val1, "XAdvance", 0) or 0) + (
+            getattr(val2, "XAdvance", 0) or 0
+        )
+
+    def make_pairs(self, pairs):
+        """Make a sorted pair subtable from a list of (key, value)"""
+        arr = np.array(pairs, dtype=float).reshape(-1, 2)
+        order = np.argsort(arr[:, 0], kind="stable")
+        return (PairIndex.PAIRS, arr[order, 0].astype(np.int64), arr[order, 1])
+
+    def read_pairs(self, subtable):
+        """Read a PairPos format 1 subtable (individual glyph pairs)"""
+        pairs = []
+        for glyph1, pset in zip(subtable.Coverage.glyphs, subtable.PairSet):
+            gid1 = self.gids[glyph1]
+            for pvr in pset.PairValueRecord:
+                val = self.xadvance(
+                    getattr(pvr, "Value1", None), getattr(pvr, "Value2", None)
+                )
+                pairs.append((gid1 * self.nglyphs + self.gids[pvr.SecondGlyph], val))
+        return self.make_pairs(pairs)
+
+    def read_classes(self, subtable):
+        """Read a PairPos format 2 subtable (pairs of glyph classes)"""
+        covered = np.zeros(self.nglyphs, dtype=bool)
+        covered[[self.gids[g] for g in subtable.Coverage.glyphs]] = True
+        cls1 = np.zeros(self.nglyphs, dtype=np.int32)
+        cls2 = np.zeros(self.nglyphs, dtype=np.int32)
+        for cls, cdef in ((cls1, subtable.ClassDef1), (cls2, subtable.ClassDef2)):
+            if cdef is not None:
+                for glyph, val in cdef.classDefs.items():
+                    cls[self.gids[glyph]] = val
+        mat = np.array(
+            [
+                [
+                    self.xadvance(
+                        getattr(c2r, "Value1", None), getattr(c2r, "Value2", None)
+                    )
+                    for c2r in c1r.Class2Record
+                ]
+                for c1r in subtable.Class1Record
+            ],
+            dtype=float,
+        ).reshape(subtable.Class1Count, subtable.Class2Count)
+        return (PairIndex.CLASSES, covered, cls1, cls2, mat)
+
+    def get(self, glyph1, glyph2):
+        """Kerning of a pair of glyphs (by name), in font units"""
+        gid1 = self.gids.get(glyph1)
+        gid2 = self.gids.get(glyph2)
+        if gid1 is None or gid2 is None:
+            return 0
+        key = gid1 * self.nglyphs + gid2
+        ret = 0
+        for subtables in self.lookups:
+            for sub in subtables:
+                if sub[0] == PairIndex.PAIRS:
+                    keys, vals = sub[1], sub[2]
+                    pos = np.searchsorted(keys, key)
+                    if pos < len(keys) and keys[pos] == key:
+                        ret += vals[pos]
+                        break
+                elif sub[1][gid1]:
+                    ret += sub[4][sub[2][gid1], sub[3][gid2]]
+                    break
+        return float(ret)
+
+
 class Conversions:
     """
     Conversions between CSS, FontConfig, Pango, and OS2 font attributes
@@ -0,0 +1,129 @@
+# coding=utf-8
+#
+# Copyright (c) 2023 David Burghoff <burghoff@utexas.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Persistent cache of character metrics
+
+Measuring characters (by rendering them with Pango or reading the font with
+fontTools) gives the same results for the same font every time, but was
+repeated on every run of an extension. This module stores the metrics in an
+SQLite database so that later runs only measure characters they have not
+seen before.
+
+Entries are grouped by a font key that identifies both the true style and
+the font file it resolves to (including the file's modification time), so
+updating or replacing a font invalidates its entries.
+"""
+
+import sqlite3
+import threading
+from inkex.text.utils import temp_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS fonts (
+    font TEXT PRIMARY KEY, spacew REAL, caph REAL
+);
+CREATE TABLE IF NOT EXISTS chars (
+    font TEXT, c TEXT, charw REAL, x REAL, y REAL, w REAL, h REAL,
+    PRIMARY KEY (font, c)
+);
+CREATE TABLE IF NOT EXISTS pairs (
+    font TEXT, p TEXT, c TEXT, dadv REAL,
+    PRIMARY KEY (font, p, c)
+);
+"""
+DB_NAME = "si_glyph_metrics_v1.sqlite"
+
+
+class GlyphMetricsCache:
+    """An SQLite store of character advances, ink bboxes, and kerning."""
+
+    def __init__(self, path=None):
+        self.path = temp_path(DB_NAME) if path is None else path
+        self.local = threading.local()  # connections can't be shared by threads
+        self.connect()
+
+    def connect(self):
+        """Get this thread's connection, making the tables if needed."""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript(SCHEMA)
+            self.local.conn = conn
+        return conn
+
+    def lookup(self, font, chars, pairs):
+        """
+        Find cached metrics for a font. Returns (fprops, cprops, pprops):
+        fprops is (space width, cap height) or None, cprops maps characters to
+        (advance, ink bbox), and pprops maps (preceding, next) character pairs
+        to differential advances. Only requested entries that exist are returned.
+        """
+        conn = self.connect()
+        row = conn.execute(
+            "SELECT spacew, caph FROM fonts WHERE font=?", (font,)
+        ).fetchone()
+        if row is None:
+            return None, dict(), dict()
+        cprops = dict()
+        for c, charw, x, y, w, h in conn.execute(
+            "SELECT c, charw, x, y, w, h FROM chars WHERE font=?", (font,)
+        ):
+            if c in chars:
+                cprops[c] = (charw, [x, y, w, h])
+        pprops = dict()
+        if len(pairs) > 0:
+            for p, c, dadv in conn.execute(
+                "SELECT p, c, dadv FROM pairs WHERE font=?", (font,)
+            ):
+                if (p, c) in pairs:
+                    pprops[p, c] = dadv
+        return tuple(row), cprops, pprops
+
+    def store(self, font, fprops, cprops, pprops):
+        """Add metrics for a font, in the format returned by lookup."""
+        conn = self.connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO fonts VALUES (?, ?, ?)", (font,) + tuple(fprops)
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO chars VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(font, c, cw, *inkbb) for c, (cw, inkbb) in cprops.items()],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO pairs VALUES (?, ?, ?, ?)",
+                [(font, p, c, dadv) for (p, c), dadv in pprops.items()],
+            )
+
+
+GCACHE = None
+GCACHE_LOCK = threading.Lock()
+
+
+def get_glyph_cache():
+    """The shared cache, or None if the database can't be used."""
+    global GCACHE  # pylint: disable=global-statement
+    with GCACHE_LOCK:
+        if GCACHE is None:
+            try:
+                GCACHE = GlyphMetricsCache()
+            except (sqlite3.Error, OSError):
+                GCACHE = False
+    return GCACHE if GCACHE else None
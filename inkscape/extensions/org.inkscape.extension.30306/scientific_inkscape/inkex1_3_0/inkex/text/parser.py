@@ -46,10 +46,15 @@ which draws rectangles that tell you where the extents / bboxes are. For example
 - el.parsed_text.make_highlights('fullink') : shows the bbox of the whole element
 """
 
+import io
+import os
 import itertools
 import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from copy import copy
 import threading
+import sqlite3
 import lxml
 import numpy as np
 import inkex
@@ -73,17 +78,24 @@ from inkex.text.utils import (
     bbox,
 )
 from inkex.text.font_properties import (
-    PangoRenderer,
+    get_pango_service,
     HASPANGO,
     fcfg,
     font_style,
     true_style,
 )
+from inkex.text.glyph_cache import get_glyph_cache
 from inkex.utils import debug
 
 DIFF_ADVANCES = True  # generate a differential advances table for each font?
+GLYPH_CACHE = True  # keep measured character metrics between runs?
+LAZY_KERNING = True  # read differential advances from the font's pair tables?
 TEXTSIZE = 100  # size of rendered text
 DEPATHOLOGIZE = True  # clean up pathological atts not normally made by Inkscape
+# Parse in worker processes when there are at least this many elements. Off
+# by default: startup, pickling, and rebuilding the results cost about as much
+# as serial parsing, and elements that parsing modifies are parsed again.
+PARALLEL_MIN = None
 
 EBget = lxml.etree.ElementBase.get
 EBset = lxml.etree.ElementBase.set
@@ -104,15 +116,39 @@ class ParsedTextList(list):
     characters (e.g., from PDFs).
     """
 
-    def __init__(self, els):
-        """Initializes ParsedTextList with a list of elements."""
+    def __init__(self, els, processes=None):
+        """
+        Initializes ParsedTextList with a list of elements. They are parsed
+        in worker processes if processes > 1, or if processes is None and
+        PARALLEL_MIN is set and reached.
+        """
+        if processes is None:
+            processes = 1
+            if (
+                PARALLEL_MIN is not None
+                and len(els) >= PARALLEL_MIN
+                and multiprocessing.current_process().name == "MainProcess"
+            ):
+                # Not in a worker (e.g. the Autoexporter's pool), which would
+                # be one of many running in parallel
+                processes = min(os.cpu_count() or 1, 8)
+        if processes > 1:
+            parse_parallel(
+                [el for el in els if not hasattr(el, "_parsed_text")], processes
+            )
         super().__init__([el.parsed_text for el in els])
 
-    def precalcs(self):
+    def precalcs(self, chks=None):
         """
         Calculate parsed_bb, parsed_pts_ut, parsed_pts_t for all chunks
-        simultaneously
+        simultaneously. Character values are kept in a TextArrays (self.arrays),
+        which the characters' parsed points are views of.
+        If chks is given, only the current positions of those chunks are
+        recomputed in place (see recompute_chunks); parsed points are kept.
         """
+        if chks is not None:
+            self.recompute_chunks(chks)
+            return
         tws = [chk for ptxt in self for line in ptxt.lns for chk in line.chks]
         nchrs = sum(chk.ncs for chk in tws)
 
@@ -204,6 +240,10 @@ class ParsedTextList(list):
             np.vstack(vmult(mat, rx2, by2)),
         ]
 
+        self.arrays = TextArrays(tws, idx_ncs, cwd, dxeff, dy, bshft, caph)
+        self.arrays.cpts_ut = np.stack(cpts_ut, axis=1)
+        self.arrays.cpts_t = np.stack(cpts_t, axis=1)
+
         # pylint:disable=protected-access
         # Split outputs into lists of column vectors
         # maxerr = float('-inf')
@@ -231,25 +271,278 @@ class ParsedTextList(list):
             ]
 
             for j, c in enumerate(chk.chrs):
-                c.parsed_pts_ut = [
-                    (float(chk._cpts_ut[0][j][0]), float(chk._cpts_ut[0][j][1])),
-                    (float(chk._cpts_ut[1][j][0]), float(chk._cpts_ut[1][j][1])),
-                    (float(chk._cpts_ut[2][j][0]), float(chk._cpts_ut[2][j][1])),
-                    (float(chk._cpts_ut[3][j][0]), float(chk._cpts_ut[3][j][1])),
-                ]
-                c.parsed_pts_t = [
-                    (float(chk._cpts_t[0][j][0]), float(chk._cpts_t[0][j][1])),
-                    (float(chk._cpts_t[1][j][0]), float(chk._cpts_t[1][j][1])),
-                    (float(chk._cpts_t[2][j][0]), float(chk._cpts_t[2][j][1])),
-                    (float(chk._cpts_t[3][j][0]), float(chk._cpts_t[3][j][1])),
-                ]
+                c._arrs = self.arrays
+                c._row = idx_ncs[i] + j
+                c._ppts_ut = c._ppts_t = None
+        for ptxt in self:
+            for line in ptxt.lns:
+                line.dirty = False
         # pylint:enable=protected-access
-    
+
+    def recompute_chunks(self, chks):
+        """
+        Recompute the current positions and extents of chks together, after
+        edits have invalidated them. Values are the same as TChunk.charpos
+        would compute one chunk at a time.
+        """
+        chks = [chk for chk in chks if chk.ncs > 0]
+        if len(chks) == 0:
+            return
+        ncs = np.array([chk.ncs for chk in chks])
+        idx_ncs = np.concatenate(([0], np.cumsum(ncs)))
+        starts, stops = idx_ncs[:-1], idx_ncs[1:] - 1
+        widx = np.repeat(np.arange(len(chks)), ncs)
+
+        def column(att):
+            # dxeff has an extra entry for the letter spacing after the chunk
+            return np.fromiter(
+                itertools.chain.from_iterable(
+                    itertools.islice(getattr(chk, att), chk.ncs) for chk in chks
+                ),
+                dtype=float,
+                count=idx_ncs[-1],
+            )
+
+        cwd, dxeff, dy, bshft, caph = (
+            column(att) for att in ("cwd", "dxeff", "dy", "bshft", "caph")
+        )
+        dadv = np.zeros(idx_ncs[-1], dtype=float)
+        if DIFF_ADVANCES:
+            for j, chk in enumerate(chks):
+                for i in range(1, chk.ncs):
+                    dadv[starts[j] + i] = chk.chrs[i].dadvs(
+                        chk.chrs[i - 1].c, chk.chrs[i].c
+                    ) * (chk.dxeff[i] == 0)
+
+        # Accumulate within each chunk (sequentially, as charpos does)
+        wds = cwd + dxeff + dadv
+        cstop = np.concatenate([np.cumsum(v) for v in np.split(wds, idx_ncs[1:-1])])
+        cstrt = cstop - cwd
+        adyl = np.concatenate([np.cumsum(v) for v in np.split(dy, idx_ncs[1:-1])])
+
+        unsp = np.array([chk.unrenderedspace for chk in chks], dtype=float)
+        anfr = np.array([chk.line.anchfrac for chk in chks], dtype=float)
+        chkx = np.array([chk.x for chk in chks], dtype=float)
+        chky = np.array([chk.y for chk in chks], dtype=float)
+        offx = -anfr * (cstop[stops] - unsp * cwd[stops])
+        lftx = chkx[widx] + cstrt + offx[widx]
+        rgtx = chkx[widx] + cstop + offx[widx]
+        btmy = chky[widx] + adyl - bshft
+        topy = btmy - caph
+
+        lx2 = np.minimum.reduceat(lftx, starts) - dxeff[starts]
+        rx2 = lx2 + cstop[stops]
+        by2 = np.maximum.reduceat(btmy, starts)
+        ty2 = np.minimum.reduceat(topy, starts)
+
+        m00, m01, m02, m10, m11, m12 = (
+            np.array([chk.transform.matrix[i][j] for chk in chks], dtype=float)
+            for i in (0, 1)
+            for j in (0, 1, 2)
+        )
+        mat = ((m00[widx], m01[widx], m02[widx]), (m10[widx], m11[widx], m12[widx]))
+        cpts_ut = [
+            np.stack((lftx, btmy), axis=1),
+            np.stack((lftx, topy), axis=1),
+            np.stack((rgtx, topy), axis=1),
+            np.stack((rgtx, btmy), axis=1),
+        ]
+        cpts_t = [
+            np.stack(vmult(mat, lftx, btmy), axis=1),
+            np.stack(vmult(mat, lftx, topy), axis=1),
+            np.stack(vmult(mat, rgtx, topy), axis=1),
+            np.stack(vmult(mat, rgtx, btmy), axis=1),
+        ]
+        mat = ((m00, m01, m02), (m10, m11, m12))
+        pts_t = [
+            vmult(mat, lx2, by2),
+            vmult(mat, lx2, ty2),
+            vmult(mat, rx2, ty2),
+            vmult(mat, rx2, by2),
+        ]
+
+        # pylint:disable=protected-access
+        for i, chk in enumerate(chks):
+            sli = slice(idx_ncs[i], idx_ncs[i + 1])
+            lx2i, rx2i, by2i, ty2i = (
+                float(lx2[i]),
+                float(rx2[i]),
+                float(by2[i]),
+                float(ty2[i]),
+            )
+            chk._charpos = (
+                lftx[sli, np.newaxis],
+                rgtx[sli, np.newaxis],
+                btmy[sli, np.newaxis],
+                topy[sli, np.newaxis],
+                lx2i,
+                rx2i,
+                by2i,
+                ty2i,
+            )
+            chk._cpts_ut = [cpv[sli] for cpv in cpts_ut]
+            chk._cpts_t = [cpv[sli] for cpv in cpts_t]
+            chk._pts_ut = [(lx2i, by2i), (lx2i, ty2i), (rx2i, ty2i), (rx2i, by2i)]
+            chk._pts_t = [(float(x[i]), float(y[i])) for x, y in pts_t]
+            chk._bb = None
+        # pylint:enable=protected-access
+
+    def dirty_chunks(self):
+        """
+        Chunks whose positions have been invalidated since they were last
+        computed. Only lines marked as dirty are checked, and are then cleared.
+        """
+        ret = []
+        for ptxt in self:
+            if ptxt.lns is None:
+                continue
+            for line in ptxt.lns:
+                if line.dirty:
+                    # pylint:disable=protected-access
+                    ret += [chk for chk in line.chks if chk._charpos is None]
+                    line.dirty = False
+        return ret
+
+    def update_positions(self):
+        """Recompute the positions of all chunks that have been edited"""
+        self.precalcs(self.dirty_chunks())
+
     def make_next_chain(self):
         for pt in self:
             pt.make_next_chain()
 
 
+class TextArrays:
+    """
+    Columnar storage of the characters of a ParsedTextList, made by precalcs.
+    Row k is the kth character in chunk order, and chunk i owns rows
+    starts[i]:starts[i+1]. Columns are untransformed advances (cwd), effective
+    dx (dxeff), dy, baseline shift, and cap height, indices into lists of
+    unique true fonts (fidx, fonts) and styles (sidx, styles), and the corner
+    points of each character (cpts_ut and cpts_t, n x 4 x 2, ordered
+    bottom-left, top-left, top-right, bottom-right).
+    """
+
+    __slots__ = (
+        "chks",
+        "starts",
+        "cwd",
+        "dxeff",
+        "dy",
+        "bshft",
+        "caph",
+        "fidx",
+        "fonts",
+        "sidx",
+        "styles",
+        "cpts_ut",
+        "cpts_t",
+    )
+
+    def __init__(self, chks, starts, cwd, dxeff, dy, bshft, caph):
+        """Initializes TextArrays from chunks and their character columns."""
+        self.chks = chks
+        self.starts = np.asarray(starts)
+        self.cwd, self.dxeff, self.dy, self.bshft, self.caph = (
+            cwd,
+            dxeff,
+            dy,
+            bshft,
+            caph,
+        )
+        fonts, stys = dict(), dict()
+        chrs = [c for chk in chks for c in chk.chrs]
+        self.fidx = np.array(
+            [fonts.setdefault(c.tsty, len(fonts)) for c in chrs], dtype=np.int32
+        )
+        self.sidx = np.array(
+            [stys.setdefault(c.sty, len(stys)) for c in chrs], dtype=np.int32
+        )
+        self.fonts = list(fonts)
+        self.styles = list(stys)
+        self.cpts_ut = self.cpts_t = None
+
+    def chunk_slice(self, i):
+        """Rows belonging to the ith chunk"""
+        return slice(self.starts[i], self.starts[i + 1])
+
+
+WORKER_STATE = dict()
+
+
+def parse_worker_init(svgbytes, ctable):
+    """Loads a copy of the document in a worker process for parse_parallel"""
+    svg = inkex.load_svg(io.BytesIO(svgbytes)).getroot()
+    ctable.root = svg
+    svg._char_table = ctable  # pylint: disable=protected-access
+    WORKER_STATE["els"] = list(svg.iter())
+
+
+def parse_worker(idxs):
+    """Parses elements (by document position) and describes them"""
+    els = WORKER_STATE["els"]
+    ret = []
+    for idx in idxs:
+        elem = els[idx]
+        before = lxml.etree.tostring(elem)
+        ptxt = elem.parsed_text
+        if ptxt.isflow or lxml.etree.tostring(elem) != before:
+            # Flows and text modified by parsing are left to the main process
+            ret.append(None)
+        else:
+            ret.append(ptxt.describe())
+    return ret
+
+
+def parse_parallel(els, processes):
+    """
+    Parse text elements in worker processes, setting their parsed_text.
+    Each worker loads its own copy of the document and a copy of the character
+    table, and returns compact descriptions of its elements' lines and
+    characters. These are rebuilt into ParsedText objects here, which skips
+    the style and position resolution done by parse_lines. Elements that can't
+    be handled this way are left to be parsed normally.
+    """
+    if len(els) == 0:
+        return
+    root = els[0].croot
+    ctable = root.char_table
+    pos = {el: i for i, el in enumerate(root.iter())}
+    idxs = [pos[el] for el in els if el in pos]
+    nshards = min(len(idxs), processes * 4)
+    shards = [
+        idxs[i * len(idxs) // nshards : (i + 1) * len(idxs) // nshards]
+        for i in range(nshards)
+    ]
+
+    # Unlike multiprocessing.Pool, which respawns workers forever when they
+    # fail to start, an executor is marked broken and raises
+    try:
+        with ProcessPoolExecutor(
+            processes,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=parse_worker_init,
+            initargs=(lxml.etree.tostring(root), ctable),
+        ) as pool:
+            descs = list(pool.map(parse_worker, shards))
+    except Exception:  # pylint: disable=broad-except
+        # Process creation can fail in restricted environments, and workers
+        # can fail to start (BrokenProcessPool). Everything is then parsed
+        # serially.
+        return
+
+    byidx = {i: el for el, i in pos.items()}
+    for shard, sdescs in zip(shards, descs):
+        for idx, desc in zip(shard, sdescs):
+            if desc is not None:
+                elem = byidx[idx]
+                try:
+                    ptxt = ParsedText.from_description(elem, ctable, desc)
+                except KeyError:
+                    continue
+                elem._parsed_text = ptxt  # pylint: disable=protected-access
+
+
 def vmult(mat, x, y):
     """Multiplies mat times (x;y) in a way compatible with vectorization"""
     return (
@@ -311,6 +604,109 @@ class ParsedText:
         self.ismlinkscape = self.isinkscape and len(self.lns) > 1
         # multi-line Inkscape
 
+    def describe(self):
+        """
+        Describes the lines and characters as plain lists, which can be
+        pickled and rebuilt with from_description. Elements are given by their
+        index in tree.dds and styles by their index in a list of styles.
+        """
+        dds = self.tree.dds
+        ddi = {ddv: i for i, ddv in enumerate(dds)}
+        stys = dict()
+
+        def styi(sty):
+            return stys.setdefault(sty, len(stys))
+
+        lines = [
+            (
+                line._xv,  # pylint: disable=protected-access
+                line._yv,  # pylint: disable=protected-access
+                ddi[line.xsrc],
+                ddi[line.ysrc],
+                line.sprl,
+                [ddi[sa] for sa in line.sprlabove],
+                line.anchor,
+                line.transform,
+                line.tlvlno,
+                styi(line.style),
+                line.continuex,
+                line.continuey,
+            )
+            for line in self.lns
+        ]
+        lnis = {line: i for i, line in enumerate(self.lns)}
+        chrs = self.chrs
+        cols = (
+            [lnis[c.line] for c in chrs],
+            [c.c for c in chrs],
+            [c.tfs for c in chrs],
+            [c.utfs for c in chrs],
+            [styi(c.sty) for c in chrs],
+            [styi(c.tsty) for c in chrs],
+            [styi(c.fsty) for c in chrs],
+            [ddi[c.loc.elem] for c in chrs],
+            [c.loc.typ for c in chrs],
+            [c.loc.ind for c in chrs],
+            [c.dx for c in chrs],
+            [c.dy for c in chrs],
+            [c.lsp for c in chrs],
+            [c.bshft for c in chrs],
+        )
+        return list(stys), lines, cols, (self.isinkscape, self.ismlinkscape)
+
+    @staticmethod
+    def from_description(elem, ctable, desc):
+        """Rebuilds a ParsedText from a description made by describe"""
+        stys, lines, cols, flags = desc
+        ret = ParsedText.__new__(ParsedText)
+        ret.ctable = ctable
+        ret.textel = elem
+        ret.isflow = False
+        ret._tree = None
+        ret.dchange, ret.writtendx, ret.writtendy = [None] * 3
+        ret.achange = False
+
+        dds = ret.tree.dds
+        ret.lns = []
+        for x, y, xsrc, ysrc, sprl, sprlabove, anch, xform, tlvlno, sty, cx, cy in lines:
+            TLine(
+                ret,
+                x,
+                y,
+                dds[xsrc],
+                dds[ysrc],
+                sprl,
+                [dds[i] for i in sprlabove],
+                anch,
+                xform,
+                tlvlno,
+                stys[sty],
+                cx,
+                cy,
+            )
+        lns = ret.lns
+        for lni, c, tfs, utfs, sty, tsty, fsty, eli, typ, ind, dx, dy, lsp, bshft in zip(
+            *cols
+        ):
+            TChar(
+                c,
+                tfs,
+                utfs,
+                ctable.get_prop(c, stys[tsty]),
+                stys[sty],
+                stys[tsty],
+                CLoc(dds[eli], typ, ind),
+                lns[lni],
+                dx,
+                dy,
+                fsty=stys[fsty],
+                lsp=lsp,
+                bshft=bshft,
+            )
+        ret.finish_lines()
+        ret.isinkscape, ret.ismlinkscape = flags
+        return ret
+
     def duplicate(self):
         """Duplicates a PT and its text without reparsing"""
         ret = copy(self)
@@ -2114,6 +2510,7 @@ class TLine:
         "effabsp",
         "effbbsp",
         "broken",
+        "dirty",
     )
 
     def __init__(
@@ -2164,6 +2561,7 @@ class TLine:
         self.broken = None  # text is broken
         self.effabsp = None  # above-baseline space
         self.effbbsp = None  # below-baseline space
+        self.dirty = True  # some chunk positions need to be computed
         ptxt.lns.append(self)
 
     def copy(self, memo):
@@ -2190,6 +2588,7 @@ class TLine:
         ret.broken = self.broken
         ret.effabsp = self.effabsp  # above-baseline space
         ret.effbbsp = self.effbbsp  # below-baseline space
+        ret.dirty = self.dirty
 
         return ret
 
@@ -2722,7 +3121,7 @@ class TChunk:
                 # Update the style
                 newsty = None
                 if c.sty != newc.sty or ntype in ["super", "sub"] or abs(c.scf - newc.scf)>1e-4:
-                    newsty = c.sty
+                    newsty = c.sty.copy()
                     if ntype in ["super", "sub"]:
                         # newsty = c.sty
                         # Nativize super/subscripts
@@ -2912,6 +3311,7 @@ class TChunk:
         """Sets the character positions and invalidates dependent properties."""
         if svi is None:  # invalidate self and dependees
             self._charpos = None
+            self.line.dirty = True
             self.pts_ut = None
             self.cpts_ut = None
             self.cpts_t = None
@@ -3033,8 +3433,42 @@ class TChunk:
 class TChar:
     """Represents a single character and its style."""
 
-    def __init__(self, c, tfs, utfs, prop, sty, tsty, loc, line, dx, dy):
-        """Initializes TChar with given parameters."""
+    __slots__ = (
+        "c",
+        "tfs",
+        "utfs",
+        "prop",
+        "cwd",
+        "_sty",
+        "tsty",
+        "fsty",
+        "loc",
+        "caph",
+        "spw",
+        "line",
+        "lnindex",
+        "chk",
+        "windex",
+        "_dx",
+        "_dy",
+        "_ax",
+        "_ay",
+        "_ppts_ut",
+        "_ppts_t",
+        "_arrs",
+        "_row",
+        "_lsp",
+        "_bshft",
+        "lhs",
+    )
+
+    def __init__(
+        self, c, tfs, utfs, prop, sty, tsty, loc, line, dx, dy, **known
+    ):
+        """
+        Initializes TChar with given parameters. Values of fsty, lsp, and bshft
+        that are already known can be passed as keywords.
+        """
         self.c = c
         self.tfs = tfs
         # transformed font size (uu)
@@ -3048,7 +3482,7 @@ class TChar:
         # actual style
         self.tsty = tsty
         # true font style
-        self.fsty = font_style(sty)
+        self.fsty = known["fsty"] if "fsty" in known else font_style(sty)
         # font style
         self.loc = loc
         # true location: [parent, TYP_TEXT or TYP_TAIL, index]
@@ -3068,12 +3502,17 @@ class TChar:
         self._dy = dy
         self._ax = None
         self._ay = None
-        self.dadvs = lambda cL, cR: prop.dadvs.get((cL, cR), 0) * utfs
-        self.parsed_pts_t = None
-        self.parsed_pts_ut = None
+        self._ppts_t = None
+        self._ppts_ut = None
+        self._arrs = None
+        self._row = None
         # for merging later
-        self._lsp = TChar.lspfunc(self.sty)
-        self._bshft = TChar.bshftfunc(self.sty, self.loc.sel)
+        self._lsp = known["lsp"] if "lsp" in known else TChar.lspfunc(self.sty)
+        self._bshft = (
+            known["bshft"]
+            if "bshft" in known
+            else TChar.bshftfunc(self.sty, self.loc.sel)
+        )
         # letter spacing
         self.lhs = None
         # flow line-heights
@@ -3084,13 +3523,42 @@ class TChar:
             memo = dict()
         ret = TChar.__new__(TChar)
         memo[self] = ret
-        ret.__dict__.update(self.__dict__)
+        for att in TChar.__slots__:
+            setattr(ret, att, getattr(self, att))
         ret.loc = CLoc(
             memo.get(self.loc.elem, self.loc.elem), self.loc.typ, self.loc.ind
         )
         ret.line = memo.get(self.line, self.line)
         return ret
 
+    def dadvs(self, cL, cR):
+        """Returns the differential advance of a character pair at my size."""
+        return self.prop.dadvs.get((cL, cR), 0) * self.utfs
+
+    @property
+    def parsed_pts_ut(self):
+        """Untransformed corner points when parsed (by precalcs)"""
+        if self._ppts_ut is None and self._arrs is not None:
+            return self._arrs.cpts_ut[self._row]
+        return self._ppts_ut
+
+    @parsed_pts_ut.setter
+    def parsed_pts_ut(self, val):
+        """Sets the parsed untransformed corner points."""
+        self._ppts_ut = val
+
+    @property
+    def parsed_pts_t(self):
+        """Transformed corner points when parsed (by precalcs)"""
+        if self._ppts_t is None and self._arrs is not None:
+            return self._arrs.cpts_t[self._row]
+        return self._ppts_t
+
+    @parsed_pts_t.setter
+    def parsed_pts_t(self, val):
+        """Sets the parsed transformed corner points."""
+        self._ppts_t = val
+
     @property
     def dx(self):
         """Returns the dx property."""
@@ -3479,6 +3947,45 @@ def sortnone(x):
     return sord
 
 
+class PairAdvances(dict):
+    """
+    A table of differential advances, keyed by (preceding char, char). Pairs
+    that were not measured are looked up in the font's pair tables when first
+    requested, so unusual pairs never need to be rendered.
+    """
+
+    def __init__(self, vals=None, sty=None, scl=1):
+        super().__init__(vals if vals is not None else dict())
+        self.sty = sty if LAZY_KERNING else None
+        # true style of the font to look pairs up in
+        self.scl = scl
+
+    def get(self, key, default=None):
+        """Gets a pair's advance, looking it up if needed."""
+        if key not in self and self.sty is not None:
+            ftfnt = pair_font(self.sty)
+            if ftfnt is None:
+                self.sty = None
+            else:
+                self[key] = ftfnt.get_pair_advance(*key) * self.scl
+        return super().get(key, default)
+
+    def __mul__(self, scl):
+        """Scales the advances by a given factor."""
+        return PairAdvances(
+            {k: val * scl for k, val in self.items()}, self.sty, self.scl * scl
+        )
+
+
+def pair_font(sty):
+    """The FontTools font for a true style, or None if it can't be loaded."""
+    try:
+        return fcfg.get_fonttools_font(sty)
+    except Exception:  # pylint: disable=broad-except
+        # FontTools can fail on unusual font files
+        return None
+
+
 class CProp:
     """
     A class representing the properties of a single character
@@ -3502,7 +4009,10 @@ class CProp:
 
     def __mul__(self, scl):
         """Scales the character properties by a given factor."""
-        dadv2 = {k: val * scl for k, val in self.dadvs.items()}
+        if isinstance(self.dadvs, PairAdvances):
+            dadv2 = self.dadvs * scl
+        else:
+            dadv2 = {k: val * scl for k, val in self.dadvs.items()}
         inkbb2 = [val * scl for val in self.inkbb]
         return CProp(
             self.char,
@@ -3575,12 +4085,7 @@ class CharacterTable:
         )
 
         # HASPANGO = False; os.environ["HASPANGO"]='False'
-        if HASPANGO:
-            # Prefer to measure with Pango if we have it (faster, more accurate)
-            self.ctable = self.measure_characters()
-        else:
-            # Can also extract directly using fonttools, which is pure Python
-            self.ctable = self.extract_characters()
+        self.ctable = self.cached_measure()
 
         self.mults = dict()
         self._ftable = None
@@ -3621,14 +4126,111 @@ class CharacterTable:
 
         return tstyset, pchrset, fstyset, cstys
 
-    def extract_characters(self):
+    def __getstate__(self):
+        """Pickles without the document's elements, e.g. for worker processes"""
+        state = self.__dict__.copy()
+        state["els"] = []
+        state["root"] = None
+        state["_ftable"] = None
+        return state
+
+    def measure(self, tstyset, pchrset):
+        """
+        Measure characters by whichever method is available. The method that
+        was actually used is left in measured_with.
+        """
+        self.measured_with = "pango" if HASPANGO else "fonttools"
+        if HASPANGO:
+            # Prefer to measure with Pango if we have it (faster, more accurate)
+            return self.measure_characters(tstyset, pchrset)
+        # Can also extract directly using fonttools, which is pure Python
+        return self.extract_characters(tstyset, pchrset)
+
+    def cached_measure(self):
+        """
+        Get character metrics from the glyph cache, measuring only the
+        characters (and preceding character pairs) that it doesn't have.
+        """
+        gcache = get_glyph_cache() if GLYPH_CACHE else None
+        if gcache is None:
+            return self.measure(self.tstyset, self.pchrset)
+
+        method = (
+            "pango" if HASPANGO else "fonttools",
+            DIFF_ADVANCES,
+            LAZY_KERNING,
+            TEXTSIZE,
+        )
+        found = dict()
+        tmiss, pmiss = dict(), dict()
+        for sty, chrs in self.tstyset.items():
+            if sty is None:
+                tmiss[sty] = chrs
+                continue
+            pairs = {
+                (pchr, c)
+                for c, pchrs in self.pchrset.get(sty, dict()).items()
+                for pchr in pchrs
+            }
+            fkey = repr((method, str(sty), fcfg.get_font_signature(sty)))
+            try:
+                fprops, cprops, pprops = gcache.lookup(fkey, chrs, pairs)
+            except sqlite3.Error:
+                fprops, cprops, pprops = None, dict(), dict()
+            found[sty] = (fkey, fprops, cprops, pprops)
+
+            mchrs = {c for c in chrs if c not in cprops}
+            mpairs = {pc for pc in pairs if pc not in pprops}
+            if fprops is None or len(mchrs) > 0 or len(mpairs) > 0:
+                # Pairs are measured with both of their characters, and space
+                # is needed for the space width
+                tmiss[sty] = mchrs | {c for pc in mpairs for c in pc} | {" "}
+                pmiss[sty] = dict()
+                for pchr, c in mpairs:
+                    pmiss[sty].setdefault(c, set()).add(pchr)
+
+        measured = self.measure(tmiss, pmiss) if len(tmiss) > 0 else dict()
+        # Don't store fallback metrics under the key of the preferred method
+        storable = len(tmiss) == 0 or self.measured_with == method[0]
+
+        ret = dict()
+        for sty, chrs in self.tstyset.items():
+            if sty is None:
+                ret[sty] = measured[sty]
+                continue
+            fkey, fprops, cprops, pprops = found[sty]
+            if sty in measured:
+                mtbl = measured[sty]
+                fprops = (mtbl[" "].spacew, mtbl[" "].caph)
+                ncprops = {c: (mtbl[c].charw, mtbl[c].inkbb) for c in tmiss[sty]}
+                npprops = dict()
+                for c, pchrs in pmiss[sty].items():
+                    for pchr in pchrs:
+                        npprops[pchr, c] = mtbl[c].dadvs.get((pchr, c), 0)
+                try:
+                    if storable:
+                        gcache.store(fkey, fprops, ncprops, npprops)
+                except sqlite3.Error:
+                    pass
+                cprops.update(ncprops)
+                pprops.update(npprops)
+            dadvs = PairAdvances(pprops, sty)
+            ret[sty] = {
+                c: CProp(c, cprops[c][0], fprops[0], fprops[1], dadvs, cprops[c][1])
+                for c in chrs
+            }
+        return ret
+
+    def extract_characters(self, tstyset=None, pchrset=None):
         """
         Direct extraction of character metrics from the font file using fonttools
         fonttools is pure Python, so this usually works
         """
+        tstyset = self.tstyset if tstyset is None else tstyset
+        pchrset = self.pchrset if pchrset is None else pchrset
         badchars = {"\n", "\r"}
         ret = dict()
-        for sty, chrs in self.tstyset.items():
+        for sty, chrs in tstyset.items():
             if sty is not None:
                 bdcs = {c for c in chrs if c in badchars}  # unusual chars
                 gcs = {c for c in chrs if c not in badchars}
@@ -3645,13 +4247,14 @@ class CharacterTable:
                 ret[sty] = dict()
                 for fnt, chs in fntcs.items():
                     ftfnt = fcfg.get_fonttools_font(fnt)
-                    if sty in self.pchrset:
+                    if sty in pchrset and not LAZY_KERNING:
                         pct2 = {
-                            k: val for k, val in self.pchrset[sty].items() if k in chs
+                            k: val for k, val in pchrset[sty].items() if k in chs
                         }
                     else:
                         pct2 = dict()
                     advs, dadv, inkbbs = ftfnt.get_char_advances(chs, pct2)
+                    dadv = PairAdvances(dadv, fnt)
                     for c in chs:
                         cwd = advs[c]
                         caph = ftfnt.cap_height
@@ -3668,11 +4271,11 @@ class CharacterTable:
                     )
             else:
                 ret[sty] = dict()
-                for c in self.tstyset[None]:
+                for c in tstyset[None]:
                     ret[sty][c] = CProp(c, 0, 0, 0, dict(), [0, 0, 0, 0])
         return ret
 
-    def measure_characters(self):
+    def measure_characters(self, tstyset=None, pchrset=None):
         """
         Uses Pango to measure character properties by rendering them on an unseen
         context. Requires GTK Python bindings, generally present in Inkscape 1.1 and
@@ -3683,6 +4286,8 @@ class CharacterTable:
         width including intercharacter space. Width corresponds to a character with
         a composed font size of 1 uu.
         """
+        tstyset = self.tstyset if tstyset is None else tstyset
+        pchrset = self.pchrset if pchrset is None else pchrset
         cnt = 0
         pstrings = dict()
 
@@ -3708,7 +4313,7 @@ class CharacterTable:
 
         ixes = dict()
         validtstyset = {
-            sty: chrs for sty, chrs in self.tstyset.items() if sty is not None
+            sty: chrs for sty, chrs in tstyset.items() if sty is not None
         }
         for sty in validtstyset:
             chrs = [chr(c) for c in fcfg.fontcharsets[sty]]
@@ -3735,6 +4340,8 @@ class CharacterTable:
         bareids = []
         for sty, chrs in validtstyset.items():
             prefix, suffix, empty, pistr = ixes[sty]
+            ftfnt = pair_font(sty) if LAZY_KERNING else None
+            # pairs that the font's tables describe are looked up instead
             ctbl[sty] = dict()
             for myc in chrs:
                 t = make_string(prefix + effc(myc) + suffix, sty)
@@ -3744,9 +4351,10 @@ class CharacterTable:
                 if DIFF_ADVANCES:
                     for pchr in chrs:
                         if (
-                            sty in self.pchrset
-                            and myc in self.pchrset[sty]
-                            and pchr in self.pchrset[sty][myc]
+                            sty in pchrset
+                            and myc in pchrset[sty]
+                            and pchr in pchrset[sty][myc]
+                            and (ftfnt is None or ftfnt.needs_layout(pchr, myc))
                         ):
                             tpc = make_string(
                                 prefix + effc(pchr) + effc(myc) + suffix, sty
@@ -3758,73 +4366,30 @@ class CharacterTable:
             ctbl[sty][pistr] = StringInfo(pistr, make_string(pistr, sty), dict())
             ctbl[sty][empty] = StringInfo(empty, make_string(empty, sty), dict())
 
-        # Pango querying doesn't multithread well
-        lock = threading.Lock()
-        lock.acquire()
-        try:
-            pngr = PangoRenderer()
-            nbb = dict()
-            for sty in ctbl:
-                joinch = " "
-                mystrs = [val[0] for k, val in pstrings.items() if val[1] == sty]
-                myids = [k for k, val in pstrings.items() if val[1] == sty]
-
-                success, metrics = pngr.set_text_style(sty)
-                if not (success):
-                    lock.release()
-                    return self.extract_characters()
-                joinedstr = joinch.join(mystrs) + joinch + prefix
-
-                # We need to render all the characters, but we don't
-                # need all of their extents. For most of them we just
-                # need the first character, unless the following string
-                # has length 1 (and may be differently differentially kerned)
-                modw = [
-                    any(
-                        len(mystrs[i]) == 1
-                        for i in range(i, i + 2)
-                        if 0 <= i < len(mystrs)
-                    )
-                    for i in range(len(mystrs))
-                ]
-                needexts = [
-                    "1"
-                    if len(s) == 1
-                    else "1" + "0" * (len(s) - 2) + ("1" if modw[i] else "0")
-                    for i, s in enumerate(mystrs)
-                ]
-                needexts2 = "0".join(needexts) + "1" + "1" * len(prefix)
-                pngr.render_text(joinedstr)
-                exts, _ = pngr.get_character_extents(metrics[1], needexts2)
-
-                spw = exts[-len(prefix) - 1][0][2]
-                cnt = 0
-                x = 0
-                for i, mystr in enumerate(mystrs):
-                    if modw[i]:
-                        altw = (
-                            exts[cnt + len(mystr) - 1][0][0]
-                            + exts[cnt + len(mystr) - 1][0][2]
-                            - exts[cnt][0][0]
-                        )
-                    else:
-                        altw = (
-                            exts[cnt + len(mystr) + 1][0][0] - exts[cnt][0][0] - spw
-                        )
-                    wdt = altw
-
-                    firstch = exts[cnt]
-                    (xbr, ybr, wbr, hbr) = tuple(firstch[2])
-                    if myids[i] not in bareids:
-                        xbr = x
-                        wbr = wdt
-                        # use logical width
-
-                    nbb[myids[i]] = [val * TEXTSIZE for val in [xbr, ybr, wbr, hbr]]
-                    cnt += len(mystr) + len(joinch)
-                    x += wdt
-        finally:
-            lock.release()
+        # Pango querying doesn't multithread well, so all measuring is done by
+        # a shared service, which can combine our styles with other threads'
+        service = get_pango_service()
+        bareids = set(bareids)
+        futs = dict()
+        for sty in ctbl:
+            mystrs = [val[0] for k, val in pstrings.items() if val[1] == sty]
+            myids = [k for k, val in pstrings.items() if val[1] == sty]
+            bare = [k in bareids for k in myids]
+            block = (mystrs, bare, ixes[sty][0])
+            futs[sty] = (myids, block, service.submit(sty, *block))
+
+        nbb = dict()
+        for sty, (myids, block, fut) in futs.items():
+            try:
+                boxes = fut.result()
+            except Exception:  # pylint: disable=broad-except
+                # service failed, measure in this thread instead
+                boxes = service.measure_here(sty, *block)
+            if boxes is None:
+                self.measured_with = "fonttools"
+                return self.extract_characters(tstyset, pchrset)
+            for myid, box in zip(myids, boxes):
+                nbb[myid] = [val * TEXTSIZE for val in box]
 
         dadv = dict()
         for sty, chd in ctbl.items():
@@ -3855,10 +4420,12 @@ class CharacterTable:
             caph = -chd[empty].bbx.y1
             # cap height is the top of I (relative to baseline)
 
-            dadvscl = dict()
+            dadvscl = PairAdvances(sty=sty)
             if DIFF_ADVANCES:
                 for k in dadv[sty]:
                     dadvscl[k] = dadv[sty][k] / TEXTSIZE
+            else:
+                dadvscl.sty = None
 
             for i in chd:
                 cwd = chd[i].bbx.w - blnkwd
@@ -3879,9 +4446,9 @@ class CharacterTable:
                     dadvscl,
                     [val / TEXTSIZE for val in inkbb],
                 )
-        if None in self.tstyset:
+        if None in tstyset:
             ctbl[None] = dict()
-            for c in self.tstyset[None]:
+            for c in tstyset[None]:
                 ctbl[None][c] = CProp(c, 0, 0, 0, dict(), [0, 0, 0, 0])
         return ctbl
 
@@ -28,7 +28,10 @@ import math
 import re
 import sys
 import os
+import tempfile
 from functools import lru_cache
+from collections.abc import Mapping
+import numpy as np
 import lxml
 from lxml import etree
 import inkex
@@ -36,6 +39,17 @@ import inkex.command
 from inkex.properties import all_properties
 from inkex.units import CONVERSIONS, BOTH_MATCH
 
+
+def temp_path(name):
+    """Location of a file next to the other Scientific Inkscape temp files"""
+    if sys.executable[0:4] == "/tmp" or sys.executable[0:5] == "/snap":
+        # tempfile does not always work with Linux Snap distributions
+        base = os.path.dirname(os.path.abspath(__file__))
+    else:
+        base = tempfile.gettempdir()
+    return os.path.join(base, name)
+
+
 # For style components that represent a size (stroke-width, font-size, etc),
 # calculate the true size reported by Inkscape in user units, inheriting
 # any styles/transforms/document scaling
@@ -636,4 +650,278 @@ class bbox:
         return bbox([self.x1 * scl, self.y1 * scl, self.w * scl, self.h * scl])
 
 
+class BBoxArray(Mapping):
+    """
+    Bounding boxes for many elements, stored as contiguous arrays of x1, y1,
+    x2, y2 so that bbox math can be done on all of them at once. Null boxes
+    are NaNs.
+
+    Reads like the dict of ID to [x, y, width, height] lists returned by
+    BB2: indexing by ID returns the list, and null boxes are omitted.
+    """
+
+    def __init__(self, ids, x1, y1, x2, y2):
+        """Initialize from a list of IDs and coordinate arrays."""
+        self.ids = list(ids)
+        self.x1 = np.asarray(x1, dtype=float)
+        self.y1 = np.asarray(y1, dtype=float)
+        self.x2 = np.asarray(x2, dtype=float)
+        self.y2 = np.asarray(y2, dtype=float)
+        self._index = None
+
+    @classmethod
+    def from_bboxes(cls, ids, bbs):
+        """Make from a list of IDs and a matching list of bboxes."""
+        arr = np.array(
+            [
+                (np.nan,) * 4 if bb is None or bb.isnull else (bb.x1, bb.y1, bb.x2, bb.y2)
+                for bb in bbs
+            ],
+            dtype=float,
+        ).reshape(-1, 4)
+        return cls(ids, arr[:, 0], arr[:, 1], arr[:, 2], arr[:, 3])
+
+    @classmethod
+    def from_dict(cls, bbd):
+        """Make from a dict of ID to [x, y, width, height]."""
+        arr = np.array(list(bbd.values()), dtype=float).reshape(-1, 4)
+        return cls(bbd.keys(), arr[:, 0], arr[:, 1], arr[:, 0] + arr[:, 2],
+                   arr[:, 1] + arr[:, 3])
+
+    @property
+    def index(self):
+        """Dict of ID to position"""
+        if self._index is None:
+            self._index = {eid: i for i, eid in enumerate(self.ids)}
+        return self._index
+
+    @property
+    def isnull(self):
+        """Boolean array that is True for null boxes"""
+        return np.isnan(self.x1)
+
+    @property
+    def w(self):
+        """Widths"""
+        return self.x2 - self.x1
+
+    @property
+    def h(self):
+        """Heights"""
+        return self.y2 - self.y1
+
+    def __getitem__(self, eid):
+        i = self.index[eid]
+        if np.isnan(self.x1[i]):
+            raise KeyError(eid)
+        x1, y1, x2, y2 = (float(v[i]) for v in (self.x1, self.y1, self.x2, self.y2))
+        return [x1, y1, x2 - x1, y2 - y1]
+
+    def __iter__(self):
+        return (eid for eid, null in zip(self.ids, self.isnull) if not null)
+
+    def __len__(self):
+        return int(np.count_nonzero(~self.isnull))
+
+    def bbox(self, i):
+        """The bbox at position i."""
+        if np.isnan(self.x1[i]):
+            return bbox(None)
+        return bbox(self[self.ids[i]])
+
+    def take(self, ids):
+        """A BBoxArray for the given IDs, with null boxes for any missing."""
+        pos = np.array([self.index.get(eid, -1) for eid in ids], dtype=np.int64)
+        found = pos >= 0
+
+        def pick(v):
+            ret = np.full(len(pos), np.nan)
+            ret[found] = v[pos[found]]
+            return ret
+
+        return BBoxArray(ids, pick(self.x1), pick(self.y1), pick(self.x2), pick(self.y2))
+
+    def transform(self, xforms):
+        """
+        Transform every box by a Transform, or by per-box transforms given as
+        a list of Transforms or an (n, 2, 3) array of matrices.
+        """
+        if isinstance(xforms, inkex.Transform):
+            mats = np.array(xforms.matrix, dtype=float).reshape(1, 2, 3)
+        elif isinstance(xforms, np.ndarray):
+            mats = xforms.reshape(-1, 2, 3)
+        else:
+            mats = np.array([t.matrix for t in xforms], dtype=float).reshape(-1, 2, 3)
+        a, c, e = mats[:, 0, 0], mats[:, 0, 1], mats[:, 0, 2]
+        b, d, f = mats[:, 1, 0], mats[:, 1, 1], mats[:, 1, 2]
+        xs = np.stack((self.x1, self.x2, self.x1, self.x2))
+        ys = np.stack((self.y1, self.y2, self.y2, self.y1))
+        txs = a * xs + c * ys + e
+        tys = b * xs + d * ys + f
+        return BBoxArray(self.ids, txs.min(axis=0), tys.min(axis=0),
+                         txs.max(axis=0), tys.max(axis=0))
+
+    def union_reduce(self, groups, ids=None):
+        """
+        Union boxes by group membership. groups gives each box's group number
+        (or -1 for none); the result has one box per group, which is null if
+        the group has no non-null members.
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        ngroups = int(groups.max()) + 1 if len(groups) > 0 else 0
+        if ids is None:
+            ids = list(range(ngroups))
+        inc = groups >= 0
+        gis = groups[inc]
+        ret = []
+        for v, ufunc, init in ((self.x1, np.fmin, np.inf), (self.y1, np.fmin, np.inf),
+                               (self.x2, np.fmax, -np.inf), (self.y2, np.fmax, -np.inf)):
+            out = np.full(ngroups, init)
+            ufunc.at(out, gis, v[inc])
+            out[np.isinf(out)] = np.nan
+            ret.append(out)
+        return BBoxArray(ids, *ret)
+
+    def intersection(self, other):
+        """
+        Clip each box by the corresponding box of other (a BBoxArray or a
+        single bbox). Boxes that do not overlap become null; a null clip
+        makes the box null, as in bounding_box2.
+        """
+        if isinstance(other, bbox):
+            other = BBoxArray.from_bboxes([None], [other])
+        x1 = np.maximum(self.x1, other.x1)
+        y1 = np.maximum(self.y1, other.y1)
+        x2 = np.minimum(self.x2, other.x2)
+        y2 = np.minimum(self.y2, other.y2)
+        empty = np.logical_or(x2 < x1, y2 < y1)
+        for v in (x1, y1, x2, y2):
+            v[empty] = np.nan
+        return BBoxArray(self.ids, x1, y1, x2, y2)
+
+
+def path_segments(path):
+    """
+    Convert a Path into an (n, 4, 2) array of cubic segments (start point, two
+    control points, end point). Lines become degenerate cubics, quadratics are
+    elevated, arcs are converted to curves, and each move-to adds a single
+    point, so the extents of the segments are the extents of the path.
+    """
+    segs = []
+    cx = cy = sx = sy = 0.0
+    lcx = lcy = None  # last cubic control point, for S
+    lqx = lqy = None  # last quadratic control point, for T
+    for cmd in path:
+        let = cmd.letter
+        cap = let.upper()
+        args = cmd.args
+        ox, oy = (cx, cy) if let != cap else (0.0, 0.0)
+        ncx = ncy = nqx = nqy = None
+        if cap == "M":
+            cx, cy = sx, sy = args[0] + ox, args[1] + oy
+            segs.append((cx, cy, cx, cy, cx, cy, cx, cy))
+            continue
+        if cap == "Z":
+            cx, cy = sx, sy
+        elif cap in "LHV":
+            if cap == "L":
+                x, y = args[0] + ox, args[1] + oy
+            elif cap == "H":
+                x, y = args[0] + ox, cy
+            else:
+                x, y = cx, args[0] + oy
+            segs.append((cx, cy, cx, cy, x, y, x, y))
+            cx, cy = x, y
+        elif cap in "CS":
+            if cap == "C":
+                x1, y1 = args[0] + ox, args[1] + oy
+                args = args[2:]
+            elif lcx is not None:
+                x1, y1 = 2 * cx - lcx, 2 * cy - lcy
+            else:
+                x1, y1 = cx, cy
+            x2, y2, x, y = args[0] + ox, args[1] + oy, args[2] + ox, args[3] + oy
+            segs.append((cx, cy, x1, y1, x2, y2, x, y))
+            cx, cy, ncx, ncy = x, y, x2, y2
+        elif cap in "QT":
+            if cap == "Q":
+                qx, qy = args[0] + ox, args[1] + oy
+                args = args[2:]
+            elif lqx is not None:
+                qx, qy = 2 * cx - lqx, 2 * cy - lqy
+            else:
+                qx, qy = cx, cy
+            x, y = args[0] + ox, args[1] + oy
+            segs.append(
+                (cx, cy, cx + 2 / 3 * (qx - cx), cy + 2 / 3 * (qy - cy),
+                 x + 2 / 3 * (qx - x), y + 2 / 3 * (qy - y), x, y)
+            )
+            cx, cy, nqx, nqy = x, y, qx, qy
+        elif cap == "A" and (args[0] == 0 or args[1] == 0):
+            x, y = args[5] + ox, args[6] + oy  # zero radius, so a line
+            segs.append((cx, cy, cx, cy, x, y, x, y))
+            cx, cy = x, y
+        elif cap == "A":
+            arc = inkex.paths.Arc(*args[:5], args[5] + ox, args[6] + oy)
+            for crv in arc.to_curves(inkex.Vector2d(cx, cy)):
+                segs.append((cx, cy) + tuple(crv.args))
+                cx, cy = crv.args[4], crv.args[5]
+            cx, cy = arc.x, arc.y
+        lcx, lcy, lqx, lqy = ncx, ncy, nqx, nqy
+    return np.array(segs, dtype=float).reshape(-1, 4, 2)
+
+
+def segment_extents(segs, rough=False):
+    """
+    Vectorized extents of cubic segments (see path_segments), returned as
+    arrays of x1, y1, x2, y2. If rough is True the control points are used,
+    which is faster and an upper bound for the true extents.
+    """
+    if rough:
+        mins = segs.min(axis=1)
+        maxs = segs.max(axis=1)
+        return mins[:, 0], mins[:, 1], maxs[:, 0], maxs[:, 1]
+    p0, p1, p2, p3 = segs[:, 0, :], segs[:, 1, :], segs[:, 2, :], segs[:, 3, :]
+    mins = np.minimum(p0, p3)
+    maxs = np.maximum(p0, p3)
+
+    # Extrema are where the derivative a t^2 + b t + c is zero
+    a = -p0 + 3 * p1 - 3 * p2 + p3
+    b = 2 * (p0 - 2 * p1 + p2)
+    c = p1 - p0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        disc = np.sqrt(b**2 - 4 * a * c)
+        quad = np.abs(a) > 1e-12
+        roots = (
+            np.where(quad, (-b + disc) / (2 * a), -c / b),
+            np.where(quad, (-b - disc) / (2 * a), np.nan),
+        )
+        for t in roots:
+            ok = (t > 0) & (t < 1)
+            t = np.where(ok, t, 0)
+            mt = 1 - t
+            val = mt**3 * p0 + 3 * mt**2 * t * p1 + 3 * mt * t**2 * p2 + t**3 * p3
+            mins = np.where(ok, np.minimum(mins, val), mins)
+            maxs = np.where(ok, np.maximum(maxs, val), maxs)
+    return mins[:, 0], mins[:, 1], maxs[:, 0], maxs[:, 1]
+
+
+def path_extents(segarrs, rough=False):
+    """
+    Extents of many paths at once, given a list of their segment arrays.
+    Returns a BBoxArray (indexed by position) with a null box for empty paths.
+    """
+    counts = np.array([len(sga) for sga in segarrs], dtype=np.int64)
+    if counts.sum() == 0:
+        return BBoxArray.from_bboxes(range(len(segarrs)), [None] * len(segarrs))
+    exts = BBoxArray(
+        range(counts.sum()),
+        *segment_extents(np.concatenate([sga for sga in segarrs if len(sga) > 0]), rough),
+    )
+    ret = exts.union_reduce(np.repeat(np.arange(len(segarrs)), counts))
+    if len(ret.ids) < len(segarrs):  # trailing empty paths
+        ret = ret.take(range(len(segarrs)))
+    return ret
+
+
 # pylint:enable=invalid-name
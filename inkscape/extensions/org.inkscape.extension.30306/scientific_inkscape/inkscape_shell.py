@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2023 David Burghoff <burghoff@utexas.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Persistent Inkscape workers
+
+Starting the Inkscape binary takes a second or more, which dominates the
+Autoexporter's run time when a watched folder contains many figures. This
+module keeps a pool of long-lived `inkscape --shell` processes that accept
+action lists on stdin, so that each export only pays for the actions it runs.
+
+Workers are started lazily, checked for health before each use, and restarted
+if they crash or stop responding.
+"""
+
+import os
+import sys
+import time
+import queue
+import threading
+import subprocess
+
+# Export settings persist for the life of a shell session, so every command
+# starts by putting them back to their command-line defaults. An empty id or
+# background, a dpi of 0, and an opacity of -1 are what Inkscape uses for unset.
+RESET_EXPORT = (
+    "export-id:; export-id-only:false; export-area-page:false; "
+    "export-area-drawing:false; export-plain-svg:false; export-latex:false; "
+    "export-dpi:0; export-background:; export-background-opacity:-1; "
+)
+PROMPT = b"> "
+
+
+class ShellCrash(RuntimeError):
+    """Raised when a shell worker dies while running a command."""
+
+
+class ShellTimeout(ShellCrash):
+    """Raised when a shell worker stops responding."""
+
+
+class ShellWorker:
+    """A single `inkscape --shell` process."""
+
+    def __init__(self, inkscape_binary, cwd=None):
+        self.binary = inkscape_binary
+        self.cwd = cwd
+        self.proc = None
+        self.outq = None
+        self.ncommands = 0
+        self.broken = False
+        self.start()
+
+    def start(self):
+        """Launch the process and wait for its first prompt."""
+        env = dict(os.environ)
+        env["SELF_CALL"] = "true"  # seems to be needed for 1.3
+        kwargs = dict()
+        if sys.platform == "win32":
+            kwargs["creationflags"] = subprocess.CREATE_NO_WINDOW
+        self.proc = subprocess.Popen(
+            [self.binary, "--shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+            cwd=self.cwd,
+            env=env,
+            **kwargs
+        )
+        # Read stdout on a separate thread so reads can time out
+        self.outq = queue.Queue()
+
+        def reader(stream, outq):
+            for chunk in iter(lambda: stream.read1(4096), b""):
+                outq.put(chunk)
+            outq.put(None)  # EOF
+
+        threading.Thread(
+            target=reader, args=(self.proc.stdout, self.outq), daemon=True
+        ).start()
+        self.ncommands = 0
+        self.broken = False
+        self._read_until_prompt(timeout=60)
+
+    def alive(self):
+        """True if the process is still running."""
+        return self.proc is not None and self.proc.poll() is None
+
+    def healthy(self, timeout=10):
+        """Check that the worker is running and answers an empty command."""
+        if self.broken or not self.alive():
+            return False
+        try:
+            self._send("")
+            self._read_until_prompt(timeout=timeout)
+            return True
+        except ShellCrash:
+            return False
+
+    def restart(self):
+        """Kill the process if needed and start a new one."""
+        self.stop()
+        self.start()
+
+    def stop(self):
+        """Terminate the process."""
+        if self.proc is None:
+            return
+        if self.alive():
+            try:
+                self._send("quit")
+                self.proc.wait(timeout=5)
+            except (ShellCrash, subprocess.TimeoutExpired):
+                self.proc.kill()
+        self.proc = None
+
+    def _send(self, line):
+        try:
+            self.proc.stdin.write((line + "\n").encode("utf-8"))
+            self.proc.stdin.flush()
+        except (OSError, ValueError, AttributeError) as excp:
+            raise ShellCrash("Inkscape shell worker is not accepting input") from excp
+
+    def _read_until_prompt(self, timeout):
+        buf = b""
+        tend = time.time() + timeout
+        while not buf.endswith(PROMPT):
+            remaining = tend - time.time()
+            if remaining <= 0:
+                raise ShellTimeout("Inkscape shell worker timed out")
+            try:
+                chunk = self.outq.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if chunk is None:
+                raise ShellCrash("Inkscape shell worker exited unexpectedly")
+            buf += chunk
+        return buf[:-2].decode("utf-8", errors="ignore")
+
+    def run(self, actions, timeout):
+        """
+        Run a semicolon-separated action list and return what it printed.
+        ShellCrash is raised if it fails, and the worker is marked unhealthy so
+        that it is restarted the next time it is checked out.
+        """
+        try:
+            self._send(actions)
+            ret = self._read_until_prompt(timeout)
+        except ShellCrash:
+            self.broken = True
+            raise
+        self.ncommands += 1
+        return ret
+
+
+class ShellPool:
+    """
+    A fixed-size pool of shell workers. Checking out a worker blocks when all
+    are busy, so the pool size also limits the number of concurrent binary calls.
+    """
+
+    MAX_COMMANDS = 200  # recycle workers periodically to bound memory growth
+    CHECKOUT_TIMEOUT = 600  # seconds to wait for a busy worker
+
+    def __init__(self, inkscape_binary, size, cwd=None):
+        self.binary = inkscape_binary
+        self.cwd = cwd
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.nstarted = 0
+        self.lock = threading.Lock()
+        self.workers = []
+        self.closed = False
+
+    def checkout(self):
+        """Get a healthy idle worker, starting a new one if allowed."""
+        deadline = time.time() + self.CHECKOUT_TIMEOUT
+        while True:
+            with self.lock:
+                if self.idle.empty() and self.nstarted < self.size:
+                    self.nstarted += 1
+                    start_new = True
+                else:
+                    start_new = False
+            if start_new:
+                try:
+                    worker = ShellWorker(self.binary, self.cwd)
+                except (OSError, ShellCrash):
+                    with self.lock:
+                        self.nstarted -= 1
+                    raise
+                with self.lock:
+                    self.workers.append(worker)
+                return worker
+
+            # Wait briefly so that slots freed by failed workers are noticed
+            try:
+                worker = self.idle.get(timeout=1)
+                break
+            except queue.Empty:
+                if time.time() > deadline:
+                    raise ShellTimeout(
+                        "No Inkscape shell worker became available in {0} s".format(
+                            self.CHECKOUT_TIMEOUT
+                        )
+                    )
+
+        if worker.ncommands >= self.MAX_COMMANDS or not worker.healthy():
+            try:
+                worker.restart()
+            except (OSError, ShellCrash):
+                # Give up the worker's slot so a fresh one can be started
+                worker.stop()
+                with self.lock:
+                    if worker in self.workers:
+                        self.workers.remove(worker)
+                    self.nstarted -= 1
+                raise
+        return worker
+
+    def checkin(self, worker):
+        """Return a worker to the pool."""
+        if self.closed:
+            worker.stop()
+        else:
+            self.idle.put(worker)
+
+    def run(self, actions, timeout=60):
+        """Run an action list on any available worker."""
+        worker = self.checkout()
+        try:
+            return worker.run(actions, timeout)
+        finally:
+            self.checkin(worker)
+
+    def run_file(self, filename, actions="", query_all=False, timeout=60):
+        """
+        Open a file, optionally query all bounding boxes, run actions on it, and
+        close it without saving. Returns the query output.
+        """
+        filename = os.path.abspath(filename).replace("\\", "/")
+        cmd = RESET_EXPORT + "file-open:{0}; ".format(filename)
+        if query_all:
+            cmd += "query-all; "
+        cmd += actions + " file-close"
+        return self.run(cmd, timeout)
+
+    def close(self):
+        """Stop all workers."""
+        self.closed = True
+        with self.lock:
+            workers = list(self.workers)
+            self.workers = []
+        for worker in workers:
+            worker.stop()
+
+
+def shell_supported(installed_ivp):
+    """The file-open and file-close actions needed here appeared in v1.2"""
+    return installed_ivp[0] > 1 or (installed_ivp[0] == 1 and installed_ivp[1] >= 2)
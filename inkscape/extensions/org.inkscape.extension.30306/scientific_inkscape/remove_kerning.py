@@ -52,6 +52,7 @@ import inkex
 import inkex.text.parser as tp
 
 import os, sys, re
+import numpy as np
 
 sys.path.append(
     os.path.dirname(os.path.realpath(sys.argv[0]))
@@ -87,6 +88,8 @@ def remove_kerning(
             tels = Remove_Manual_Kerning(tels, mergesupersub)
         if mergenearby or mergesupersub:
             tels = External_Merges(tels, mergenearby, mergesupersub)
+        # Recompute merged chunks together instead of one at a time
+        ptl.update_positions()
         # # Then do splits (deciding based on current position, not original position,
         # # since merges intentionally change position)
         if splitdistant:
@@ -99,6 +102,7 @@ def remove_kerning(
         tels = Change_Justification(tels, justification)
         tels, removedspc = Remove_Trailing_Leading_Spaces(tels)
         if removemanual or mergenearby or mergesupersub or removedspc:
+            tp.ParsedTextList(tels).update_positions()
             tels = Fix_Merge_Positions(tels)
         tels = Make_All_Editable(tels)
         tels = Final_Cleanup(tels)
@@ -179,107 +183,312 @@ def Split_Lines(els, ignoreinkscape=True):
     return els
 
 
+# Gap analysis
+# The split and merge passes compare the ends of neighboring chunks (or
+# characters) against space-width thresholds. The points of every candidate
+# are gathered into arrays at once and compared together, so that the
+# passes only loop over the chunks they actually change.
+NUMBERSPLITS = [" ", "-", "−"]  # chars that may separate numbers
+
+
+def char_points(chks, current_pts=False, transformed=True):
+    """
+    Corner points of the characters of chks as (n, 4, 2) arrays (untransformed
+    and transformed, or None if not transformed), and the row each chunk starts
+    at. Missing points are NaN.
+    """
+    starts = np.cumsum([0] + [len(w.chrs) for w in chks])
+    if starts[-1] == 0:
+        empty = np.zeros((0, 4, 2))
+        return empty, empty if transformed else None, starts
+    if current_pts:
+        uts = np.concatenate(
+            [np.asarray(w.cpts_ut, dtype=float) for w in chks if len(w.chrs) > 0],
+            axis=1,
+        ).transpose(1, 0, 2)
+        ts = None
+        if transformed:
+            ts = np.concatenate(
+                [np.asarray(w.cpts_t, dtype=float) for w in chks if len(w.chrs) > 0],
+                axis=1,
+            ).transpose(1, 0, 2)
+    else:
+        nanpts = np.full((4, 2), np.nan)
+
+        def orn(pts):
+            return nanpts if pts is None else pts
+
+        uts = np.array([orn(c.parsed_pts_ut) for w in chks for c in w.chrs], dtype=float)
+        ts = None
+        if transformed:
+            ts = np.array(
+                [orn(c.parsed_pts_t) for w in chks for c in w.chrs], dtype=float
+            )
+    return uts, ts, starts
+
+
+def segment_argext(vals, seg, nseg, ufunc, fill):
+    """
+    First index of the extreme value of each segment of vals (minimum or
+    maximum, by ufunc), ignoring fill values. Segments with none are -1.
+    """
+    ext = np.full(nseg, fill)
+    ufunc.at(ext, seg, vals)
+    hit = np.logical_and(vals == ext[seg], vals != fill)
+    first = np.full(nseg, len(vals))
+    np.minimum.at(first, seg[hit], np.flatnonzero(hit))
+    first[first == len(vals)] = -1
+    return first
+
+
+def gap_points(chks, i1s, i2s, current_pts=False):
+    """
+    Vectorized get_ut_pts for the pairs of chunks (chks[i1s], chks[i2s]).
+    Returns (k, 2) arrays of tr1, br1, tl2, bl2, and a mask of the pairs that
+    could be computed. The rest (no character points, or a singular
+    transform) are left for get_ut_pts.
+    """
+    if len(i1s) == 0:
+        empty = np.zeros((0, 2))
+        return empty, empty, empty, empty, np.zeros(0, dtype=bool)
+    uts, ts, starts = char_points(chks, current_pts)
+    seg = np.repeat(np.arange(len(chks)), np.diff(starts))
+    with np.errstate(invalid="ignore"):
+        lft = np.where(np.isnan(uts[:, 0, 0]), np.inf, uts[:, 0, 0])
+        rgt = np.where(np.isnan(uts[:, 3, 0]), -np.inf, uts[:, 3, 0])
+    ilft = segment_argext(lft, seg, len(chks), np.minimum, np.inf)[i2s]
+    irgt = segment_argext(rgt, seg, len(chks), np.maximum, -np.inf)[i1s]
+
+    tr1 = uts[irgt, 2]
+    br1 = uts[irgt, 3]
+    mats = np.array([w.transform.matrix for w in chks], dtype=float)[i1s]
+    m00, m01, m02 = mats[:, 0, 0], mats[:, 0, 1], mats[:, 0, 2]
+    m10, m11, m12 = mats[:, 1, 0], mats[:, 1, 1], mats[:, 1, 2]
+    det = m00 * m11 - m01 * m10
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inv_det = 1 / det
+
+        def vmultinv(pts):
+            sxv = pts[:, 0] - m02
+            syv = pts[:, 1] - m12
+            return np.stack(
+                ((m11 * sxv - m01 * syv) * inv_det, (m00 * syv - m10 * sxv) * inv_det),
+                axis=1,
+            )
+
+        bl2 = vmultinv(ts[ilft, 0])
+        tl2 = vmultinv(ts[ilft, 1])
+    ok = np.logical_and.reduce((ilft >= 0, irgt >= 0, det != 0))
+    return tr1, br1, tl2, bl2, ok
+
+
+def chunk_spaces(chks):
+    """Arrays of space widths, trailing spaces, and leading spaces of chks"""
+    spw = np.array([np.nan if w.spw is None else w.spw for w in chks], dtype=float)
+    trl = np.array([len(w.txt) - len(w.txt.rstrip(" ")) for w in chks], dtype=int)
+    ldg = np.array([len(w.txt) - len(w.txt.lstrip(" ")) for w in chks], dtype=int)
+    return spw, trl, ldg
+
+
+def distant_chunk_splits(lines):
+    """
+    For each line, its chunks sorted by x and the positions in that order
+    where the gap from the previous chunk is too large (by current position).
+    """
+    swss = [sorted(line.chks, key=lambda w: w.x) for line in lines]
+    chks = [w for sws in swss for w in sws]
+    nchks = np.array([len(sws) for sws in swss], dtype=np.int64)
+    i2s = np.flatnonzero(
+        np.arange(len(chks)) != np.repeat(np.cumsum(nchks) - nchks, nchks)
+    )  # every chunk but the first of each line
+    i1s = i2s - 1
+
+    spw, trl, ldg = chunk_spaces(chks)
+    tr1, br1, tl2, bl2, ok = gap_points(chks, i1s, i2s, current_pts=True)
+    dx = spw[i1s] * (NUM_SPACES - trl[i1s] - ldg[i2s])
+    xtol = XTOLSPLIT * spw[i1s]
+    split = bl2[:, 0] > br1[:, 0] + dx + xtol
+
+    for k in np.flatnonzero(~ok):
+        w, w2 = chks[i1s[k]], chks[i2s[k]]
+        tr1k, br1k, tl2k, bl2k = w.get_ut_pts(w2, current_pts=True)
+        split[k] = bl2k[0] > br1k[0] + dx[k] + xtol[k]
+
+    # Positions of the splits within their lines
+    splitpos = i2s[split]
+    lidx = np.repeat(np.arange(len(lines)), nchks)[splitpos]
+    splitpos = splitpos - (np.cumsum(nchks) - nchks)[lidx]
+    bounds = np.searchsorted(lidx, np.arange(len(lines) + 1))
+    return [
+        (swss[il], splitpos[bounds[il] : bounds[il + 1]].tolist())
+        for il in range(len(lines))
+    ]
+
+
 # Generate splitting of distantly-kerned text
 def Split_Distant_Chunks(els):
-    for ptxt in [el.parsed_text for el in els]:
-        if ptxt.lns is not None:
-            for il in reversed(range(len(ptxt.lns))):
-                line = ptxt.lns[il]
-                sws = [
-                    x
-                    for _, x in sorted(
-                        zip([w.x for w in line.chks], line.chks),
-                        key=lambda pair: pair[0],
-                    )
-                ]  # chunks sorted in ascending x
-                splits = []
-                for ii in range(1, len(line.chks)):
-                    w = sws[ii - 1]
-                    w2 = sws[ii]
-
-                    trl_spcs, ldg_spcs = trailing_leading(w.txt, w2.txt)
-                    dx = w.spw * (NUM_SPACES - trl_spcs - ldg_spcs)
-                    xtol = XTOLSPLIT * w.spw
-
-                    tr1, br1, tl2, bl2 = w.get_ut_pts(w2, current_pts=True)
-                    if bl2[0] > br1[0] + dx + xtol:
-                        splits.append(ii)
-                line.splits = splits
-                line.sws = sws
-
-                if len(splits) > 0:
-                    for ii in reversed(range(len(splits))):
-                        sstart = splits[ii]
-                        if ii != len(splits) - 1:
-                            sstop = splits[ii + 1]
-                        else:
-                            sstop = len(line.chks)
+    ptxts = [el.parsed_text for el in els if el.parsed_text.lns is not None]
+    lines = [line for ptxt in ptxts for line in ptxt.lns]
+    plans = dict(zip(lines, distant_chunk_splits(lines)))
+    for ptxt in ptxts:
+        changed = False
+        for il in reversed(range(len(ptxt.lns))):
+            line = ptxt.lns[il]
+            if changed or line not in plans:
+                # splitting rewrites the text's positions, so check again
+                sws, splits = distant_chunk_splits([line])[0]
+            else:
+                sws, splits = plans[line]
+            line.splits = splits
+            line.sws = sws
+
+            if len(splits) > 0:
+                changed = True
+                for ii in reversed(range(len(splits))):
+                    sstart = splits[ii]
+                    if ii != len(splits) - 1:
+                        sstop = splits[ii + 1]
+                    else:
+                        sstop = len(line.chks)
 
-                        newtxt = ptxt.split_off_chunks(sws[sstart:sstop])
-                        els.append(newtxt)
+                    newtxt = ptxt.split_off_chunks(sws[sstart:sstop])
+                    els.append(newtxt)
     return els
 
 
+def numbersplit(wtxt, ii, prevsplit, c, c2):
+    """
+    If a character is splitting two numbers, should always split in case
+    they are ticks
+    """
+    remainingnumeric = False
+    splrest = re.split("|".join(NUMBERSPLITS), wtxt[ii:])
+    splrest = [v for v in splrest if v != ""]
+    if len(splrest) > 0:
+        remainingnumeric = isnumeric(splrest[0])
+    return (
+        isnumeric(wtxt[prevsplit:ii])
+        and (c2.c in NUMBERSPLITS and remainingnumeric)
+        and c.loc.elem == c2.loc.elem
+    )
+
+
+def intrachunk_splits(chks):
+    """
+    Find where chunks should be split into separate texts. Returns a dict
+    of the chunks with splits, whose values are the chunk's characters
+    sorted by current x and the split positions in that order.
+    """
+    uts, _, starts = char_points(chks, current_pts=True, transformed=False)
+    if starts[-1] == 0:
+        return dict()
+    seg = np.repeat(np.arange(len(chks)), np.diff(starts))
+    order = np.lexsort((uts[:, 0, 0], seg))  # stable, like sorted
+    allchrs = [c for w in chks for c in w.chrs]
+    schrs = [allchrs[k] for k in order]
+    lft = uts[order, 0, 0]
+    rgt = uts[order, 3, 0]
+
+    # Last non-space character before each one in its chunk
+    pos = np.arange(len(schrs))
+    nonspace = np.array([c.c not in [" ", "\u00a0"] for c in schrs], dtype=bool)
+    lastnspc = np.maximum.accumulate(np.where(nonspace, pos, -1))
+    prevnspc = np.concatenate(([-1], lastnspc[:-1]))
+    active = np.logical_and(pos != starts[seg], prevnspc >= starts[seg])
+
+    spw = chunk_spaces(chks)[0]
+    dx = spw * (NUM_SPACES)
+    xtol = XTOLSPLIT * spw
+    gap = np.logical_and(active, lft > rgt[prevnspc] + dx[seg] + xtol[seg])
+    maybenum = np.logical_and(
+        active, np.array([c.c in NUMBERSPLITS for c in schrs], dtype=bool)
+    )
+
+    ret = dict()
+    for j in np.unique(seg[np.logical_or(gap, maybenum)]):
+        w = chks[j]
+        strt = starts[j]
+        splitiis = []
+        prevsplit = 0
+        for k in np.flatnonzero(np.logical_or(gap, maybenum)[strt : starts[j + 1]]):
+            ii = int(k)
+            if gap[strt + ii] or numbersplit(
+                w.txt, ii, prevsplit, schrs[prevnspc[strt + ii]], schrs[strt + ii]
+            ):
+                splitiis.append(ii)
+                prevsplit = ii
+        if len(splitiis) > 0:
+            ret[w] = (schrs[strt : starts[j + 1]], splitiis)
+    return ret
+
+
 # Generate splitting of distantly-kerned text
 def Split_Distant_Intrachunk(els):
-    for ptxt in [el.parsed_text for el in els]:
-        if ptxt.lns is not None and not (ptxt.ismlinkscape) and not (ptxt.isflow):
-            for line in ptxt.lns:
-                for w in line.chks:
-                    if len(w.chrs) > 0:
-                        chrs = sorted(w.chrs, key=lambda chr: chr.pts_ut[0][0])
-                        lastnspc = None
-                        splitiis = []
-                        prevsplit = 0
-                        if chrs[0].c not in [" ", "\u00a0"]:
-                            lastnspc = chrs[0]
-                        for ii in range(1, len(chrs)):
-                            if lastnspc is not None:
-                                c = lastnspc
-                                c2 = chrs[ii]
-
-                                bl2 = c2.pts_ut[0]
-                                br1 = c.pts_ut[3]
-
-                                dx = w.spw * (NUM_SPACES)
-                                xtol = XTOLSPLIT * w.spw
-
-                                # If this character is splitting two numbers,
-                                # should always split in case they are ticks
-                                import re
-
-                                remainingnumeric = False
-                                numbersplits = [" ", "-", "−"]
-                                # chars that may separate numbers
-                                splrest = re.split("|".join(numbersplits), w.txt[ii:])
-                                splrest = [v for v in splrest if v != ""]
-                                if len(splrest) > 0:
-                                    remainingnumeric = isnumeric(splrest[0])
-                                numbersplit = (
-                                    isnumeric(w.txt[prevsplit:ii])
-                                    and (c2.c in numbersplits and remainingnumeric)
-                                    and c.loc.elem == c2.loc.elem
-                                )
-
-                                if bl2[0] > br1[0] + dx + xtol or numbersplit:
-                                    splitiis.append(ii)
-                                    prevsplit = ii
-                            if chrs[ii].c not in [" ", "\u00a0"]:
-                                lastnspc = chrs[ii]
-
-                        if len(splitiis) > 0:
-                            for ii in reversed(range(len(splitiis))):
-                                sstart = splitiis[ii]
-                                if ii != len(splitiis) - 1:
-                                    sstop = splitiis[ii + 1]
-                                else:
-                                    sstop = len(chrs)
-                                split_chrs = [chr for chr in w.chrs if chr in chrs[sstart:sstop]]
-                                newtxt = ptxt.split_off_characters(split_chrs)
-                                els.append(newtxt)
+    ptxts = [
+        el.parsed_text
+        for el in els
+        if el.parsed_text.lns is not None
+        and not (el.parsed_text.ismlinkscape)
+        and not (el.parsed_text.isflow)
+    ]
+    plans = intrachunk_splits(
+        [w for ptxt in ptxts for line in ptxt.lns for w in line.chks]
+    )
+    for ptxt in ptxts:
+        changed = False
+        for line in ptxt.lns:
+            for w in line.chks:
+                if changed:
+                    # splitting rewrites the text's positions, so check again
+                    plan = intrachunk_splits([w]).get(w)
+                else:
+                    plan = plans.get(w)
+                if plan is not None:
+                    changed = True
+                    chrs, splitiis = plan
+                    for ii in reversed(range(len(splitiis))):
+                        sstart = splitiis[ii]
+                        if ii != len(splitiis) - 1:
+                            sstop = splitiis[ii + 1]
+                        else:
+                            sstop = len(chrs)
+                        split_chrs = [chr for chr in w.chrs if chr in chrs[sstart:sstop]]
+                        newtxt = ptxt.split_off_characters(split_chrs)
+                        els.append(newtxt)
     return els
 
 
+def manual_kerning_merges(w, w2):
+    """Check one chunk and its next chunk for a manual kerning merge"""
+    mw = []
+    trl_spcs, ldg_spcs = trailing_leading(w.txt, w2.txt)
+    dx = w.spw * (NUM_SPACES - trl_spcs - ldg_spcs)
+    xtoln = XTOLMKN * w.spw
+    xtolp = XTOLMKP * w.spw
+    ytol  = YTOLMK  * w.mch
+
+    try:
+        tr1, br1, tl2, bl2 = w.get_ut_pts(w2)
+    except ZeroDivisionError:
+        return mw
+
+    if isnumeric(w.txt) and isnumeric(w2.txt, True):
+        dx = w.spw * 0
+
+    previoussp = w.txt == " " and w.prevw is not None
+    validmerge = br1[0] - xtoln <= bl2[0] <= br1[0] + dx + xtolp
+    validmerge = validmerge and br1[1] - ytol <= bl2[1] <= br1[1] + ytol
+    if previoussp and not validmerge:
+        # reconsider in case previous space was weirdly-kerned
+        tr1p, br1p, tl2p, bl2p = w.prevw.get_ut_pts(w2)
+        dx = w.spw * (NUM_SPACES - trl_spcs - ldg_spcs + 1)
+        validmerge = br1p[0] - xtoln <= bl2p[0] <= br1p[0] + dx + xtolp
+
+    if validmerge:
+        mw.append([w2, "same", br1, bl2])
+    return mw
+
+
 def Remove_Manual_Kerning(els, mergesupersub):
     # Generate list of merges
     chks = []
@@ -287,38 +496,51 @@ def Remove_Manual_Kerning(els, mergesupersub):
     for ptxt in ptxts:
         if ptxt.lns is not None:
             chks += [w for line in ptxt.lns for w in line.chks]
-    for w in chks:
-        mw = []
-        w2 = w.nextw
-        if w2 is not None and w2 in chks and not (twospaces(w.txt, w2.txt)):
-            trl_spcs, ldg_spcs = trailing_leading(w.txt, w2.txt)
-            dx = w.spw * (NUM_SPACES - trl_spcs - ldg_spcs)
-            xtoln = XTOLMKN * w.spw
-            xtolp = XTOLMKP * w.spw
-            ytol  = YTOLMK  * w.mch
-
-            try:
-                tr1, br1, tl2, bl2 = w.get_ut_pts(w2)
-            except ZeroDivisionError:
-                w.mw = mw
-                continue
-
-            if isnumeric(w.txt) and isnumeric(w2.txt, True):
-                dx = w.spw * 0
-
-            previoussp = w.txt == " " and w.prevw is not None
-            validmerge = br1[0] - xtoln <= bl2[0] <= br1[0] + dx + xtolp
-            validmerge = validmerge and br1[1] - ytol <= bl2[1] <= br1[1] + ytol
-            if previoussp and not validmerge:
-                # reconsider in case previous space was weirdly-kerned
-                tr1p, br1p, tl2p, bl2p = w.prevw.get_ut_pts(w2)
-                dx = w.spw * (NUM_SPACES - trl_spcs - ldg_spcs + 1)
-                validmerge = br1p[0] - xtoln <= bl2p[0] <= br1p[0] + dx + xtolp
-                
-            if validmerge:
-                mw.append([w2, "same", br1, bl2])
 
-        w.mw = mw
+    # Each chunk can only merge into the next one
+    index = {w: ii for ii, w in enumerate(chks)}
+    i1s = np.array(
+        [ii for ii, w in enumerate(chks) if w.nextw is not None and w.nextw in index],
+        dtype=np.int64,
+    )
+    i2s = np.array([index[chks[ii].nextw] for ii in i1s], dtype=np.int64)
+
+    spw, trl, ldg = chunk_spaces(chks)
+    mch = np.array([np.nan if w.mch is None else w.mch for w in chks], dtype=float)
+    numl = np.array([isnumeric(w.txt) for w in chks], dtype=bool)
+    numr = np.array([isnumeric(w.txt, True) for w in chks], dtype=bool)
+    prevsp = np.array([w.txt == " " and w.prevw is not None for w in chks], dtype=bool)
+    tr1, br1, tl2, bl2, ok = gap_points(chks, i1s, i2s)
+
+    # Resultant chunk would have two spaces
+    skip = np.logical_or(
+        trl[i1s] > 1, np.logical_and(trl[i1s] > 0, ldg[i2s] > 0)
+    )
+    spw1 = spw[i1s]
+    dx = spw1 * (NUM_SPACES - trl[i1s] - ldg[i2s])
+    dx = np.where(np.logical_and(numl[i1s], numr[i2s]), spw1 * 0, dx)
+    xtoln = XTOLMKN * spw1
+    xtolp = XTOLMKP * spw1
+    ytol = YTOLMK * mch[i1s]
+    validmerge = np.logical_and.reduce(
+        (
+            br1[:, 0] - xtoln <= bl2[:, 0],
+            bl2[:, 0] <= br1[:, 0] + dx + xtolp,
+            br1[:, 1] - ytol <= bl2[:, 1],
+            bl2[:, 1] <= br1[:, 1] + ytol,
+        )
+    )
+    # Pairs the arrays can't settle are checked one at a time
+    recheck = np.logical_or.reduce(
+        (~ok, np.isnan(spw1), np.isnan(ytol), np.logical_and(~validmerge, prevsp[i1s]))
+    )
+
+    for w in chks:
+        w.mw = []
+    for k in np.flatnonzero(np.logical_and(~skip, np.logical_and(validmerge, ~recheck))):
+        chks[i1s[k]].mw = [[chks[i2s[k]], "same", br1[k], tuple(bl2[k])]]
+    for k in np.flatnonzero(np.logical_and(~skip, recheck)):
+        chks[i1s[k]].mw = manual_kerning_merges(chks[i1s[k]], chks[i2s[k]])
 
     Perform_Merges(chks, mk=True)
 
@@ -334,21 +556,71 @@ def Remove_Manual_Kerning(els, mergesupersub):
     return els
 
 
-import numpy as np
+from spatial_index import SpatialIndex
 
 
-def External_Merges(els, mergenearby, mergesupersub):
-    # Generate list of merges
-    chks = []
-    for ptxt in [el.parsed_text for el in els]:
-        if ptxt.lns is not None:
-            chks += [w for line in ptxt.lns for w in line.chks]
+def plausible_merges(chks, pairs, mergenearby, mergesupersub):
+    """
+    Filter candidate merges (rows of pairs) with the tests External_Merges
+    makes before classifying them, done on arrays in each first chunk's
+    frame: the second's pen must start near the end of the first, and its
+    baseline (or top, for subscripts) must be within the first's line band.
+    Returns a mask of pairs to classify and the pairs' gap_points.
+    """
+    i1s, i2s = pairs[:, 0], pairs[:, 1]
+    pts = gap_points(chks, i1s, i2s)
+    tr1, br1, tl2, bl2, ok = pts
 
-    pbbs = [None]*len(chks)
-    for ii, w in enumerate(chks):
-        cx = [v[0] for c in w.chrs for v in c.parsed_pts_t]
-        cy = [v[1] for c in w.chrs for v in c.parsed_pts_t]
-        pbbs[ii] = tp.bbox([min(cx),min(cy),max(cx)-min(cx),max(cy)-min(cy)]);
+    spw, trl, ldg = chunk_spaces(chks)
+    mch = np.array([np.nan if w.mch is None else w.mch for w in chks], dtype=float)
+    tfs = np.array([w.tfs for w in chks], dtype=float)
+    empty = np.array([len(wstrip(w.txt)) == 0 for w in chks], dtype=bool)
+    dx = spw[i1s] * (NUM_SPACES - trl[i1s] - ldg[i2s])
+    xtol = XTOLEXT * spw[i1s]
+    ytol = YTOLEXT * mch[i1s]
+
+    xpenmatch = np.logical_and(
+        br1[:, 0] - xtol <= bl2[:, 0], bl2[:, 0] <= br1[:, 0] + dx + xtol
+    )
+    twospc = np.logical_or(trl[i1s] > 1, np.logical_and(trl[i1s] > 0, ldg[i2s] > 0))
+    same = np.logical_and.reduce(
+        (
+            np.abs(bl2[:, 1] - br1[:, 1]) < ytol,
+            np.abs(tfs[i1s] - tfs[i2s]) < 0.001,
+            np.full(len(i1s), bool(mergenearby)),
+        )
+    )
+    band = np.logical_and(mergesupersub, np.logical_or(
+        np.logical_and(br1[:, 1] + ytol >= bl2[:, 1], bl2[:, 1] >= tr1[:, 1] - ytol),
+        np.logical_and(br1[:, 1] + ytol >= tl2[:, 1], tl2[:, 1] >= tr1[:, 1] - ytol),
+    ))
+    plausible = np.logical_and.reduce(
+        (xpenmatch, ~empty[i1s], ~empty[i2s], ~twospc, np.logical_or(same, band))
+    )
+    # Pairs the arrays can't settle are classified one at a time
+    recheck = np.logical_or.reduce((~ok, np.isnan(dx), np.isnan(ytol)))
+    return np.logical_or(plausible, recheck), pts
+
+
+def merge_candidates(chks):
+    """
+    Index pairs of chunks that might merge: the big bbox of the first (its
+    bbox grown by the extra space) intersects the second's, and their angles
+    match. Also sets each chunk's bb_big and clears its merges.
+    """
+    # Parsed bboxes of the chunks, reduced over slices of their characters' corners
+    pbbs = []
+    if len(chks) > 0:
+        cpts = np.array(
+            [c.parsed_pts_t for w in chks for c in w.chrs], dtype=float
+        ).reshape(-1, 4, 2)
+        starts = np.cumsum([0] + [len(w.chrs) for w in chks])[:-1]
+        mins = np.minimum.reduceat(cpts.min(axis=1), starts)
+        maxs = np.maximum.reduceat(cpts.max(axis=1), starts)
+        pbbs = [
+            tp.bbox([mn[0], mn[1], mx[0] - mn[0], mx[1] - mn[1]])
+            for mn, mx in zip(mins.tolist(), maxs.tolist())
+        ]
     
     for ii, w in enumerate(chks):
         dx = (
@@ -365,22 +637,28 @@ def External_Merges(els, mergenearby, mergesupersub):
         )
         w.mw = []
 
-    # Vectorized angle / bbox calculations
-    angles = np.array([[w.angle for w in chks]])
-    sameangle = abs(angles - angles.T) < 0.001
-
+    # Candidate pairs: big bbox of one intersects the other, same angle
     bb1s = [w.bb_big for w in chks]
-    bb2s = pbbs
-    intersects = dh.bb_intersects(bb1s, bb2s)
-
-    # reshape(-1,1) is a transpose
-    potentials = np.logical_and(sameangle, intersects)
+    i2s, i1s = SpatialIndex(pbbs).query_pairs(bb1s)
+    angles = np.array([w.angle for w in chks])
     potentials = np.logical_and(
-        potentials, np.identity(len(chks)) == 0
+        abs(angles[i1s] - angles[i2s]) < 0.001, i1s != i2s
     )  # off-diagonal only
-    goodl = np.argwhere(potentials)
+    return np.stack((i1s[potentials], i2s[potentials]), axis=1)
 
-    for ii in range(goodl.shape[0]):
+
+def External_Merges(els, mergenearby, mergesupersub):
+    # Generate list of merges
+    chks = []
+    for ptxt in [el.parsed_text for el in els]:
+        if ptxt.lns is not None:
+            chks += [w for line in ptxt.lns for w in line.chks]
+
+    goodl = merge_candidates(chks)
+    plausible, pts = plausible_merges(chks, goodl, mergenearby, mergesupersub)
+
+    todo = range(goodl.shape[0]) if DEBUG_MERGE else np.flatnonzero(plausible)
+    for ii in todo:
         w = chks[goodl[ii, 0]]
         w2 = chks[goodl[ii, 1]]
         trl_spcs, ldg_spcs = trailing_leading(w.txt, w2.txt)
@@ -390,7 +668,10 @@ def External_Merges(els, mergenearby, mergesupersub):
         ytol = YTOLEXT * w.mch
 
         # calculate 2's coords in 1's system
-        tr1, br1, tl2, bl2 = w.get_ut_pts(w2)
+        if pts[4][ii]:
+            tr1, br1, tl2, bl2 = pts[0][ii], pts[1][ii], pts[2][ii], tuple(pts[3][ii])
+        else:
+            tr1, br1, tl2, bl2 = w.get_ut_pts(w2)
         xpenmatch = br1[0] - xtol <= bl2[0] <= br1[0] + dx + xtol
         neitherempty = len(wstrip(w.txt)) > 0 and len(wstrip(w2.txt)) > 0
         if xpenmatch and neitherempty and not twospaces(w.txt, w2.txt):
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2023 David Burghoff <burghoff@utexas.edu>
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Spatial index for bounding boxes
+
+Finding which of n boxes intersect which of m others with a dense n x m
+matrix takes quadratic time and memory, which is prohibitive for plots with
+tens of thousands of markers or text chunks. SpatialIndex hashes boxes into a
+uniform grid whose cell size is chosen from the boxes themselves, so that
+queries only compare boxes that share a cell. Everything is done with NumPy
+array operations, and results are returned as sparse index arrays.
+
+Intersection has the same meaning as bbox.intersect: boxes that only touch
+do not intersect, and null boxes intersect nothing.
+"""
+
+import numpy as np
+import dhelpers  # noqa
+from inkex.text.utils import BBoxArray
+
+MAX_CELLS = 64  # boxes spanning more cells than this are checked directly
+MAX_GRID = 2**20  # limit on the number of grid columns and rows
+
+
+def bbox_arrays(bbs):
+    """
+    Convert a list of bboxes (or a BBoxArray) into arrays of x1, y1, x2, y2.
+    Null boxes become NaNs, which fail every comparison.
+    """
+    if isinstance(bbs, BBoxArray):
+        return bbs.x1, bbs.y1, bbs.x2, bbs.y2
+    arr = np.array(
+        [
+            (np.nan, np.nan, np.nan, np.nan)
+            if bb is None or bb.isnull
+            else (bb.x1, bb.y1, bb.x2, bb.y2)
+            for bb in bbs
+        ],
+        dtype=float,
+    ).reshape(-1, 4)
+    return arr[:, 0], arr[:, 1], arr[:, 2], arr[:, 3]
+
+
+def expand(counts):
+    """
+    For an array of counts, return the repeated positions and the offset
+    within each repeat, e.g. [2, 1] -> [0, 0, 1], [0, 1, 0].
+    """
+    pos = np.repeat(np.arange(len(counts)), counts)
+    starts = np.cumsum(counts) - counts
+    return pos, np.arange(len(pos)) - starts[pos]
+
+
+class SpatialIndex:
+    """A uniform-grid hash of a list of bounding boxes."""
+
+    def __init__(self, bbs, cellsize=None):
+        self.x1, self.y1, self.x2, self.y2 = bbox_arrays(bbs)
+        self.xc = (self.x1 + self.x2) / 2
+        self.yc = (self.y1 + self.y2) / 2
+        self.w = self.x2 - self.x1
+        self.h = self.y2 - self.y1
+        self.n = len(self.x1)
+
+        valid = np.flatnonzero(~np.isnan(self.x1))
+        self.nvalid = len(valid)
+        if len(valid) == 0:
+            self.cellsize = 1.0
+            self.ox = self.oy = 0.0
+            self.ncols = self.nrows = 1
+        else:
+            self.ox = self.x1[valid].min()
+            self.oy = self.y1[valid].min()
+            extw = self.x2[valid].max() - self.ox
+            exth = self.y2[valid].max() - self.oy
+            if cellsize is None:
+                # About one box per cell, but no smaller than a typical box
+                typical = np.median(np.maximum(self.w[valid], self.h[valid]))
+                cellsize = max(np.sqrt(extw * exth / len(valid)), typical)
+            cellsize = max(cellsize, max(extw, exth) / MAX_GRID, 1e-12)
+            self.cellsize = float(cellsize)
+            self.ncols = int(extw // self.cellsize) + 1
+            self.nrows = int(exth // self.cellsize) + 1
+
+        # Boxes that would cover many cells are kept aside
+        cx1, cy1, cx2, cy2 = self.cells(self.x1[valid], self.y1[valid],
+                                        self.x2[valid], self.y2[valid])
+        ncells = (cx2 - cx1 + 1) * (cy2 - cy1 + 1)
+        big = ncells > MAX_CELLS
+        self.oversize = valid[big]
+        small = ~big
+        keys, pos = self.cell_keys(cx1[small], cy1[small], cx2[small], cy2[small])
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.idx = valid[small][pos[order]]
+
+    def cells(self, x1, y1, x2, y2):
+        """Ranges of grid cells covered by boxes, clipped to the grid"""
+        def clip(v, hi):
+            v = np.nan_to_num(np.floor(v), nan=0, posinf=hi, neginf=0)
+            return np.clip(v, 0, hi).astype(np.int64)
+
+        return (
+            clip((x1 - self.ox) / self.cellsize, self.ncols - 1),
+            clip((y1 - self.oy) / self.cellsize, self.nrows - 1),
+            clip((x2 - self.ox) / self.cellsize, self.ncols - 1),
+            clip((y2 - self.oy) / self.cellsize, self.nrows - 1),
+        )
+
+    def cell_keys(self, cx1, cy1, cx2, cy2):
+        """Keys of every cell covered by each box, and which box they are from"""
+        nx = cx2 - cx1 + 1
+        ny = cy2 - cy1 + 1
+        pos, off = expand(nx * ny)
+        col = cx1[pos] + off % nx[pos]
+        row = cy1[pos] + off // nx[pos]
+        return col * self.nrows + row, pos
+
+    def intersects(self, i, x1, y1, x2, y2, j):
+        """Exact test of index boxes i against query boxes j"""
+        qxc = (x1[j] + x2[j]) / 2
+        qyc = (y1[j] + y2[j]) / 2
+        return np.logical_and(
+            np.abs(self.xc[i] - qxc) * 2 < self.w[i] + (x2[j] - x1[j]),
+            np.abs(self.yc[i] - qyc) * 2 < self.h[i] + (y2[j] - y1[j]),
+        )
+
+    def query_pairs(self, bbs=None):
+        """
+        Find all pairs of intersecting boxes between the index and bbs (by
+        default, the indexed boxes themselves, including each box with itself).
+        Returns arrays (i, j) of index and query positions, sorted by j and then i.
+        """
+        if bbs is None:
+            x1, y1, x2, y2 = self.x1, self.y1, self.x2, self.y2
+        else:
+            x1, y1, x2, y2 = bbox_arrays(bbs)
+        valid = np.flatnonzero(~np.isnan(x1))
+        empty = np.zeros(0, dtype=np.int64)
+        if self.n == 0 or len(valid) == 0:
+            return empty, empty
+
+        # Candidates that share a grid cell
+        cx1, cy1, cx2, cy2 = self.cells(x1[valid], y1[valid], x2[valid], y2[valid])
+        qkeys, qpos = self.cell_keys(cx1, cy1, cx2, cy2)
+        lo = np.searchsorted(self.keys, qkeys, side="left")
+        hi = np.searchsorted(self.keys, qkeys, side="right")
+        pos, off = expand(hi - lo)
+        ci = self.idx[lo[pos] + off]
+        cj = valid[qpos[pos]]
+
+        # Candidates from oversize boxes
+        if len(self.oversize) > 0:
+            ci = np.concatenate((ci, np.tile(self.oversize, len(valid))))
+            cj = np.concatenate((cj, np.repeat(valid, len(self.oversize))))
+
+        keep = self.intersects(ci, x1, y1, x2, y2, cj)
+        pairs = np.unique(cj[keep] * np.int64(self.n) + ci[keep])
+        return pairs % self.n, pairs // self.n
+
+    def query_box(self, bb):
+        """Indices of the boxes that intersect bb, in increasing order"""
+        return self.query_pairs([bb])[0]
+
+    def nearest(self, x, y, k=1):
+        """
+        Indices of the (up to) k boxes closest to the point (x, y), nearest
+        first. Distance is zero for boxes containing the point.
+        """
+        if self.n == 0 or k <= 0:
+            return np.zeros(0, dtype=np.int64)
+
+        def dists(i):
+            dx = np.maximum(np.maximum(self.x1[i] - x, x - self.x2[i]), 0)
+            dy = np.maximum(np.maximum(self.y1[i] - y, y - self.y2[i]), 0)
+            return np.sqrt(dx**2 + dy**2)
+
+        # Search rings of cells outward from the point's cell until the kth
+        # best candidate is closer than any box that could be in the next ring
+        col, row, _, _ = self.cells(*[np.array([v], dtype=float) for v in (x, y, x, y)])
+        col, row = int(col[0]), int(row[0])
+        # Distance from the point to the edge of its (clipped) cell
+        edge = min(
+            x - (self.ox + col * self.cellsize),
+            self.ox + (col + 1) * self.cellsize - x,
+            y - (self.oy + row * self.cellsize),
+            self.oy + (row + 1) * self.cellsize - y,
+        )
+        found = set(self.oversize.tolist())
+        maxring = max(col, self.ncols - 1 - col, row, self.nrows - 1 - row)
+        ring = 0
+        while True:
+            if ring == 0:
+                cc, rr = np.array([col]), np.array([row])
+            else:
+                span = np.arange(-ring, ring + 1)
+                side = np.arange(-ring + 1, ring)
+                cc = col + np.concatenate((span, span, -ring + 0 * side, ring + 0 * side))
+                rr = row + np.concatenate((-ring + 0 * span, ring + 0 * span, side, side))
+            inside = (cc >= 0) & (cc < self.ncols) & (rr >= 0) & (rr < self.nrows)
+            qkeys = cc[inside] * self.nrows + rr[inside]
+            lo = np.searchsorted(self.keys, qkeys, side="left")
+            hi = np.searchsorted(self.keys, qkeys, side="right")
+            pos, off = expand(hi - lo)
+            found.update(self.idx[lo[pos] + off].tolist())
+
+            cand = np.array(sorted(found), dtype=np.int64)
+            if len(cand) >= k:
+                dst = dists(cand)
+                kth = np.partition(dst, k - 1)[k - 1]
+                # Unsearched boxes are at least this far away
+                if kth <= max(edge, 0) + ring * self.cellsize or ring >= maxring:
+                    break
+            elif ring >= maxring or len(found) == self.nvalid:
+                break
+            ring += 1
+
+        if len(cand) == 0:
+            return cand
+        dst = dists(cand)
+        order = np.lexsort((cand, dst))
+        return cand[order][:k]
@@ -24,6 +24,7 @@
 
 import inkex
 from inkex import Transform
+from inkex.text.cache import SvgDocumentElementCache
 import re, lxml
 
 
@@ -51,6 +52,7 @@ from typing import Dict
 
 wrprops: Dict[str, str] = dict()
 inkexget = inkex.BaseElement.get
+linkatts = SvgDocumentElementCache.RefGraph.linkatts
 
 
 def fast_get(self, attr, default=None):
@@ -72,21 +74,22 @@ inkex.BaseElement.get = fast_get  # type: ignore
 
 def fast_set(self, attr, value):
     """Set element attribute named, with addNS support"""
+    NSattr = inkex.addNS(attr)
     if attr in wrapped_attrs:
         # Always keep the local wrapped class up to date.
         (prop, cls) = wrapped_attrs[attr]
         setattr(self, prop, cls(value))
         value = getattr(self, prop)
         if not value:
-            return
-
-    NSattr = inkex.addNS(attr)
+            value = None  # already removed
 
     if value is None:
         self.attrib.pop(NSattr, None)  # pylint: disable=no-member
     else:
         value = str(value)
         fset(self, NSattr, value)
+    if NSattr in linkatts:
+        self.update_crefs()  # keep the document's reference graph up to date
 
 
 inkex.BaseElement.set = fast_set  # type: ignore